@@ -1,19 +1,21 @@
 import os
 import json
+import asyncio
 from datetime import datetime, UTC
 from dotenv import load_dotenv
-import requests
 
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 
-from google.cloud import storage
-from google.cloud import language_v2
 from google.cloud import run_v2
 
 from shared.db.sql_cn import SqlCN
-from shared.c_run import get_google_cloud_run_service_url
+from shared.db.async_sql_cn import AsyncSqlCN
+from shared.c_run import trigger_service
+from utiles.append_log import append_log, close_logs
 from utiles.playbook_tools import PlaybookTools
-from utiles.sentiment import Sentiment
+from utiles.scheduler import AdvisoryRunLock, CoalescingScheduler
+from utiles.sentiment import Sentiment, sentiment_backend
 
 
 
@@ -25,52 +27,50 @@ fapp = FastAPI()
 
 # Db & Utiles
 sqlcn = SqlCN()
+asqlcn = AsyncSqlCN()
 pbt = PlaybookTools(sqlcn)
 ss = Sentiment(sqlcn)
+# Scorer of /nlp-analysis, set SENTIMENT_BACKEND=lexicon to score posts in process
+sentiment_scorer = sentiment_backend()
+# Coalesces overlapping /nlp-analysis and /analysis runs of a thread, sized by its backlog, which pending_count() counts
+# with the CLAIM_VISIBILITY_TIMEOUT of claim_pending_posts(). Advisory locks coalesce them across instances too.
+scheduler = CoalescingScheduler(backlog_fn=sqlcn.posts.pending_count, lock_fn=AdvisoryRunLock(sqlcn.engine).hold)
 
 
 def trigger_analysis(project_id, location, thread_id, service_name="analysis-service", nlp="nlp"):
-    s_url = get_google_cloud_run_service_url(project_id=project_id, location=location, service_name=service_name)
-    if s_url is None:
-        s_url="http://localhost:8000"
-    print(f"service_url: {s_url}")
-    try:
-        if nlp == "nlp":
-            print(f"Trigger analysis {s_url}/nlp-analysis/{thread_id} again...")
-            requests.get(f"{s_url}/nlp-analysis/{thread_id}", timeout=2)
-        else:
-            print(f"Trigger analysis {s_url}/analysis/{thread_id} again...")
-            requests.get(f"{s_url}/analysis/{thread_id}", timeout=2)
-    except requests.exceptions.ReadTimeout: 
-        pass
+    # Sent in the background, the caller doesn't wait for discovery or the request
+    if nlp == "nlp":
+        trigger_service(project_id, location, service_name, f"/nlp-analysis/{thread_id}", timeout=2)
+    else:
+        trigger_service(project_id, location, service_name, f"/analysis/{thread_id}", timeout=2)
 
 
 def append_line_to_gcs_file(bucket_name, blob_name, new_line):
     """
-    Appends a line to a file in a GCS bucket.
+    Appends a line to a file in a GCS bucket, lines are buffered and written as segments by AppendLog, which
+    composes them into the file later.
     Args:
         bucket_name: The name of the GCS bucket.
         blob_name: The name of the file (blob) in the bucket.
         new_line: The line to append to the file.
     """
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        # Download the file
-        try:
-            file_content = blob.download_as_string().decode('utf-8')
-        except:
-            file_content = ""  # If the file doesn't exist, start with empty content
+    append_log(bucket_name, blob_name).append(new_line)
+    print(f"Line appended to {blob_name} in bucket {bucket_name}")
+
 
-        # Append the new line
-        file_content += new_line + "\n"
 
-        # Upload the modified file
-        blob.upload_from_string(file_content)
-        print(f"Line appended to {blob_name} in bucket {bucket_name}")
-    except Exception as e:
-        print(f"Error appending line to GCS file: {e}")
+async def prefetch_in_threadpool(iterator):
+    """
+    Iterate a blocking iterator in the threadpool, the next item is fetched while the caller processes the current one.
+    """
+    done = object()
+    nxt = asyncio.ensure_future(run_in_threadpool(next, iterator, done))
+    while True:
+        item = await nxt
+        if item is done:
+            return
+        nxt = asyncio.ensure_future(run_in_threadpool(next, iterator, done))
+        yield item
 
 
 
@@ -81,69 +81,63 @@ def index():
 
 @fapp.get("/nlp-analysis/{thread_id}")
 def nlp_analyze_sentiment(thread_id):
+    project_id = os.getenv("PROJECT_ID") or "multi-gke-ops"
+    location = os.getenv("LOCATION") or "us-central1"
+    status = scheduler.run(
+        ("nlp", thread_id),
+        thread_id,
+        lambda batch_size: run_nlp_analysis(thread_id, batch_size),
+        handoff=lambda: trigger_analysis(project_id=project_id, location=location, thread_id=thread_id),
+    )
+    return {"status": status}
+
+
+def run_nlp_analysis(thread_id, batch_size=None):
     analysis_gcs_bucket = os.getenv("ANALYSIS_GCS_BUCKET") or "rrd-sentiment-analysis-multi-gke-ops"
 
-    results = ss.retrieve_unprocessed_posts(thread_id)
+    results = ss.retrieve_unprocessed_posts(thread_id, batch_size=batch_size)
     if results is not None and len(results.get("data"))>0:
         rows = results.get("data")
         batch_id = results.get("batch_id")
-        ls_client = language_v2.LanguageServiceClient()
-        # Available types: PLAIN_TEXT, HTML
-        document_type_in_plain_text = language_v2.Document.Type.PLAIN_TEXT
-        # Optional. If not specified, the language is automatically detected.
-        # For list of supported languages:
-        # https://cloud.google.com/natural-language/docs/languages
-        # language_code = "en"
-        analysis_file = f"nlp-analysis-{datetime.now(UTC).strftime('%Y%m%d%H%M%S')}.jsonl"
-        with open(f"/tmp/{analysis_file}", "a") as f:
-            for row in rows:
-                document = {
-                    "content": json.dumps(row.content),
-                    "type_": document_type_in_plain_text,
-                }
-
-                # Available values: NONE, UTF8, UTF16, UTF32
-                # See https://cloud.google.com/natural-language/docs/reference/rest/v2/EncodingType.
-                encoding_type = language_v2.EncodingType.UTF8
-                try:
-                    response = ls_client.analyze_sentiment(
-                        request={"document": document, "encoding_type": encoding_type}
-                    )
-                except Exception as e: 
-                    print(e)
-                    print(f"Ignored this row due to error!!! post_id:{row.post_id} in batch_id:{batch_id}")
-                    continue
-
-                print(f"Language of the text: {response.language_code}")
-                if response.document_sentiment.score > 0:
-                    label ="positive" 
-                elif response.document_sentiment.score == 0:
-                    label = "neutral"
-                else:
-                    label = "negative"
-                r_data = {
-                    "content_id": row.post_id,
-                    "thread_id": row.thread_id,
-                    "platform_id": row.platform_id,
-                    "sentiment" : {
-                        "score": response.document_sentiment.score,
-                        "magnitude": response.document_sentiment.magnitude,
-                        "label": label
-                    }
-                }
-                f.write(json.dumps(r_data) + '\r')
-                f.write('\n')
-            f.close()
-
-            if len(rows)>0:
-                # Upload the analysis_file into GCS bucket 
-                blob_name = ss.upload_to_bucket(f"processed/{analysis_file}", analysis_file, analysis_gcs_bucket)
-                print(f"Uploaded file: {blob_name} with success")
+        # Back-to-back rounds of the scheduler may start within the same second
+        analysis_file = f"nlp-analysis-{datetime.now(UTC).strftime('%Y%m%d%H%M%S')}-{batch_id[3:11]}.jsonl"
+        # Stream results into the blob as they're scored, the object is finalized (and post_analysis is notified)
+        # only when the writer is closed.
+        n = 0
+        with ss.open_blob_writer(f"processed/{analysis_file}", analysis_gcs_bucket) as f:
+            for r_data in sentiment_scorer.score(rows, batch_id=batch_id):
+                f.write(json.dumps(r_data) + '\r\n')
+                n += 1
+        print(f"Uploaded file: processed/{analysis_file} with {n}/{len(rows)} scored posts")
 
 
 
 @fapp.get("/analysis/{thread_id}")
 def analysis(thread_id: str):
+    project_id = os.getenv("PROJECT_ID") or "multi-gke-ops"
+    location = os.getenv("LOCATION") or "us-central1"
+    results = []
+    status = scheduler.run(
+        ("batch", thread_id),
+        thread_id,
+        lambda batch_size: results.append(run_batch_analysis(thread_id, batch_size)),
+        handoff=lambda: trigger_analysis(project_id=project_id, location=location, thread_id=thread_id, nlp=None),
+    )
+    return results[-1] if len(results) > 0 else {"status": status}
+
+
+@fapp.get("/scheduler")
+def scheduler_metrics():
+    return scheduler.metrics()
+
+
+@fapp.get("/sql-stats")
+def sql_stats():
+    # Sampled query latency, rows and pool wait per query of both engines since start, see shared/db/instrument.py
+    return {"sync": sqlcn.instrument.snapshot(), "async": asqlcn.instrument.snapshot()}
+
+
+def run_batch_analysis(thread_id: str, batch_size=None):
     """
     Main function for batch prediction, which includes the following flows:
         1. Extract unprocessed rows from BQ and save it into /to_be_process/ folder in GCS.
@@ -174,7 +168,8 @@ def analysis(thread_id: str):
         location=location,
         thread_id=thread_id,
         analysis_gcs_bucket=analysis_gcs_bucket,
-        input_file=input_file
+        input_file=input_file,
+        batch_size=batch_size
     )
 
     if records is not None:
@@ -209,7 +204,7 @@ async def post_analysis(request: Request, q: str | None = None):
     file_name = bdata['name']
     print(f"File {file_name} from bucket {bucket_name}")
     print(f"q={q}")
-    if ss.is_marked_blob(blob_name=bdata['name']):
+    if await run_in_threadpool(ss.is_marked_blob, blob_name=bdata['name']):
         return {"status": "duplicated event, ignored."}
 
     # Get environment variables
@@ -217,52 +212,29 @@ async def post_analysis(request: Request, q: str | None = None):
     location = os.getenv("LOCATION") or "us-central1"
 
     if file_name.startswith("processed"):
-        if file_name.startswith("processed/nlp-analysis-"):
-            sents = ss.read_analysis_response(gcs_bucket=bucket_name, blob_name=file_name, nlp=q)
-        else:
-            sents = ss.read_analysis_response(gcs_bucket=bucket_name, blob_name=file_name)
-        print(sents)
-        
-        # Save sentiment core, sentiment_magnitude, sentiment_label
-        rows_to_update=[]
-        for st in sents:
-            try: 
-                thread_id = st["thread_id"]
-                if st["content_id"].startswith("tw"):
-                    platform_id = "twitter"
-                elif st["content_id"].startswith("gs"):
-                    platform_id = "google-search"
-                elif st["content_id"].startswith("gn"):
-                    platform_id = "google-news"
-                else:
-                    platform_id = st["platform_id"]
-                
-                row = {
-                    "post_id": st["content_id"],
-                    "thread_id": st["thread_id"],
-                    "platform_id": platform_id,
-                    "sentiment_score": st["sentiment"]["score"],
-                    "sentiment_magnitude": st["sentiment"]["magnitude"],
-                    "sentiment_label": st["sentiment"]["label"],
-                    "status": "sentimented",
-                    "sentiment_at": datetime.now(UTC).isoformat(),
-                }
-                rows_to_update.append(row)
-            except Exception as e:
-                print(e)
-                pass
-        
-        if len(rows_to_update)>0:
-            # Update sentiment results
-            print(f"{len(rows_to_update)} rows will be updated.")
-            print(f"{len(sqlcn.posts.save_sentiment_results(rows_to_update))} rows have be updated.")
-        
+        nlp = q if file_name.startswith("processed/nlp-analysis-") else None
+        # Write micro-batches while the rest of the blob is still being downloaded and parsed
+        batches = ss.iter_sentiment_batches(gcs_bucket=bucket_name, blob_name=file_name, nlp=nlp)
+        n_rows, n_updated = 0, 0
+        thread_id, platform_id = None, None
+        async for batch in prefetch_in_threadpool(batches):
+            n_rows += len(batch)
+            saved = await asqlcn.posts.save_sentiment_results(batch)
+            if saved is None:
+                # A failed micro-batch is rolled back on its own, the rest of the blob is still written
+                print(f"Failed to save sentiment results of {len(batch)} posts from {file_name}: "
+                      f"{[r.get('post_id') for r in batch]}")
+            n_updated += len(saved or [])
+            thread_id, platform_id = batch[-1]["thread_id"], batch[-1]["platform_id"]
+        print(f"{n_updated}/{n_rows} rows have be updated.")
+
+        if n_rows>0:
             # Get last sentiment level
-            s_level, is_new_level = sqlcn.sentiment_summaries.calculate_sentiment_level(thread_id, platform_id)
+            s_level, is_new_level = await asqlcn.sentiment_summaries.calculate_sentiment_level(thread_id, platform_id)
             
             if is_new_level:    
                 # Trigger generate playbook when sentiment level changed
-                pbt.gen_playbook(thread_id=thread_id)
+                await pbt.agen_playbook(thread_id)
 
             # Trigger analysis again
             if file_name.startswith("processed/nlp-analysis-"):
@@ -277,5 +249,11 @@ async def post_analysis(request: Request, q: str | None = None):
 
 
 @fapp.get("/playbook/{thread_id}")
-def latest_playbook(thread_id: str):
-    return sqlcn.playbooks.last_playbook(thread_id)
\ No newline at end of file
+async def latest_playbook(thread_id: str):
+    return await asqlcn.playbooks.last_playbook(thread_id)
+
+
+@fapp.on_event("shutdown")
+async def shutdown():
+    await run_in_threadpool(close_logs)
+    await asqlcn.close()
\ No newline at end of file
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, UTC
+
+from google.api_core import exceptions as gexc
+
+from . import storage
+
+
+# GCS composes at most 32 source objects per request
+MAX_COMPOSE_SOURCES = 32
+# Metadata key of the log, names of the segments composed into it as a JSON list, see AppendLog.compact()
+COMPOSED_KEY = "rrd-composed-segments"
+
+
+class AppendLog():
+    """
+    Buffered append-only log on object storage, lines are batched in memory and written as small segment objects:
+        <blob_name>.segments/<timestamp>-<uuid>.txt
+    Segments are composed into <blob_name> from time to time, so appending a line never downloads or rewrites the
+    whole log, and concurrent instances never overwrite each other's lines.
+    Flushed every APPEND_LOG_FLUSH_INTERVAL seconds (default 10) or once APPEND_LOG_MAX_LINES (default 500) are
+    buffered, compacted when APPEND_LOG_COMPACT_SEGMENTS (default 16) segments are pending.
+    Flushes run on a daemon thread and close() flushes the rest, which the service calls on shutdown. Lines still
+    buffered when the process is killed without a shutdown, e.g. by SIGKILL or an OOM kill, are lost, up to
+    flush_interval seconds or max_lines of them.
+    """
+    def __init__(self, bucket, blob_name: str, flush_interval: float=None, max_lines: int=None,
+                 compact_segments: int=None):
+        self.bucket = bucket
+        self.blob_name = blob_name
+        self.segment_prefix = f"{blob_name}.segments/"
+        self.flush_interval = flush_interval or float(os.getenv("APPEND_LOG_FLUSH_INTERVAL") or 10)
+        self.max_lines = max_lines or int(os.getenv("APPEND_LOG_MAX_LINES") or 500)
+        self.compact_segments = min(
+            compact_segments or int(os.getenv("APPEND_LOG_COMPACT_SEGMENTS") or 16), MAX_COMPOSE_SOURCES - 1
+        )
+        self._lines = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._pending_segments = 0
+        self._flusher = threading.Thread(target=self._run, name=f"append-log-{blob_name}", daemon=True)
+        self._flusher.start()
+
+
+    def append(self, line: str):
+        with self._lock:
+            self._lines.append(line)
+            full = len(self._lines) >= self.max_lines
+        if full:
+            self._wakeup.set()
+
+
+    def flush(self) -> str:
+        """
+        Write buffered lines as one segment object.
+        Returns:
+            Name of the segment, None if nothing was buffered.
+        """
+        with self._flush_lock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+            if len(lines) == 0:
+                return None
+            name = f"{self.segment_prefix}{datetime.now(UTC).strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}.txt"
+            try:
+                self.bucket.blob(name).upload_from_string("".join(f"{line}\n" for line in lines))
+            except Exception as e:
+                print(f"Failed to write segment {name}, err: {e}")
+                with self._lock:
+                    self._lines = lines + self._lines
+                return None
+            self._pending_segments += 1
+            if self._pending_segments >= self.compact_segments:
+                self.compact()
+            return name
+
+
+    def compact(self) -> int:
+        """
+        Compose pending segments, oldest first, into the log and delete them. The compose is conditional on the
+        generation of the log, so only one of concurrent compactions wins and the others leave segments for later.
+        The log's metadata names the segments it holds, which are only deleted, never composed again. Otherwise an
+        instance could compose segments another one has composed but not deleted yet, and duplicate their lines.
+        Returns:
+            Number of segments have been compacted.
+        """
+        target = self.bucket.get_blob(self.blob_name)
+        metadata = (target.metadata if target is not None else None) or {}
+        composed = set(json.loads(metadata.get(COMPOSED_KEY) or "[]"))
+        segments = list(self.bucket.list_blobs(prefix=self.segment_prefix))
+        done = [s for s in segments if s.name[len(self.segment_prefix):] in composed]
+        pending = [s for s in segments if s.name[len(self.segment_prefix):] not in composed][:MAX_COMPOSE_SOURCES - 1]
+        if len(pending) > 0:
+            log = self.bucket.blob(self.blob_name)
+            # Composed segments not deleted yet stay listed, until they're gone
+            log.metadata = {COMPOSED_KEY: json.dumps(sorted(s.name[len(self.segment_prefix):] for s in done + pending))}
+            try:
+                log.compose(
+                    ([target] if target is not None else []) + pending,
+                    if_generation_match=target.generation if target is not None else 0,
+                )
+            except gexc.PreconditionFailed:
+                print(f"Log {self.blob_name} was compacted concurrently, retry later.")
+                return 0
+        for segment in done + pending:
+            try:
+                segment.delete()
+            except gexc.NotFound:
+                pass
+        self._pending_segments = max(0, self._pending_segments - len(pending))
+        if len(pending) > 0:
+            print(f"Compacted {len(pending)} segments into {self.blob_name}")
+        return len(pending)
+
+
+    def close(self):
+        """
+        Stop the flusher, then flush and compact what's left.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join(timeout=self.flush_interval)
+        self.flush()
+        try:
+            while self.compact() > 0:
+                pass
+        except Exception as e:
+            print(f"Failed to compact {self.blob_name}, err: {e}")
+
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush {self.blob_name}, err: {e}")
+
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+
+def append_log(gcs_bucket: str, blob_name: str) -> AppendLog:
+    """
+    Returns:
+        The process-wide AppendLog of the blob, storage is picked by storage.bucket().
+    """
+    with _logs_lock:
+        key = (gcs_bucket, blob_name)
+        if key not in _logs:
+            _logs[key] = AppendLog(storage.bucket(gcs_bucket), blob_name)
+        return _logs[key]
+
+
+def close_logs():
+    with _logs_lock:
+        logs = list(_logs.values())
+        _logs.clear()
+    for log in logs:
+        log.close()
+
+
+def bench_append_log(lines=10000, local_dir="/tmp/rrd-blobs"):
+    """
+    Append lines to a log under a local directory, prints per-line cost and checks every line made it into the log.
+    """
+    bucket = storage.LocalBucket(os.path.join(local_dir, "bench-log"))
+    log = AppendLog(bucket, f"unknown-issues-{uuid.uuid4().hex[:8]}.txt", flush_interval=0.2, max_lines=500)
+    started = time.perf_counter()
+    for i in range(lines):
+        log.append(f"processed/line-{i}.jsonl")
+    appended = time.perf_counter() - started
+    log.close()
+    with bucket.blob(log.blob_name).open("r") as f:
+        n = sum(1 for _ in f)
+    print(f"appended {lines} lines in {appended * 1000:.1f}ms ({appended / lines * 1e6:.2f}us/line), "
+          f"{n} lines in {log.blob_name} after close")
+
+
+if __name__ == "__main__":
+    bench_append_log(lines=int(os.getenv("BENCH_LINES") or 10000))
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from google.api_core import exceptions as gexc
+from google.cloud import language_v2
+
+from .sentiment import SentimentBackend, sentiment_record
+
+
+# Errors of the Natural Language API which are worth another try, anything else (e.g. unsupported language) is final.
+RETRYABLE_ERRORS = (
+    gexc.ResourceExhausted,
+    gexc.ServiceUnavailable,
+    gexc.DeadlineExceeded,
+    gexc.InternalServerError,
+    gexc.TooManyRequests,
+)
+
+
+class RateLimiter():
+    """
+    A thread-safe token bucket, acquire() blocks until a token is available.
+    """
+    def __init__(self, rate_per_sec: float, burst: int=None):
+        self.rate = rate_per_sec
+        self.capacity = burst or max(1, int(rate_per_sec))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class NlpScorer(SentimentBackend):
+    """
+    Score posts with the Natural Language API on a bounded thread pool, results are yielded as they complete so the
+    caller can stream them out, e.g.:
+        scorer = NlpScorer()
+        for r_data in scorer.score(rows):
+            f.write(json.dumps(r_data) + "\\r\\n")
+    The client is anything with analyze_sentiment(request=...) like language_v2.LanguageServiceClient, which is
+    created on first use when not given.
+    Configured by NLP_CONCURRENCY (default 16), NLP_RATE_LIMIT (requests per second, default unlimited) and
+    NLP_MAX_RETRIES (default 3).
+    """
+    def __init__(self, client=None, concurrency: int=None, rate_per_sec: float=None, max_retries: int=None,
+                 backoff: float=0.5):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.concurrency = concurrency or int(os.getenv("NLP_CONCURRENCY") or 16)
+        rate_per_sec = rate_per_sec if rate_per_sec is not None else float(os.getenv("NLP_RATE_LIMIT") or 0)
+        self.limiter = RateLimiter(rate_per_sec) if rate_per_sec > 0 else None
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("NLP_MAX_RETRIES") or 3)
+        self.backoff = backoff
+
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = language_v2.LanguageServiceClient()
+            return self._client
+
+
+    def analyze(self, content: str):
+        """
+        One analyze_sentiment call, rate limited and retried with jittered exponential backoff on retryable errors.
+        """
+        request = {
+            "document": {
+                "content": content,
+                "type_": language_v2.Document.Type.PLAIN_TEXT,
+            },
+            "encoding_type": language_v2.EncodingType.UTF8,
+        }
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                return self.client.analyze_sentiment(request=request)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                print(f"Retry analyze_sentiment in {delay:.2f}s, attempt {attempt + 1}, err: {e}")
+                time.sleep(delay)
+
+
+    def score_row(self, row) -> dict:
+        response = self.analyze(json.dumps(row.content))
+        return sentiment_record(row, response.document_sentiment.score, response.document_sentiment.magnitude)
+
+
+    def score(self, rows, batch_id: str=None):
+        """
+        Score rows concurrently, at most `concurrency` requests are in flight.
+        Returns:
+            Iterator of result records in completion order, rows failed after retries are logged and skipped.
+        """
+        rows = iter(rows)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="nlp") as pool:
+            pending = {}
+            for row in rows:
+                pending[pool.submit(self.score_row, row)] = row
+                if len(pending) >= self.concurrency:
+                    break
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    row = pending.pop(fut)
+                    try:
+                        yield fut.result()
+                    except Exception as e:
+                        print(e)
+                        print(f"Ignored this row due to error!!! post_id:{row.post_id} in batch_id:{batch_id}")
+                    nxt = next(rows, None)
+                    if nxt is not None:
+                        pending[pool.submit(self.score_row, nxt)] = nxt
+
+
+class FakeLanguageClient():
+    """
+    Stand-in for LanguageServiceClient with a fixed latency, scores are derived from the content so they are stable.
+    """
+    def __init__(self, latency: float=0.2, error_rate: float=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+    def analyze_sentiment(self, request):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise gexc.ServiceUnavailable("fake unavailable")
+        h = hashlib.md5(request["document"]["content"].encode("utf-8")).digest()
+        return SimpleNamespace(
+            language_code="en",
+            document_sentiment=SimpleNamespace(score=round(h[0] / 127.5 - 1, 3), magnitude=round(h[1] / 64, 3)),
+        )
+
+
+def bench_nlp_scoring(docs=1000, latency=0.2, concurrency=16, error_rate=0.0, out_file="/tmp/nlp-bench.jsonl"):
+    """
+    Score fake posts with FakeLanguageClient and stream results to a local file, prints docs/min.
+    """
+    rows = [
+        SimpleNamespace(post_id=f"p{i}", thread_id=1, platform_id="twitter", content=f"post number {i}")
+        for i in range(docs)
+    ]
+    scorer = NlpScorer(client=FakeLanguageClient(latency, error_rate), concurrency=concurrency, backoff=0.05)
+    started = time.perf_counter()
+    n = 0
+    with open(out_file, "w") as f:
+        for r_data in scorer.score(rows, batch_id="bench"):
+            f.write(json.dumps(r_data) + '\r\n')
+            n += 1
+    elapsed = time.perf_counter() - started
+    print(f"scored {n}/{docs} docs in {elapsed:.2f}s, {n / elapsed * 60:.0f} docs/min, concurrency={concurrency}")
+
+
+if __name__ == "__main__":
+    bench_nlp_scoring(
+        docs=int(os.getenv("BENCH_DOCS") or 1000),
+        latency=float(os.getenv("BENCH_LATENCY") or 0.2),
+        concurrency=int(os.getenv("NLP_CONCURRENCY") or 16),
+        error_rate=float(os.getenv("BENCH_ERROR_RATE") or 0.0),
+    )
@@ -2,16 +2,26 @@ import os
 import json
 import datetime
 import ast
+import asyncio
 from shared.db.sql_cn import SqlCN
-from shared.llm import init_model, call_llm
+from shared.llm import init_model, call_llm, call_llm_many
+from shared.prompt_builder import PromptBuilder
 
 
 class PlaybookTools():
+    """
+    A playbook is reused instead of calling the model again when one of the thread was generated within
+    PLAYBOOK_CACHE_TTL seconds (default 1800, 0 to disable) and either from the same inputs (see input_hash() of
+    shared/prompt_builder.py), or at a sentiment level less than PLAYBOOK_MIN_DELTA (default 5) away.
+    """
     def __init__(self, sqlcn: SqlCN):
         self.sqlcn = sqlcn
+        self.prompt_builder = PromptBuilder()
+        self.cache_ttl = int(os.getenv("PLAYBOOK_CACHE_TTL") or 1800)
+        self.min_delta = float(os.getenv("PLAYBOOK_MIN_DELTA") or 5)
 
 
-    def save_playbook(self, thread_id: str, playbook: dict):
+    def save_playbook(self, thread_id: str, playbook: dict, input_hash: str=None, sentiment_level=None):
         if bool(playbook):
             p = {
                     "display_name": playbook.get("report_name"),
@@ -22,24 +32,59 @@ class PlaybookTools():
                         "incident_categorization": playbook["incident_categorization"]
                     }),
                     "plan": json.dumps(playbook["recommendations"]),
-                    "created_at": datetime.datetime.now(datetime.UTC).isoformat()
+                    "created_at": datetime.datetime.now(datetime.UTC).isoformat(),
+                    "input_hash": input_hash,
+                    "sentiment_level": float(sentiment_level) if sentiment_level is not None else None,
             }
             r = self.sqlcn.playbooks.create_playbook(p)
 
 
+    def cached_playbook(self, thread_id: str, input_hash: str, sentiment_level) -> dict:
+        """
+        Returns:
+            The stored playbook to reuse for these inputs, in the same shape as generated, None to generate a new one.
+        """
+        if self.cache_ttl <= 0:
+            return None
+        since = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=self.cache_ttl)
+        row = self.sqlcn.playbooks.recent_playbook(thread_id, since, input_hash=input_hash)
+        reason = "same inputs"
+        if row is None and sentiment_level is not None:
+            row = self.sqlcn.playbooks.recent_playbook(thread_id, since)
+            if row is None or row.get("sentiment_level") is None \
+                    or abs(float(sentiment_level) - row["sentiment_level"]) >= self.min_delta:
+                return None
+            reason = f"sentiment level {float(sentiment_level):.2f} within {self.min_delta} of " \
+                     f"{row['sentiment_level']:.2f}"
+        if row is None:
+            return None
+        print(f"Reuse playbook {row['playbook_id']} of thread {thread_id}, {reason}")
+        assessment = row["assessment"]
+        plan = row["plan"]
+        return {
+            "report_name": row["display_name"],
+            **(json.loads(assessment) if isinstance(assessment, str) else assessment),
+            "recommendations": json.loads(plan) if isinstance(plan, str) else plan,
+        }
+
+
     def gen_positive_content(self, project_id: str, location: str, model_id: str, thread_id: str) -> dict:
+        prompt = self.positive_content_prompt(thread_id)
+        if prompt is not None:
+            llm = init_model(project_id=project_id, location=location, model_id=model_id)
+            return call_llm(llm, prompt)
+
+
+    def positive_content_prompt(self, thread_id: str) -> str:
         # Query thread detail from threads
         thread = self.sqlcn.threads.thread_by_id(thread_id)
         thread_context = thread.get("context")
         # Query records from posts
-        posts = self.sqlcn.posts.recent_top100_worst_posts(thread_id)
-        neg_content = []
-        for row in posts:
-            neg_content.append({
-                "post_id": row.post_id,
-                "platform_id": row.platform_id,
-                "content": json.dumps(row.content)
-            })
+        posts = self.sqlcn.posts.sentiment_snapshot(thread_id).get("negative")
+        packed, _ = self.prompt_builder.pack(
+            {"negative": posts}, thread_context, self.prompt_builder.token_budget, shares=(("negative", 1.0),)
+        )
+        neg_content = [json.loads(line) for line in packed["negative"]]
 
         if len(neg_content)>0:
             neg_content_sample = [
@@ -89,87 +134,42 @@ class PlaybookTools():
                 Responding:
             
             """
-            
-            llm = init_model(project_id=project_id, location=location, model_id=model_id)
-            return call_llm(llm, prompt)
-            
+            return prompt
+        return None
 
 
 
   
-    def gen_assessment(self, project_id: str, location: str, model_id: str, thread_id: str) -> dict:
-        # Top 100 Negative content
-        negative_content = self.sqlcn.posts.recent_top100_worst_posts(thread_id)
-        # Top 10 positive content
-        positive_content = self.sqlcn.posts.recent_top100_best_posts(thread_id)
-        # Top 10 Neutral content
-        neutral_content = self.sqlcn.posts.recent_top100_neutral_posts(thread_id)
-        # Sentiment distribution as count
-        s_distribution = self.sqlcn.posts.sentiment_distribution_by_score(thread_id)
-        # Last sentiment level
-        sentiment_level=self.sqlcn.sentiment_summaries.last_overall_sentiment_level(thread_id)
-        # Query thread detail from threads
-        thread = self.sqlcn.threads.thread_by_id(thread_id)
-
-        json_format = {
-                "report_name": "Give a creative name for this reputation report within five words.",
-                "summary": "Key findings and data points summarized, including reputational strengths and weaknesses.",
-                "severity_assessment": "Evaluation of the potential impact on brand reputation.",
-                "incident_categorization": {
-                    "category": "Category of the incident (e.g., unmet expectations, product failure, etc.)",
-                    "explanation": "Explanation for the chosen category"
-                },
-                "recommendations": {
-                    "response_strategy": "Comprehensive communication plan to address concerns and manage public perception.",
-                    "performance_monitoring": "Methods for tracking the effectiveness of the response strategy.",
-                    "post_incident_analysis": "Process for reviewing the incident and improving future strategies.",
-                    "reputation_building": "Proactive measures to strengthen online reputation."
-                }
-            }
-        prompt = f"""
-            You are a public relations expert with extensive experience in mitigating reputation incidents and in-depth knowledge of organizational strategies. Your task is to analyze the provided context and analytic data to generate a comprehensive reputation report in JSON format.
-
-            ## Context
-            {thread.get("context")}
-
-            ## Analytic Data
-
-            **The sentiment results are based on content collected from media platforms: {thread.get("platform_ids")}.** 
-
-            Positive  records: {s_distribution.get("positive")}
-            Negative records:  {s_distribution.get("negative")}
-            Neutral records: {s_distribution.get("neutral")} 
-
-            ** Sentiment level (sentiment_level = (0.7 * sentiment_score) + (0.3 * sentiment_magnitude)) is formulated by last two hours sentiment records and the value is between 1 and 100 after normalization. ** 
-
-            Sentiment level:  {sentiment_level}
-
-            **Top 100 positive records**
-
-            {positive_content}
-
-            **Top 100 neutral records**
-
-            {negative_content}
-            
-            **Top 100 negative records**
+    def gen_assessment(self, project_id: str, location: str, model_id: str, thread_id: str, prompt: str=None) -> dict:
+        if prompt is None:
+            prompt = self.assessment_prompt(thread_id)
+        llm = init_model(project_id=project_id, location=location, model_id=model_id)
 
-            {neutral_content}
+        responding = call_llm(llm, prompt)
+        print(f"responding from call_llm: {responding}")
+        return ast.literal_eval(responding)
 
-            ## Instructions
 
-            Based on the provided context and analytic data, create a reputation report following this structure:
+    def assessment_prompt(self, thread_id: str) -> str:
+        prompt, _ = self.assessment_inputs(thread_id)
+        return prompt
 
-            {json_format}
 
-            Ensure your report adheres strictly to the JSON structure above.  Use the provided context and analytic data to populate each section of the JSON object with relevant information.
+    def assessment_inputs(self, thread_id: str) -> tuple[str, dict]:
         """
-            
-        llm = init_model(project_id=project_id, location=location, model_id=model_id)
+        Returns:
+            The assessment prompt, and its metrics with input_hash and sentiment_level.
+        """
+        # Top 100 negative, positive, neutral content and sentiment distribution as count, in one query
+        snapshot = self.sqlcn.posts.sentiment_snapshot(thread_id)
+        # Last sentiment level
+        sentiment_level=self.sqlcn.sentiment_summaries.last_overall_sentiment_level(thread_id)
+        # Query thread detail from threads
+        thread = self.sqlcn.threads.thread_by_id(thread_id)
 
-        responding = call_llm(llm, prompt)
-        print(f"responding from call_llm: {responding}")
-        return ast.literal_eval(responding)
+        prompt, metrics = self.prompt_builder.assessment_prompt(thread, snapshot, sentiment_level)
+        metrics["sentiment_level"] = sentiment_level
+        return prompt, metrics
 
 
 
@@ -183,11 +183,16 @@ class PlaybookTools():
 
         # Get request
         try:
+            prompt, inputs = self.assessment_inputs(thread_id)
+            pbook = self.cached_playbook(thread_id, inputs["input_hash"], inputs["sentiment_level"])
+            if pbook is not None:
+                return pbook
             pbook = self.gen_assessment(
                 project_id=project_id, 
                 location=location, 
                 model_id=model_id,
-                thread_id=thread_id
+                thread_id=thread_id,
+                prompt=prompt
             )
             # TODO: Maybe gen_positive content seperately
             # pcontent = gen_positive_content(
@@ -198,10 +203,57 @@ class PlaybookTools():
             #     thread_context=thread_context, 
             #     model_id=model_id
             # )
-            self.save_playbook(thread_id=thread_id, playbook=pbook)
+            self.save_playbook(thread_id=thread_id, playbook=pbook, input_hash=inputs["input_hash"],
+                               sentiment_level=inputs["sentiment_level"])
         except Exception as e:
             print(f"Failed to exec gen_playbook(), with error: {e}")
             pbook = None
         
         return pbook
 
+
+    async def agen_playbook(self, thread_id: str, positive_content: bool=None) -> dict:
+        """
+        Async gen_playbook(): the assessment, and positive content when enabled by PLAYBOOK_POSITIVE_CONTENT=true, are
+        generated concurrently within PLAYBOOK_DEADLINE seconds (default 120), a cached playbook is returned as is.
+        Returns:
+            The playbook, with "positive_content" when generated, None if the assessment failed.
+        """
+        project_id = os.getenv("PROJECT_ID") or "realtime-reputation-defender"
+        location = os.getenv("MODEL_LOCATION") or "us-central1"
+        model_id = os.getenv("MODEL_ID") or "gemini-1.5-pro-002"
+        if positive_content is None:
+            positive_content = (os.getenv("PLAYBOOK_POSITIVE_CONTENT") or "false").lower() == "true"
+
+        try:
+            prompt, inputs = await asyncio.to_thread(self.assessment_inputs, thread_id)
+            pbook = await asyncio.to_thread(
+                self.cached_playbook, thread_id, inputs["input_hash"], inputs["sentiment_level"]
+            )
+            if pbook is not None:
+                return pbook
+            prompts = [prompt]
+            if positive_content:
+                prompt = await asyncio.to_thread(self.positive_content_prompt, thread_id)
+                if prompt is not None:
+                    prompts.append(prompt)
+            llm = await asyncio.to_thread(init_model, project_id=project_id, location=location, model_id=model_id)
+            if llm is None:
+                print(f"Failed to generate assessment, model {model_id} is not available")
+                return None
+            results = await call_llm_many(
+                llm, prompts, concurrency=len(prompts), deadline=float(os.getenv("PLAYBOOK_DEADLINE") or 120)
+            )
+            if not results[0].ok:
+                print(f"Failed to generate assessment, with error: {results[0].error}")
+                return None
+            pbook = ast.literal_eval(results[0].content)
+            await asyncio.to_thread(self.save_playbook, thread_id=thread_id, playbook=pbook,
+                                    input_hash=inputs["input_hash"], sentiment_level=inputs["sentiment_level"])
+            if len(results) > 1 and results[1].ok:
+                pbook["positive_content"] = results[1].content
+        except Exception as e:
+            print(f"Failed to exec agen_playbook(), with error: {e}")
+            pbook = None
+
+        return pbook
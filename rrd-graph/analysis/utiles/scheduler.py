@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import sqlalchemy
+
+
+class CoalescingScheduler():
+    """
+    Coalesce analysis runs per key (e.g. ("nlp", thread_id)): at most one run is in flight and one queued.
+    The request which starts a run executes it in its own thread, a trigger arriving meanwhile queues one more round
+    for that request to run next, further triggers are merged into the queued round and return immediately.
+    After max_rounds back-to-back rounds a still queued round is handed off to a new request, so no single request
+    runs unbounded.
+    Batch size of each round adapts to the backlog of the thread:
+        clamp(backlog / SCHEDULER_BACKLOG_DIVISOR, SCHEDULER_MIN_BATCH, SCHEDULER_MAX_BATCH)
+    Triggers land on any instance of the service, with lock_fn (e.g. AdvisoryRunLock.hold) the same holds across
+    instances: a run first takes the key's lock, and returns coalesced if a trigger of another instance is already
+    waiting for it.
+    """
+    def __init__(self, backlog_fn=None, min_batch: int=None, max_batch: int=None, backlog_divisor: int=None,
+                 max_rounds: int=None, lock_fn=None):
+        self.backlog_fn = backlog_fn
+        self.lock_fn = lock_fn
+        self.min_batch = min_batch or int(os.getenv("SCHEDULER_MIN_BATCH") or os.getenv("CLAIM_BATCH_SIZE") or 100)
+        self.max_batch = max_batch or int(os.getenv("SCHEDULER_MAX_BATCH") or 1000)
+        self.backlog_divisor = backlog_divisor or int(os.getenv("SCHEDULER_BACKLOG_DIVISOR") or 4)
+        self.max_rounds = max_rounds or int(os.getenv("SCHEDULER_MAX_ROUNDS") or 10)
+        self._lock = threading.Lock()
+        self._state = {}
+        self._counters = {"requested": 0, "started": 0, "queued": 0, "coalesced": 0, "rounds": 0, "handed_off": 0,
+                          "failed": 0, "coalesced_remote": 0, "lock_timeouts": 0}
+
+
+    def batch_size(self, thread_id) -> int:
+        backlog = self.backlog_fn(thread_id) if self.backlog_fn is not None else None
+        if backlog is None:
+            return self.min_batch
+        return max(self.min_batch, min(self.max_batch, backlog // self.backlog_divisor))
+
+
+    def run(self, key: tuple, thread_id, fn, handoff=None) -> str:
+        """
+        Run fn(batch_size) for the key, or coalesce into the run in flight.
+        Args:
+            handoff: Called to trigger a new request when rounds are still queued after max_rounds, or waiting for
+                the lock_fn of the key timed out.
+        Returns:
+            One of: done, queued, coalesced, handed_off.
+        """
+        with self._lock:
+            self._counters["requested"] += 1
+            st = self._state.setdefault(key, {"running": False, "queued": False, "rounds": 0, "batch_size": None,
+                                              "started_at": None})
+            if st["running"]:
+                if st["queued"]:
+                    self._counters["coalesced"] += 1
+                    return "coalesced"
+                st["queued"] = True
+                self._counters["queued"] += 1
+                return "queued"
+            st["running"] = True
+            st["started_at"] = time.time()
+            self._counters["started"] += 1
+
+        if self.lock_fn is None:
+            return self._run_rounds(st, thread_id, fn, handoff)
+        try:
+            with self.lock_fn(key) as acquired:
+                if acquired:
+                    return self._run_rounds(st, thread_id, fn, handoff)
+        except Exception:
+            with self._lock:
+                # Otherwise the rounds have failed, and already reset the key
+                if st["running"]:
+                    st["running"] = False
+                    st["queued"] = False
+                    self._counters["failed"] += 1
+            raise
+        # Triggers queued here meanwhile are covered by the other instance's run, or by the handoff
+        with self._lock:
+            st["running"] = False
+            st["queued"] = False
+            if acquired is None:
+                self._counters["lock_timeouts"] += 1
+                self._counters["handed_off"] += 1
+            else:
+                self._counters["coalesced_remote"] += 1
+        if acquired is not None:
+            return "coalesced"
+        if handoff is not None:
+            handoff()
+        return "handed_off"
+
+
+    def _run_rounds(self, st: dict, thread_id, fn, handoff) -> str:
+        rounds = 0
+        try:
+            while True:
+                batch_size = self.batch_size(thread_id)
+                with self._lock:
+                    st["batch_size"] = batch_size
+                fn(batch_size)
+                rounds += 1
+                with self._lock:
+                    self._counters["rounds"] += 1
+                    st["rounds"] += 1
+                    if not st["queued"]:
+                        st["running"] = False
+                        return "done"
+                    st["queued"] = False
+                    if rounds >= self.max_rounds:
+                        st["running"] = False
+                        self._counters["handed_off"] += 1
+                        break
+        except Exception:
+            with self._lock:
+                st["running"] = False
+                st["queued"] = False
+                self._counters["failed"] += 1
+            raise
+        if handoff is not None:
+            handoff()
+        return "handed_off"
+
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            Counters since start, and queue depth (in flight + queued runs) with last batch size per key.
+        """
+        with self._lock:
+            keys = {
+                "/".join(str(k) for k in key): {
+                    "depth": int(st["running"]) + int(st["queued"]),
+                    "rounds": st["rounds"],
+                    "batch_size": st["batch_size"],
+                    "started_at": st["started_at"],
+                }
+                for key, st in self._state.items()
+            }
+            return {
+                **self._counters,
+                "depth": sum(k["depth"] for k in keys.values()),
+                "keys": keys,
+            }
+
+
+class AdvisoryRunLock():
+    """
+    Per key lock of CoalescingScheduler across instances, with Postgres transaction-level advisory locks on a run
+    lock and a queue lock of the key, e.g. "rrd-scheduler:run:nlp/<thread_id>":
+        - A trigger which can't take the queue lock returns coalesced, another one is already queued.
+        - The holder of the queue lock waits up to SCHEDULER_LOCK_TIMEOUT seconds (default 240) for the run lock,
+          then releases the queue lock and runs while holding the run lock.
+    Locks are released with the transactions of their connections, also when the instance goes away.
+    """
+    def __init__(self, engine: sqlalchemy.engine.Engine, wait_timeout: float=None, prefix: str="rrd-scheduler"):
+        self.engine = engine
+        self.wait_timeout = wait_timeout or float(os.getenv("SCHEDULER_LOCK_TIMEOUT") or 240)
+        self.prefix = prefix
+
+
+    @contextmanager
+    def hold(self, key: tuple):
+        """
+        Yields:
+            True while the run lock is held, False if a trigger is already queued, None if waiting for the run lock
+            timed out. If the locks can't be taken for another reason it yields True, i.e. runs as if unlocked.
+        """
+        name = "/".join(str(k) for k in key)
+        stmt = "SELECT {}(hashtextextended(:key, 0))"
+        try:
+            qconn = self.engine.connect()
+            queued = qconn.execute(
+                sqlalchemy.text(stmt.format("pg_try_advisory_xact_lock")), {"key": f"{self.prefix}:queue:{name}"}
+            ).scalar()
+            rconn = self.engine.connect() if queued else None
+        except Exception as e:
+            print(f"Failed to lock {name}, run without lock, err: {e}")
+            yield True
+            return
+        with qconn:
+            if not queued:
+                yield False
+                return
+            with rconn:
+                try:
+                    rconn.execute(
+                        sqlalchemy.text("SELECT set_config('lock_timeout', :timeout, true)"),
+                        {"timeout": f"{int(self.wait_timeout * 1000)}ms"},
+                    )
+                    rconn.execute(
+                        sqlalchemy.text(stmt.format("pg_advisory_xact_lock")), {"key": f"{self.prefix}:run:{name}"}
+                    )
+                except Exception as e:
+                    print(f"Timed out waiting for the run of {name}, err: {e}")
+                    qconn.rollback()
+                    yield None
+                    return
+                # Release the queue lock, the next trigger may queue behind this run
+                qconn.rollback()
+                try:
+                    yield True
+                finally:
+                    rconn.rollback()
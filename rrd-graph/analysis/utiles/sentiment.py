@@ -1,13 +1,220 @@
 import os
+import re
 import json
+import math
 import time
 import requests
 import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, UTC
 
 from vertexai.preview.batch_prediction import BatchPredictionJob
-from google.cloud import storage
 
 from shared.db.sql_cn import SqlCN
+from . import storage
+
+
+def sentiment_record(row, score: float, magnitude: float) -> dict:
+    """
+    Build the sentiment record of a post, which is the line format of processed/*.jsonl read by post_analysis.
+    """
+    if score > 0:
+        label ="positive"
+    elif score == 0:
+        label = "neutral"
+    else:
+        label = "negative"
+    return {
+        "content_id": row.post_id,
+        "thread_id": row.thread_id,
+        "platform_id": row.platform_id,
+        "sentiment" : {
+            "score": score,
+            "magnitude": magnitude,
+            "label": label
+        }
+    }
+
+
+# Download chunk of analysis responses, GCS streams it with ranged reads
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+def parse_model_output(text: str) -> dict:
+    """
+    Parse the JSON object in the model's text, which is usually fenced in ```json ... ```.
+    """
+    return _decoder.raw_decode(text, text.index("{"))[0]
+
+
+def sentiment_row(st: dict) -> dict:
+    """
+    Convert a sentiment record into a row of Post.save_sentiment_results().
+    """
+    if st["content_id"].startswith("tw"):
+        platform_id = "twitter"
+    elif st["content_id"].startswith("gs"):
+        platform_id = "google-search"
+    elif st["content_id"].startswith("gn"):
+        platform_id = "google-news"
+    else:
+        platform_id = st["platform_id"]
+
+    return {
+        "post_id": st["content_id"],
+        "thread_id": st["thread_id"],
+        "platform_id": platform_id,
+        "sentiment_score": st["sentiment"]["score"],
+        "sentiment_magnitude": st["sentiment"]["magnitude"],
+        "sentiment_label": st["sentiment"]["label"],
+        "status": "sentimented",
+        "sentiment_at": datetime.now(UTC).isoformat(),
+    }
+
+
+class SentimentBackend(ABC):
+    """
+    A sentiment scorer for posts, implementations yield one sentiment_record() per scored post.
+    """
+    @abstractmethod
+    def score(self, rows, batch_id: str=None):
+        pass
+
+
+def sentiment_backend(name: str=None) -> SentimentBackend:
+    """
+    Returns:
+        The backend by name or SENTIMENT_BACKEND, one of: nlp (default, Cloud Natural Language API), lexicon (local).
+    """
+    name = name or os.getenv("SENTIMENT_BACKEND") or "nlp"
+    if name == "lexicon":
+        return LexiconBackend(lexicon_file=os.getenv("SENTIMENT_LEXICON"))
+    elif name == "nlp":
+        from .nlp_scoring import NlpScorer
+        return NlpScorer()
+    raise ValueError(f"Unknown sentiment backend: {name}")
+
+
+# Valence of common words in [-4, 4], the same scale as the VADER lexicon, which can be loaded instead with
+# LexiconBackend(lexicon_file=...).
+LEXICON = {
+    # positive
+    "good": 1.9, "great": 3.1, "excellent": 2.7, "amazing": 2.8, "awesome": 3.1, "fantastic": 2.6, "wonderful": 2.7,
+    "love": 3.2, "loved": 2.9, "loves": 2.7, "lovely": 2.8, "like": 1.5, "liked": 1.8, "likes": 1.8, "nice": 1.8,
+    "happy": 2.7, "glad": 2.0, "pleased": 1.9, "enjoy": 2.2, "enjoyed": 2.3, "best": 3.2, "better": 1.9,
+    "beautiful": 2.9, "perfect": 2.7, "brilliant": 2.8, "impressive": 2.3, "impressed": 2.1, "cool": 1.3,
+    "fun": 2.3, "favorite": 2.0, "recommend": 1.5, "recommended": 1.8, "worth": 0.9, "win": 2.8, "wins": 2.7,
+    "winning": 2.4, "success": 2.7, "successful": 2.8, "helpful": 1.8, "useful": 1.9, "easy": 1.9, "fast": 1.1,
+    "smooth": 1.3, "reliable": 1.9, "safe": 1.9, "thanks": 1.9, "thank": 1.5, "grateful": 2.0, "exciting": 2.2,
+    "excited": 1.4, "incredible": 2.4, "superb": 3.1, "solid": 0.6, "strong": 1.6, "improved": 2.1,
+    "improvement": 1.4, "upgrade": 1.0, "innovative": 1.6, "friendly": 2.2, "clean": 1.7, "comfortable": 1.5,
+    "satisfied": 1.8, "wow": 2.8, "yay": 2.4, "hope": 1.9, "positive": 2.3, "support": 1.7, "trust": 2.3,
+    "delighted": 3.1, "stunning": 2.7, "top": 0.8, "cheap": 0.3, "affordable": 1.4, "fixed": 1.2,
+    # negative
+    "bad": -2.5, "terrible": -2.1, "awful": -2.0, "horrible": -2.5, "worst": -3.1, "worse": -2.1, "poor": -2.1,
+    "hate": -2.7, "hated": -3.2, "hates": -1.9, "dislike": -1.6, "angry": -2.3, "annoying": -1.7,
+    "annoyed": -1.6, "sad": -2.1, "disappointed": -1.9, "disappointing": -2.2, "disappointment": -2.3,
+    "broken": -2.1, "broke": -1.8, "fail": -2.5, "failed": -2.3, "fails": -2.2, "failure": -2.3, "bug": -1.2,
+    "bugs": -1.2, "buggy": -1.6, "crash": -1.7, "crashes": -1.7, "slow": -1.0, "expensive": -0.9,
+    "overpriced": -1.8, "waste": -1.8, "useless": -1.8, "problem": -1.7, "problems": -1.7, "issue": -0.7,
+    "issues": -0.9, "wrong": -2.1, "sucks": -1.5, "suck": -1.9, "boring": -1.3, "ugly": -2.3, "scam": -2.6,
+    "fraud": -2.8, "dangerous": -2.1, "unsafe": -2.2, "risk": -1.1, "lost": -1.3, "lose": -1.7, "loss": -1.3,
+    "delay": -1.3, "delayed": -0.9, "cancel": -1.0, "cancelled": -1.0, "refund": -0.5, "complaint": -1.5,
+    "angrily": -2.0, "upset": -1.6, "unhappy": -1.8, "frustrated": -2.4, "frustrating": -1.9, "nightmare": -2.7,
+    "disaster": -3.1, "pathetic": -2.2, "ridiculous": -1.5, "outage": -1.5, "down": -0.4, "rude": -2.0,
+    "dirty": -1.9, "negative": -2.7, "concern": -1.4, "concerned": -1.4, "worried": -1.2, "fear": -2.2,
+    "lawsuit": -1.6, "recall": -0.9, "hack": -1.0, "hacked": -1.7, "leak": -1.4, "unfortunately": -1.6,
+}
+
+NEGATIONS = {"not", "no", "never", "none", "nobody", "nothing", "neither", "nor", "cannot", "without",
+             "dont", "don't", "doesnt", "doesn't", "didnt", "didn't", "isnt", "isn't", "wasnt", "wasn't",
+             "arent", "aren't", "wont", "won't", "cant", "can't", "couldnt", "couldn't", "shouldnt", "shouldn't"}
+
+BOOSTERS = {"very": 0.293, "really": 0.293, "extremely": 0.293, "so": 0.293, "super": 0.293, "totally": 0.293,
+            "absolutely": 0.293, "incredibly": 0.293, "quite": 0.1, "slightly": -0.293, "somewhat": -0.293,
+            "barely": -0.293, "kinda": -0.293}
+
+
+class LexiconBackend(SentimentBackend):
+    """
+    CPU-only scorer which sums word valences with negation and booster handling (a subset of VADER's rules),
+    fast enough to score posts in-process at tens of thousands per second:
+        score: sum / sqrt(sum^2 + 15), within [-1, 1]
+        magnitude: total absolute valence / 4, not bounded, like the magnitude of the Natural Language API
+    """
+    NEGATION_SCALAR = -0.74
+    NORMALIZE_ALPHA = 15
+    TOKEN_RE = re.compile(r"[a-z][a-z']*")
+
+    def __init__(self, lexicon: dict=None, lexicon_file: str=None):
+        self.lexicon = dict(lexicon or LEXICON)
+        if lexicon_file is not None:
+            self.lexicon.update(self.load_lexicon(lexicon_file))
+
+
+    def load_lexicon(self, lexicon_file: str) -> dict:
+        """
+        Read a tab separated lexicon file, one word and its valence per line, further columns are ignored
+        (e.g. vader_lexicon.txt).
+        """
+        lexicon = {}
+        with open(lexicon_file, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) < 2:
+                    continue
+                try:
+                    lexicon[parts[0].lower()] = float(parts[1])
+                except ValueError:
+                    continue
+        return lexicon
+
+
+    def score_text(self, text: str) -> tuple:
+        lexicon = self.lexicon
+        total = 0.0
+        magnitude = 0.0
+        negate_until = -1
+        boost = 0.0
+        for i, token in enumerate(self.TOKEN_RE.findall(text.lower())):
+            if token in NEGATIONS:
+                negate_until = i + 3
+                continue
+            b = BOOSTERS.get(token)
+            if b is not None:
+                boost += b
+                continue
+            v = lexicon.get(token)
+            if v is None:
+                boost = 0.0
+                continue
+            if boost != 0.0:
+                v += boost if v > 0 else -boost
+                boost = 0.0
+            if i <= negate_until:
+                v *= self.NEGATION_SCALAR
+            total += v
+            magnitude += abs(v)
+        score = total / math.sqrt(total*total + self.NORMALIZE_ALPHA)
+        return round(score, 3), round(magnitude / 4, 3)
+
+
+    def score_texts(self, texts: list) -> list[tuple]:
+        """
+        Returns:
+            (score, magnitude) of each text.
+        """
+        score_text = self.score_text
+        return [score_text(t or "") for t in texts]
+
+
+    def score(self, rows, batch_id: str=None):
+        rows = list(rows)
+        for row, (score, magnitude) in zip(rows, self.score_texts([row.content for row in rows])):
+            yield sentiment_record(row, score, magnitude)
+
 
 class Sentiment():
     def __init__(self, sqlcn: SqlCN):
@@ -20,20 +227,31 @@ class Sentiment():
         Upload a file to the given Google Cloud Storage bucket.
         """
 
-        client = storage.Client()
-        bucket = client.bucket(gcs_bucket)
-        blob = bucket.blob(blob_name)
+        blob = storage.bucket(gcs_bucket).blob(blob_name)
         blob.upload_from_filename(f"/tmp/{file}")
         
         return blob.name
 
 
-    def retrieve_unprocessed_posts(self, thread_id):
+    def open_blob_writer(self, blob_name, gcs_bucket):
+        """
+        Open a text writer to the given blob, data is uploaded in chunks while writing and the blob is
+        finalized on close.
+        """
+
+        blob = storage.bucket(gcs_bucket).blob(blob_name)
+        return blob.open("w")
+
+
+    def retrieve_unprocessed_posts(self, thread_id, batch_size=None):
         batch_id = f"bt-{uuid.uuid4()}"    
-        return {"batch_id": batch_id, "data": self.sqlcn.posts.latest_100_posts(thread_id)}
+        batch_size = batch_size or int(os.getenv("CLAIM_BATCH_SIZE") or 100)
+        # Visibility timeout is CLAIM_VISIBILITY_TIMEOUT as read by Post, the same as pending_count() of the scheduler
+        posts = self.sqlcn.posts.claim_pending_posts(thread_id, batch_size=batch_size)
+        return {"batch_id": batch_id, "data": posts}
 
 
-    def propagate_prompt_gcs(self, project_id, location, thread_id, analysis_gcs_bucket, input_file):
+    def propagate_prompt_gcs(self, project_id, location, thread_id, analysis_gcs_bucket, input_file, batch_size=None):
         """
         Propagate the prompt to GCS for batch prediction.
         """
@@ -46,7 +264,7 @@ class Sentiment():
             input_file: {input_file}
         """)
 
-        results = self.retrieve_unprocessed_posts(thread_id)
+        results = self.retrieve_unprocessed_posts(thread_id, batch_size=batch_size)
         if results is not None and len(results.get("data"))>0:
             rows = results.get("data")
             analysis_file = input_file
@@ -173,47 +391,64 @@ class Sentiment():
         """
         Read the analysis response from GCS.
         """
+        return list(self.iter_analysis_response(gcs_bucket, blob_name, nlp=nlp))
+
+
+    def iter_analysis_response(self, gcs_bucket, blob_name, nlp=None, chunk_size=READ_CHUNK_SIZE):
+        """
+        Stream the analysis response from GCS, the blob is downloaded in chunks and each line is parsed as it
+        arrives, so memory doesn't grow with the size of the blob.
+        Returns:
+            Iterator of sentiment records, lines which can't be parsed are logged and skipped.
+        """
 
-        client = storage.Client()
-        bucket = client.bucket(gcs_bucket)
-        blob = bucket.blob(blob_name)
+        blob = storage.bucket(gcs_bucket).blob(blob_name)
         print(f"nlp={nlp}")
-        # Iterate over the lines in the stream
-        with blob.open("r") as stream:
-            outputs=[]
-            for line in stream:
-                # Process each line here
-                if len(line) == 0:
+        with blob.open("rb", chunk_size=chunk_size) as stream:
+            for n, line in enumerate(stream):
+                if len(line.strip()) == 0:
                     continue
-                else:
+                try:
                     jdata = json.loads(line)
-                    if nlp is None:
-                        if jdata.get("response"):
-                            x = jdata["response"]["candidates"][0]["content"]["parts"][0]["text"]
-                            # print(x)
-                            output = json.loads(x.split("\n```")[0].replace("```json\n", ""))
-                            outputs.append(output)
-                    else:
-                        outputs.append(jdata)
+                    if nlp is not None:
+                        yield jdata
+                    elif jdata.get("response"):
+                        yield parse_model_output(jdata["response"]["candidates"][0]["content"]["parts"][0]["text"])
+                except Exception as e:
+                    print(f"Skipped line {n} of {blob_name}, err: {e}")
+
 
-            stream.close()
-            return outputs
-        return None
+    def iter_sentiment_batches(self, gcs_bucket, blob_name, nlp=None, batch_size=None):
+        """
+        Stream the analysis response as micro-batches of rows for Post.save_sentiment_results().
+        Args:
+            batch_size: Rows per batch, default SENTIMENT_WRITE_BATCH or 1000.
+        """
+        batch_size = batch_size or int(os.getenv("SENTIMENT_WRITE_BATCH") or 1000)
+        batch = []
+        for st in self.iter_analysis_response(gcs_bucket, blob_name, nlp=nlp):
+            try:
+                batch.append(sentiment_row(st))
+            except Exception as e:
+                print(e)
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
 
 
     def is_marked_blob(self, blob_name:str) -> bool:
-        try:
-            r = self.sqlcn.marked_blobs.marked_blob_by_name(blob_name)
-            if r is not None:
-                print(f"Duplicated event has been delivered before, blob: {blob_name}")
-                return True
-            else:
-                self.sqlcn.marked_blobs.create_marked_blob({"blob_name": blob_name})
-                print(f"Marked blob: {blob_name} is processing.")
-                return False
-        except Exception as e:
-            print(f"Failed to mark repeated blob name, err: {e}")
+        claimed = self.sqlcn.marked_blobs.claim_blob(blob_name)
+        if claimed is None:
+            print(f"Failed to mark repeated blob name: {blob_name}")
             return False
+        elif not claimed:
+            print(f"Duplicated event has been delivered before, blob: {blob_name}")
+            return True
+        print(f"Marked blob: {blob_name} is processing.")
+        return False
 
 
     def http_post(self, url, data):
@@ -222,3 +457,38 @@ class Sentiment():
         except Exception as e:
             print(f"Failed to post /playbook, with error: {e}")
 
+
+
+def bench_iter_sentiment_batches(lines=1_000_000, batch_size=1000, local_dir="/tmp/rrd-blobs"):
+    """
+    Stream a generated Vertex batch prediction output through iter_sentiment_batches() from a local file-backed blob,
+    prints time to first batch, throughput and peak RSS.
+    """
+    import resource
+
+    os.environ["LOCAL_BLOB_DIR"] = local_dir
+    # One blob per size, so a blob generated by an earlier run with other lines isn't benchmarked instead
+    blob = storage.bucket("bench").blob(f"processed/bench/predictions-{lines}.jsonl")
+    if not blob.exists():
+        with blob.open("w") as f:
+            for i in range(lines):
+                text = "```json\n" + json.dumps({
+                    "content_id": f"tw{i}", "thread_id": "1", "platform_id": "twitter",
+                    "sentiment": {"score": 0.4, "magnitude": 0.3, "label": "positive"},
+                }) + "\n```"
+                f.write(json.dumps({"response": {"candidates": [{"content": {"parts": [{"text": text}]}}]}}) + "\r\n")
+
+    started = time.perf_counter()
+    first_batch_at = None
+    n = 0
+    for batch in Sentiment(None).iter_sentiment_batches("bench", blob.name, batch_size=batch_size):
+        if first_batch_at is None:
+            first_batch_at = time.perf_counter() - started
+        n += len(batch)
+    elapsed = time.perf_counter() - started
+    print(f"{n} rows in {elapsed:.2f}s ({n / elapsed:.0f} rows/s), first batch after {first_batch_at * 1000:.1f}ms, "
+          f"max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB")
+
+
+if __name__ == "__main__":
+    bench_iter_sentiment_batches(lines=int(os.getenv("BENCH_LINES") or 1_000_000))
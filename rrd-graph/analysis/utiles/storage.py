@@ -0,0 +1,153 @@
+import os
+import json
+import threading
+
+from google.api_core import exceptions as gexc
+from google.cloud import storage
+
+
+_client = None
+_client_lock = threading.Lock()
+
+# Directory of LocalBucket for custom metadata of its blobs
+LOCAL_METADATA_DIR = ".metadata"
+
+
+def gcs_client() -> storage.Client:
+    """
+    Process-wide storage client, it's thread-safe and keeps its HTTP session across calls.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = storage.Client()
+        return _client
+
+
+class LocalBlob():
+    """
+    File-backed stand-in for storage.Blob, for local runs and benchmarks.
+    """
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        # Custom metadata is kept in a JSON file under <root>/.metadata/
+        self.metadata_path = os.path.join(bucket.root, LOCAL_METADATA_DIR, f"{name}.json")
+        self.generation = None
+        self.metadata = None
+
+
+    def reload(self, **kwargs):
+        """
+        Load generation, the file's mtime in nanoseconds, and custom metadata.
+        """
+        self.generation = os.stat(self.path).st_mtime_ns
+        self.metadata = None
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, encoding="utf-8") as f:
+                self.metadata = json.load(f)
+
+
+    def open(self, mode: str="r", chunk_size: int=None, **kwargs):
+        if "w" in mode or "a" in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if "b" in mode:
+            return open(self.path, mode, buffering=chunk_size or -1)
+        return open(self.path, mode, encoding="utf-8", buffering=chunk_size or -1)
+
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+
+    def upload_from_string(self, data, **kwargs):
+        with self.open("wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        with open(filename, "rb") as src, self.open("wb") as f:
+            f.write(src.read())
+
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        with self.open("rb") as f:
+            return f.read()
+
+
+    def delete(self, **kwargs):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise gexc.NotFound(f"No such object: {self.name}")
+        if os.path.exists(self.metadata_path):
+            os.remove(self.metadata_path)
+
+
+    def compose(self, sources: list, if_generation_match: int=None, **kwargs):
+        """
+        Concatenate sources into this blob and set its metadata. Like GCS, if_generation_match is the generation
+        the blob must have, 0 when it must not exist, otherwise PreconditionFailed is raised.
+        """
+        with self.bucket.lock:
+            if if_generation_match is not None:
+                generation = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else 0
+                if generation != if_generation_match:
+                    raise gexc.PreconditionFailed(f"Generation of {self.name} is {generation}")
+            tmp_path = f"{self.path}.compose"
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                for src in sources:
+                    f.write(src.download_as_bytes())
+            os.replace(tmp_path, self.path)
+            if self.metadata is not None:
+                os.makedirs(os.path.dirname(self.metadata_path), exist_ok=True)
+                with open(self.metadata_path, "w", encoding="utf-8") as f:
+                    json.dump(self.metadata, f)
+            self.generation = os.stat(self.path).st_mtime_ns
+
+
+class LocalBucket():
+    """
+    File-backed stand-in for storage.Bucket, blobs are files under root.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.name = os.path.basename(root.rstrip("/"))
+        # Serializes conditional composes of this process, see LocalBlob.compose()
+        self.lock = threading.Lock()
+
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+
+    def get_blob(self, name: str) -> LocalBlob:
+        blob = LocalBlob(self, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+
+    def list_blobs(self, prefix: str=""):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and LOCAL_METADATA_DIR in dirnames:
+                dirnames.remove(LOCAL_METADATA_DIR)
+            dirnames.sort()
+            for filename in sorted(filenames):
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if name.startswith(prefix):
+                    yield LocalBlob(self, name)
+
+
+def bucket(gcs_bucket: str):
+    """
+    Returns:
+        The GCS bucket, or a LocalBucket under LOCAL_BLOB_DIR/<gcs_bucket> when LOCAL_BLOB_DIR is set.
+    """
+    local_dir = os.getenv("LOCAL_BLOB_DIR")
+    if local_dir is not None:
+        return LocalBucket(os.path.join(local_dir, gcs_bucket))
+    return gcs_client().bucket(gcs_bucket)
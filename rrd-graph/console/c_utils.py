@@ -5,12 +5,14 @@ from dotenv import load_dotenv
 import pandas as pd
 from shared.db.sql_cn import SqlCN
 from shared.llm import init_model, call_llm
+from shared.prompt_builder import PromptBuilder
 
 # All envariables
 load_dotenv()
 
 # Db
 sqlcn = SqlCN()
+prompt_builder = PromptBuilder()
 
 def semtiment_score_by(thread_id:str, platform_id:str, start:str, end:str):
     posts = sqlcn.posts.semtiment_score_by(thread_id, platform_id, start, end)
@@ -95,16 +97,16 @@ def sentiment_distribution_by(thread_id, platform_id, start, end):
         return pd.DataFrame()
 
 def x_posts(thread_id: str):
-    posts = sqlcn.posts.recent_top100_worst_posts(thread_id)
+    posts = sqlcn.posts.sentiment_snapshot(thread_id).get("negative")
     print (f"posts: {len(posts)}")
     pt_data = []
     for row in posts:
         pt_data.append({
-            "post_id": row.post_id,
-            "thread_id": row.thread_id,
-            "platform_id": row.platform_id,
-            "content": row.content,
-            "scraped_at": row.scraped_at
+            "post_id": row["post_id"],
+            "thread_id": row["thread_id"],
+            "platform_id": row["platform_id"],
+            "content": row["content"],
+            "scraped_at": row["scraped_at"]
         })
     return pd.DataFrame(
                 data=pt_data,
@@ -266,72 +268,15 @@ def call_llm_sdk(prompt):
 
 
 def promot_template_4_playbook(thread_id):
-    # Top 100 Negative content
-    negative_content = sqlcn.posts.recent_top100_worst_posts(thread_id)
-    # Top 10 positive content
-    positive_content = sqlcn.posts.recent_top100_best_posts(thread_id)
-    # Top 10 Neutral content
-    neutral_content = sqlcn.posts.recent_top100_neutral_posts(thread_id)
-    # Sentiment distribution as count
-    s_distribution = sqlcn.posts.sentiment_distribution_by_score(thread_id)
+    # Top 100 negative, positive, neutral content and sentiment distribution as count, in one query
+    snapshot = sqlcn.posts.sentiment_snapshot(thread_id)
     # Last sentiment level
     sentiment_level=sqlcn.sentiment_summaries.last_overall_sentiment_level(thread_id)
     # Query thread detail from threads
     thread = sqlcn.threads.thread_by_id(thread_id)
 
-    json_format = {
-            "report_name": "Give a creative name for this reputation report within five words.",
-            "summary": "Key findings and data points summarized, including reputational strengths and weaknesses.",
-            "severity_assessment": "Evaluation of the potential impact on brand reputation.",
-            "incident_categorization": {
-                "category": "Category of the incident (e.g., unmet expectations, product failure, etc.)",
-                "explanation": "Explanation for the chosen category"
-            },
-            "recommendations": {
-                "response_strategy": "Comprehensive communication plan to address concerns and manage public perception.",
-                "performance_monitoring": "Methods for tracking the effectiveness of the response strategy.",
-                "post_incident_analysis": "Process for reviewing the incident and improving future strategies.",
-                "reputation_building": "Proactive measures to strengthen online reputation."
-            }
-        }
-    prompt = f"""
-        You are a public relations expert with extensive experience in mitigating reputation incidents and in-depth knowledge of organizational strategies. Your task is to analyze the provided context and analytic data to generate a comprehensive reputation report in JSON format.
-
-        ## Context
-        {thread.get("context")}
-
-        ## Analytic Data
-
-        **The sentiment results are based on contet collected from media platforms: {thread.get("platform_ids")}.** 
-
-        Positive  records: {s_distribution.get("positive")}
-        Negative records:  {s_distribution.get("negative")}
-        Neutral records: {s_distribution.get("neutral")} 
-
-        ** Sentiment level (sentiment_level = (0.7 * sentiment_score) + (0.3 * sentiment_magnitude)) is formulated by last two hours sentiment records and the value is between 1 and 100 after normalization. ** 
-
-        Sentiment level:  {sentiment_level}
-
-        **Top 100 positive records**
-
-        {positive_content}
-
-        **Top 100 neutral records**
-
-        {negative_content}
-        
-        **Top 100 negative records**
-
-        {neutral_content}
-
-        ## Instructions
-
-        Based on the provided context and analytic data, create a reputation report following this structure:
-
-        {json_format}
-
-        Ensure your report adheres strictly to the JSON structure above.  Use the provided context and analytic data to populate each section of the JSON object with relevant information.
-    """
+    # Top posts are projected, deduplicated and ranked into PROMPT_TOKEN_BUDGET
+    prompt, _ = prompt_builder.assessment_prompt(thread, snapshot, sentiment_level)
     return prompt
 
 
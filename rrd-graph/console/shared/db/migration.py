@@ -0,0 +1,310 @@
+import os
+import json
+import sqlalchemy
+
+from .tb_sentiment_rollup import SentimentRollup
+
+
+# Tables added after the initial schema in deploy/sql/ct.sql, created before the indexes.
+TABLES = {
+    # tb_sentiment_rollup.py, backfilled from posts when it's created
+    "sentiment_rollup": """
+        CREATE TABLE IF NOT EXISTS sentiment_rollup (
+            thread_id bigint NOT NULL,
+            platform_id text NOT NULL,
+            bucket_at timestamptz NOT NULL,
+            level_sum numeric NOT NULL,
+            post_count bigint NOT NULL,
+            PRIMARY KEY (thread_id, platform_id, bucket_at)
+        )
+    """,
+    # tb_page_extract.py, extraction cache of scraped pages
+    "page_extracts": """
+        CREATE TABLE IF NOT EXISTS page_extracts (
+            url_hash text PRIMARY KEY,
+            url text NOT NULL,
+            validator text,
+            simhash bigint,
+            canonical_hash text,
+            content text,
+            extracted_at timestamptz NOT NULL
+        )
+    """,
+}
+
+
+# Columns added to tables of the initial schema, as "<table>.<column>"
+COLUMNS = {
+    # tb_playbook.py, inputs and sentiment level of a playbook to reuse it, see PlaybookTools.cached_playbook()
+    "playbooks.input_hash": "ALTER TABLE playbooks ADD COLUMN IF NOT EXISTS input_hash text",
+    "playbooks.sentiment_level": "ALTER TABLE playbooks ADD COLUMN IF NOT EXISTS sentiment_level double precision",
+    # tb_jobs.py, high-water mark of incremental scraping, see Job.save_cursor()
+    "jobs.scrape_cursor": "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS scrape_cursor jsonb",
+}
+
+
+# Indexes for the hot queries in tb_posts.py, tb_sentiment_summary.py and tb_playbook.py, created with
+# CONCURRENTLY so they can be applied to a live database without blocking writes.
+INDEXES = {
+    # claim_pending_posts(): thread_id + status='pending'/'processing', newest first
+    "posts_thread_status_created_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS posts_thread_status_created_idx
+            ON posts (thread_id, status, created_at DESC)
+    """,
+    # recent_top100_*_posts(), sentiment_distribution_*(): analysed posts of a thread, newest first
+    "posts_thread_created_analysed_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS posts_thread_created_analysed_idx
+            ON posts (thread_id, created_at DESC, sentiment_score)
+            WHERE status IN ('sentimented', 'generated')
+    """,
+    # calculate_sentiment_level(), semtiment_score_by(): analysed posts of a thread/platform by sentiment_at window
+    "posts_thread_platform_sentiment_at_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS posts_thread_platform_sentiment_at_idx
+            ON posts (thread_id, platform_id, sentiment_at)
+            WHERE status IN ('sentimented', 'generated')
+    """,
+    # last_*sentiment_level(), sentiment_level_by_timestamp()
+    "sentiment_summary_thread_platform_created_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS sentiment_summary_thread_platform_created_idx
+            ON sentiment_summary (thread_id, platform_id, created_at)
+    """,
+    # max(created_at) from sentiment_summary
+    "sentiment_summary_created_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS sentiment_summary_created_idx
+            ON sentiment_summary (created_at)
+    """,
+    # last_playbook()
+    "playbooks_thread_created_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS playbooks_thread_created_idx
+            ON playbooks (thread_id, created_at DESC)
+    """,
+    # MarkedBlob.cleanup_marks()
+    "marked_blob_created_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS marked_blob_created_idx
+            ON marked_blob (created_at)
+    """,
+    # PageExtract.recent_simhashes()
+    "page_extracts_extracted_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS page_extracts_extracted_idx
+            ON page_extracts (extracted_at DESC) WHERE canonical_hash IS NULL
+    """,
+    # the_job(), jobs_by_thread_id()
+    "jobs_thread_platform_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS jobs_thread_platform_idx
+            ON jobs (thread_id, platform_id)
+    """,
+}
+
+
+# Representative shapes of the hot queries, which have to stay index scans as posts grows, and the indexes of
+# INDEXES (or primary keys) their plans must use, a tuple is a choice of indexes which serve the query equally.
+EXPLAIN_QUERIES = {
+    "claim_pending_posts": {
+        "query": """
+            SELECT post_id FROM posts
+            WHERE thread_id = 1 AND (
+                status = 'pending' OR (status = 'processing' AND updated_at < now() - INTERVAL '600 seconds')
+            )
+            ORDER BY created_at DESC LIMIT 100
+            FOR UPDATE SKIP LOCKED
+        """,
+        "indexes": ["posts_thread_status_created_idx"],
+    },
+    "recent_top100_worst_posts": {
+        "query": """
+            SELECT * FROM posts
+            WHERE thread_id = 1 AND (status = 'sentimented' OR status = 'generated') AND sentiment_score < 0
+            ORDER BY created_at DESC, sentiment_score DESC LIMIT 100
+        """,
+        "indexes": ["posts_thread_created_analysed_idx"],
+    },
+    "sentiment_distribution_by_score": {
+        "query": """
+            SELECT thread_id, COUNT(CASE WHEN sentiment_score > 0 THEN 1 END) AS positive
+            FROM posts
+            WHERE thread_id = 1 AND status IN ('sentimented', 'generated')
+            GROUP BY thread_id
+        """,
+        "indexes": [("posts_thread_created_analysed_idx", "posts_thread_platform_sentiment_at_idx")],
+    },
+    "calculate_sentiment_level": {
+        "query": """
+            SELECT SUM((((0.7*sentiment_score + 0.3*sentiment_magnitude)+1)/2)*100)/COUNT(*) AS sentiment_level
+            FROM posts
+            WHERE thread_id = 1 AND platform_id = 'twitter' AND status IN ('sentimented', 'generated')
+                AND sentiment_at >= (
+                    SELECT MAX(sentiment_at) FROM posts
+                    WHERE thread_id = 1 AND platform_id = 'twitter' AND status IN ('sentimented', 'generated')
+                ) - INTERVAL '1 HOUR'
+        """,
+        "indexes": ["posts_thread_platform_sentiment_at_idx"],
+    },
+    "semtiment_score_by": {
+        "query": """
+            SELECT * FROM posts
+            WHERE thread_id = 1 AND platform_id = 'twitter' AND (status = 'sentimented' OR status = 'generated')
+                AND sentiment_at > now() - INTERVAL '1 day' AND sentiment_at < now()
+            ORDER BY created_at
+        """,
+        "indexes": ["posts_thread_platform_sentiment_at_idx"],
+    },
+    "last_sentiment_level": {
+        "query": """
+            SELECT AVG(sentiment_level) AS sentiment_level FROM sentiment_summary
+            WHERE thread_id = 1 AND platform_id = 'twitter'
+                AND created_at >= (SELECT max(created_at) FROM sentiment_summary) - INTERVAL '1 hour'
+        """,
+        "indexes": ["sentiment_summary_thread_platform_created_idx", "sentiment_summary_created_idx"],
+    },
+    "calculate_sentiment_level_rollup": {
+        "query": """
+            SELECT SUM(level_sum), SUM(post_count) FROM sentiment_rollup
+            WHERE thread_id = 1 AND platform_id = 'twitter' AND bucket_at >= now() - INTERVAL '1 hour'
+        """,
+        "indexes": ["sentiment_rollup_pkey"],
+    },
+    "last_playbook": {
+        "query": """
+            SELECT * FROM playbooks WHERE thread_id = 1 ORDER BY created_at DESC LIMIT 1
+        """,
+        "indexes": ["playbooks_thread_created_idx"],
+    },
+}
+
+
+class Migration():
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        self.engine = engine
+
+
+    def upgrade(self) -> list[str]:
+        """
+        Create all missing tables, columns and indexes, an invalid index left by a failed concurrent build is dropped
+        and rebuilt.
+        Returns:
+            Names of tables, columns and indexes have been created.
+        """
+        status = self.verify()
+        created = []
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for name, ddl in TABLES.items():
+                if status.get(name) == "valid":
+                    continue
+                print(ddl)
+                conn.exec_driver_sql(ddl)
+                created.append(name)
+                if name == "sentiment_rollup":
+                    print(f"Backfilled {SentimentRollup(self.engine).rebuild()} rollup buckets")
+            for name, ddl in COLUMNS.items():
+                if status.get(name) == "valid":
+                    continue
+                print(ddl)
+                conn.exec_driver_sql(ddl)
+                created.append(name)
+            for name, ddl in INDEXES.items():
+                if status.get(name) == "valid":
+                    continue
+                if status.get(name) == "invalid":
+                    print(f"Drop invalid index {name}")
+                    conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                print(ddl)
+                conn.exec_driver_sql(ddl)
+                created.append(name)
+        return created
+
+
+    def downgrade(self) -> list[str]:
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for name in INDEXES:
+                conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            for name in COLUMNS:
+                table, column = name.split(".")
+                conn.exec_driver_sql(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {column}")
+            for name in TABLES:
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {name}")
+        return list(INDEXES) + list(COLUMNS) + list(TABLES)
+
+
+    def verify(self) -> dict:
+        """
+        Returns:
+            Status of each table, column and index, which is one of: valid, invalid, missing.
+        """
+        stmt = sqlalchemy.text("""
+            SELECT c.relname AS name, COALESCE(i.indisvalid, TRUE) AS valid
+            FROM pg_class c LEFT JOIN pg_index i ON c.oid = i.indexrelid
+            WHERE c.relname = ANY(:names) AND c.relkind IN ('r', 'i')
+                AND c.relnamespace = current_schema()::regnamespace
+        """)
+        columns_stmt = sqlalchemy.text("""
+            SELECT table_name || '.' || column_name AS name
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name || '.' || column_name = ANY(:names)
+        """)
+        names = list(TABLES) + list(INDEXES)
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt, {"names": names}).fetchall()
+            columns = conn.execute(columns_stmt, {"names": list(COLUMNS)}).fetchall()
+        found = {r.name: "valid" if r.valid else "invalid" for r in rows}
+        found.update({r.name: "valid" for r in columns})
+        return {name: found.get(name, "missing") for name in names + list(COLUMNS)}
+
+
+    def explain_check(self) -> dict:
+        """
+        EXPLAIN each hot query with sequential scans disabled and report the scan nodes of its plan.
+        A query is ok when no table is read by Seq Scan and its plan uses all of its expected indexes, so the
+        indexes of this migration are what serve it however big the tables grow. Small tables will still be planned
+        as Seq Scan when enable_seqscan is on.
+        Returns:
+            {name: {"ok", "scans": [(node type, table, index)], "missing": expected indexes the plan doesn't use}}
+        """
+        results = {}
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            for name, q in EXPLAIN_QUERIES.items():
+                plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {q['query']}").scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                scans = self._scan_nodes(plan[0]["Plan"])
+                used = {index for _, _, index in scans}
+                missing = [
+                    index for index in q["indexes"]
+                    if used.isdisjoint(index if isinstance(index, tuple) else (index,))
+                ]
+                results[name] = {
+                    "ok": len(missing) == 0 and all(node_type != "Seq Scan" for node_type, _, _ in scans),
+                    "scans": scans,
+                    "missing": missing,
+                }
+            conn.rollback()
+        return results
+
+
+    def _scan_nodes(self, node: dict) -> list[tuple]:
+        # A Bitmap Index Scan names its index but not its table, which is on the Bitmap Heap Scan above it
+        scans = []
+        if "Relation Name" in node or "Index Name" in node:
+            scans.append((node["Node Type"], node.get("Relation Name"), node.get("Index Name")))
+        for child in node.get("Plans", []):
+            scans.extend(self._scan_nodes(child))
+        return scans
+
+
+if __name__ == "__main__":
+    db_url = os.getenv("DB_URL")
+    if db_url is not None:
+        engine = sqlalchemy.create_engine(db_url)
+    else:
+        from .sql_cn import SqlCN
+        engine = SqlCN().engine
+    mg = Migration(engine)
+    print(f"created: {mg.upgrade()}")
+    print(f"verified: {mg.verify()}")
+    failed = []
+    for name, r in mg.explain_check().items():
+        print(f"{name}: {'ok' if r['ok'] else 'NOT SERVED BY ' + str(r['missing'] or 'INDEX')} {r['scans']}")
+        if not r["ok"]:
+            failed.append(name)
+    if len(failed) > 0:
+        raise SystemExit(f"Queries not served by index: {failed}")
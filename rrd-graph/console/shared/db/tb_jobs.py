@@ -2,7 +2,9 @@ import pg8000
 import sqlalchemy
 from sqlalchemy import insert, select, update, and_, or_
 import datetime
-from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP, ForeignKey, JSON
+from .columns import AddedColumns
+from .instrument import echo
 
 
 
@@ -37,8 +39,13 @@ class Job():
             Column("updated_at", TIMESTAMP, comment="""
                 Updated time of the job
             """),
+            Column("scrape_cursor", JSON, comment="""
+                High-water mark to resume the next run from, e.g. since_id/next_token of Twitter or seen URL hashes.
+            """),
             comment="""The table for Job related information and current status.""",
         )
+        # Added by migration.py, NULL until then
+        self.added_columns = AddedColumns(self.engine, self.table, ["scrape_cursor"])
 
     # def __del__(self):
     #     print("__del__")
@@ -49,7 +56,7 @@ class Job():
 
     def the_job(self, thread_id:str, platform_id:str)->dict:
         stmt = (
-            select(self.table)
+            select(*self.added_columns.columns())
                 .where(
                     and_(
                         self.table.c.thread_id == int(thread_id),
@@ -57,26 +64,26 @@ class Job():
                     )
                 )
         )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt).fetchone()
-                print(r._asdict())
+                echo(r._asdict())
                 return r._asdict()
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return None
 
     def jobs_by_thread_id(self, thread_id:str)->list[dict]:
         stmt = (
-            select(self.table)
+            select(*self.added_columns.columns())
                 .where(self.table.c.thread_id == int(thread_id))
         )
-        print(stmt)
+        echo(stmt)
         jobs = []
         try:
             with self.engine.connect() as conn:
@@ -86,7 +93,7 @@ class Job():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return jobs
@@ -95,9 +102,9 @@ class Job():
         if bool(job):
             job["created_at"] = datetime.datetime.now(datetime.UTC).isoformat()
             stmt = (
-                insert(self.table).values(job)
+                insert(self.table).values(self.added_columns.values(job))
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -107,13 +114,38 @@ class Job():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
         else:
             return None
-    
+
+    def save_cursor(self, job_id:str, scrape_cursor:dict)->bool:
+        """
+        Persist the high-water mark of a run, the next run of the job resumes from it.
+        """
+        if "scrape_cursor" in self.added_columns.missing():
+            return False
+        stmt = (
+            update(self.table)
+                .where(self.table.c.job_id == job_id)
+                .values(scrape_cursor=scrape_cursor, updated_at=datetime.datetime.now(datetime.UTC))
+        )
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                r = conn.execute(stmt)
+                conn.commit()
+            return r.rowcount > 0
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+
+        return False
 
         
     
@@ -6,11 +6,16 @@ from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMEST
 from decimal import Decimal
 import pytz
 
+from .tb_sentiment_rollup import BUCKET_SECONDS, LEVEL_SQL
+from .instrument import echo
+
 
 
 class SentimentSummary():
-    def __init__(self, engine: sqlalchemy.engine.Engine, table_name="sentiment_summary"):
+    def __init__(self, engine: sqlalchemy.engine.Engine, table_name="sentiment_summary", rollup=None):
         self.engine = engine
+        # Optional SentimentRollup, calculate_sentiment_level() reads it instead of rescanning posts
+        self.rollup = rollup
         self.table = Table(
             table_name,
             sqlalchemy.MetaData(),
@@ -58,7 +63,7 @@ class SentimentSummary():
             stmt = (
                 insert(self.table).values(ss)
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -68,7 +73,7 @@ class SentimentSummary():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
@@ -86,7 +91,7 @@ class SentimentSummary():
                 thread_id = {thread_id}
                 and created_at >= (select max(created_at) from sentiment_summary) - INTERVAL '1 hour'
         """
-        print(stmt)
+        echo(stmt)
         sentiment_level=None
         try:
             with self.engine.connect() as conn:
@@ -95,7 +100,7 @@ class SentimentSummary():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return sentiment_level
@@ -111,7 +116,7 @@ class SentimentSummary():
                 and platform_id = '{platform_id}'
                 and created_at >= (select max(created_at) from sentiment_summary) - INTERVAL '1 hour'
         """
-        print(stmt)
+        echo(stmt)
         sentiment_level=None
         try:
             with self.engine.connect() as conn:
@@ -120,7 +125,7 @@ class SentimentSummary():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return sentiment_level
@@ -138,7 +143,7 @@ class SentimentSummary():
                 and created_at >= (select max(created_at) from sentiment_summary) - INTERVAL '1 hour'
             group by platform_id
         """
-        print(stmt)
+        echo(stmt)
         ssp = []
         try:
             with self.engine.connect() as conn:
@@ -148,7 +153,7 @@ class SentimentSummary():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return ssp
@@ -156,10 +161,91 @@ class SentimentSummary():
 
 
     def calculate_sentiment_level(self, thread_id: str, platform_id: str) -> tuple[Decimal, bool]:
+        if self.rollup is None or not self.rollup.available():
+            return self.calculate_sentiment_level_from_posts(thread_id, platform_id)
+
+        # Window is [MAX(sentiment_at) - 1 hour, MAX(sentiment_at)] as below, the partial bucket at the start of
+        # window is summed from posts and the rest from full rollup buckets. Sums are numeric, so the result is
+        # identical to calculate_sentiment_level_from_posts().
+        stmt = sqlalchemy.text(f"""
+            WITH w AS (
+                SELECT
+                    MAX(sentiment_at) - INTERVAL '1 HOUR' AS start_at,
+                    date_bin(INTERVAL '{BUCKET_SECONDS} seconds', MAX(sentiment_at) - INTERVAL '1 HOUR', TIMESTAMPTZ 'epoch')
+                        + INTERVAL '{BUCKET_SECONDS} seconds' AS full_bucket_at
+                FROM
+                    posts
+                WHERE
+                    thread_id = :thread_id
+                    AND platform_id = :platform_id
+                    AND status IN ('sentimented', 'generated')
+            ),
+            edge AS (
+                SELECT
+                    SUM({LEVEL_SQL}) AS level_sum,
+                    COUNT(*) AS post_count
+                FROM
+                    posts, w
+                WHERE
+                    thread_id = :thread_id
+                    AND platform_id = :platform_id
+                    AND status IN ('sentimented', 'generated')
+                    AND sentiment_at >= w.start_at
+                    AND sentiment_at < w.full_bucket_at
+            ),
+            body AS (
+                SELECT
+                    SUM(level_sum) AS level_sum,
+                    SUM(post_count) AS post_count
+                FROM
+                    {self.rollup.table.name}, w
+                WHERE
+                    thread_id = :thread_id
+                    AND platform_id = :platform_id
+                    AND bucket_at >= w.full_bucket_at
+            )
+            SELECT
+                CAST((COALESCE(edge.level_sum, 0) + COALESCE(body.level_sum, 0))
+                    / NULLIF(edge.post_count + COALESCE(body.post_count, 0), 0) AS double precision) AS sentiment_level,
+                (
+                    SELECT
+                        AVG(sentiment_level)
+                    FROM
+                        {self.table.name}
+                    WHERE
+                        thread_id = :thread_id
+                        AND platform_id = :platform_id
+                        AND created_at >= (SELECT MAX(created_at) FROM {self.table.name}) - INTERVAL '1 hour'
+                ) AS old_sentiment_level
+            FROM
+                edge, body
+        """)
+        echo(f"calculate_sentiment_level from rollup, thread_id={thread_id}, platform_id={platform_id}")
+        sentiment_level=None
+        try:
+            with self.engine.connect() as conn:
+                r = conn.execute(stmt, {"thread_id": int(thread_id), "platform_id": platform_id}).fetchone()
+                sentiment_level = Decimal(r.sentiment_level)
+                old_sentiment_level = Decimal(r.old_sentiment_level) if r.old_sentiment_level is not None else None
+                if old_sentiment_level!=sentiment_level:
+                    conn.execute(self._insert_level_stmt(thread_id, platform_id, sentiment_level))
+                    conn.commit()
+                    return sentiment_level, True
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+            
+        return sentiment_level, False
+
+
+    def calculate_sentiment_level_from_posts(self, thread_id: str, platform_id: str) -> tuple[Decimal, bool]:
         old_sentiment_level = self.last_sentiment_level(thread_id, platform_id)
         stmt = f"""
             SELECT
-                SUM((((0.7*sentiment_score + 0.3*sentiment_magnitude)+1)/2)*100)/COUNT(*) AS sentiment_level
+                CAST(SUM({LEVEL_SQL})/COUNT(*) AS double precision) AS sentiment_level
             FROM
                 posts
             WHERE
@@ -176,22 +262,15 @@ class SentimentSummary():
                 AND platform_id = '{platform_id}'
                 AND status IN ('sentimented','generated') ) - INTERVAL '1 HOUR'
         """
-        print(stmt)
+        echo(stmt)
         sentiment_level=None
         try:
             with self.engine.connect() as conn:
                 r = conn.exec_driver_sql(stmt).fetchone()
                 sentiment_level = Decimal(r.__getattr__("sentiment_level"))
                 if old_sentiment_level!=sentiment_level:
-                    insert_stmt = (
-                        insert(self.table).values({
-                            "thread_id": int(thread_id),
-                            "platform_id": platform_id,
-                            "sentiment_level": sentiment_level,
-                            "created_at": datetime.now(UTC).isoformat()
-                        })
-                    )
-                    print(insert_stmt)
+                    insert_stmt = self._insert_level_stmt(thread_id, platform_id, sentiment_level)
+                    echo(insert_stmt)
                     conn.execute(insert_stmt)
                     conn.commit()
                     return sentiment_level, True
@@ -199,12 +278,23 @@ class SentimentSummary():
             print(e)
             conn.rollback()
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return sentiment_level, False
 
 
+    def _insert_level_stmt(self, thread_id: str, platform_id: str, sentiment_level: Decimal):
+        return (
+            insert(self.table).values({
+                "thread_id": int(thread_id),
+                "platform_id": platform_id,
+                "sentiment_level": sentiment_level,
+                "created_at": datetime.now(UTC).isoformat()
+            })
+        )
+
+
     def sentiment_level_by_timestamp(self, thread_id: str, start: str, end: str) -> list[dict]:
         stmt = (
             select(self.table)
@@ -227,7 +317,7 @@ class SentimentSummary():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return sls
@@ -3,6 +3,7 @@ import sqlalchemy
 from sqlalchemy import insert, select, update, delete
 import datetime
 from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP
+from .instrument import echo
 
 
 
@@ -56,7 +57,7 @@ class Thread():
             stmt = (
                 insert(self.table).values(th)
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -67,7 +68,7 @@ class Thread():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
@@ -79,7 +80,7 @@ class Thread():
             delete(self.table)
                 .where(self.table.c.thread_id == int(thread_id))
             )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt)
@@ -88,7 +89,7 @@ class Thread():
             print(e)
             conn.rollback()
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
         return thread_id
 
@@ -108,7 +109,7 @@ class Thread():
             print(e)
             conn.rollback()
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
         return th
     
@@ -118,16 +119,16 @@ class Thread():
             select(self.table)
                 .where(self.table.c.thread_id == int(thread_id))
         )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt).fetchone()
-                print(r._asdict())
+                echo(r._asdict())
                 return r._asdict()
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return None
@@ -137,7 +138,7 @@ class Thread():
             select(self.table)
         )
         ths = []
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 rows = conn.execute(stmt).fetchall()
@@ -146,7 +147,7 @@ class Thread():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return ths
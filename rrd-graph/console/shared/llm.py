@@ -1,6 +1,10 @@
 import os
 import json
 import time
+import random
+import asyncio
+import threading
+from dataclasses import dataclass
 import vertexai
 from langchain_google_vertexai import ChatVertexAI
 from langchain_google_vertexai._enums import HarmBlockThreshold, HarmCategory
@@ -13,19 +17,65 @@ os.environ["LANGSMITH_API_KEY"]="lsv2_pt_5479ecea4a544b69855f153a89b4301c_a27298
 
 
 
-def init_model(project_id:str, location:str, model_id:str):
-    # Only for local test in LangGraph Studio
-    file_path="/deps/__outer_agent/agent/multi-gke-ops-aa82224eed72.json"
-    if os.path.exists(file_path):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"]=file_path
-    credentials, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+_models = {}
+_model_locks = {}
+_lock = threading.Lock()
+_credentials = None
+_vertexai_inited = set()
+
+
+def _default_credentials():
+    """
+    Process-wide default credentials, they refresh their own token when it expires.
+    """
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            # Only for local test in LangGraph Studio
+            file_path="/deps/__outer_agent/agent/multi-gke-ops-aa82224eed72.json"
+            if os.path.exists(file_path):
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"]=file_path
+            _credentials, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        return _credentials
+
+
+def init_model(project_id:str, location:str, model_id:str, temperature:float=None):
+    """
+    Returns:
+        The chat model of (project_id, location, model_id, temperature), constructed on first use and shared after,
+        chat models are stateless between calls so one instance serves all threads.
+        Temperature defaults to 0.5 for Vertex models and 1 for Google Generative AI.
+    """
+    key = (project_id, location, model_id, temperature)
+    llm = _models.get(key)
+    if llm is not None:
+        return llm
+    with _lock:
+        key_lock = _model_locks.setdefault(key, threading.Lock())
+    # Construct each model once, without blocking lookups of other models
+    with key_lock:
+        llm = _models.get(key)
+        if llm is None:
+            llm = _new_model(project_id, location, model_id, temperature)
+            if llm is not None:
+                _models[key] = llm
+    return llm
+
+
+def clear_model_cache():
+    with _lock:
+        _models.clear()
+        _model_locks.clear()
 
+
+def _new_model(project_id:str, location:str, model_id:str, temperature:float=None, credentials=None):
     if model_id.startswith("claude"):
         # Vertex Anthropic
         llm = ChatAnthropicVertex(
             project=project_id, location=location, model=model_id, 
             max_tokens=8192, 
-            temperature=0.5,
+            temperature=0.5 if temperature is None else temperature,
+            credentials=credentials or _default_credentials(),
             safety_settings = {
                 HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_NONE,
                 HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
@@ -37,9 +87,14 @@ def init_model(project_id:str, location:str, model_id:str):
         )
     elif model_id.startswith("gemini") and os.getenv("GOOGLE_GENERATIVEAI_API_KEY") is None:
         # VertexAI Gemini
-        vertexai.init(project=project_id, location=location)
+        credentials = credentials or _default_credentials()
+        with _lock:
+            if (project_id, location) not in _vertexai_inited:
+                vertexai.init(project=project_id, location=location, credentials=credentials)
+                _vertexai_inited.add((project_id, location))
         llm = ChatVertexAI(
-            credentials=credentials, model_name=model_id, temperature=0.5,
+            credentials=credentials, project=project_id, location=location, model_name=model_id,
+            temperature=0.5 if temperature is None else temperature,
             safety_settings = {
                         HarmCategory.HARM_CATEGORY_UNSPECIFIED: HarmBlockThreshold.BLOCK_NONE,
                         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
@@ -51,7 +106,10 @@ def init_model(project_id:str, location:str, model_id:str):
     else:
         # GoogleGenerativeAI
         if os.getenv("GOOGLE_GENERATIVEAI_API_KEY") is not None:
-            llm = ChatGoogleGenerativeAI(model=model_id, google_api_key=os.getenv("GOOGLE_GENERATIVEAI_API_KEY"), temperature=1)
+            llm = ChatGoogleGenerativeAI(
+                model=model_id, google_api_key=os.getenv("GOOGLE_GENERATIVEAI_API_KEY"),
+                temperature=1 if temperature is None else temperature
+            )
         else:
             llm=None
     print(f"llm > {llm}")
@@ -66,21 +124,153 @@ def string_to_pjson(json_string: str) -> str:
         print("Invalid JSON string")
         return None
 
-def call_llm(llm, prompt: str):
-    retry_count = 0
-    max_retries = 3
-    retry_delay = 1
-    while retry_count < max_retries:
+def backoff_delay(attempt: int, base_delay: float=1, max_delay: float=8) -> float:
+    """
+    Exponential backoff with full jitter, so retries of concurrent callers don't line up.
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+@dataclass
+class LlmResult():
+    """
+    Outcome of one LLM call: content is the response with JSON fences stripped, error is set when all attempts
+    failed or the deadline ran out.
+    """
+    prompt: str
+    content: str = None
+    error: str = None
+    attempts: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def call_llm(llm, prompt: str, max_retries: int=3, deadline: float=None):
+    """
+    Call the LLM, retried with jittered exponential backoff.
+    Args:
+        deadline: Seconds for all attempts including backoff, unlimited if not given.
+    Returns:
+        The response with JSON fences stripped, None if all attempts failed.
+    """
+    if llm is None:
+        print("Error to call LLM: model is not available")
+        return None
+    started = time.monotonic()
+    for attempt in range(max_retries):
         try: 
-            while retry_count < 3:
-                responding = llm.invoke(prompt)
-                print(f"responding: {responding.content}")
-                ct = string_to_pjson(responding.content)
-                return ct
+            responding = llm.invoke(prompt)
+            print(f"responding: {responding.content}")
+            return string_to_pjson(responding.content)
         except Exception as e:
-            print(f"Error to call LLM: {e}. Retrying in {retry_delay} seconds...")
+            retry_delay = backoff_delay(attempt)
+            if attempt == max_retries - 1 or (deadline is not None and time.monotonic() - started + retry_delay > deadline):
+                print(f"Error to call LLM: {e}. Giving up after {attempt + 1} attempts.")
+                break
+            print(f"Error to call LLM: {e}. Retrying in {retry_delay:.2f} seconds...")
             time.sleep(retry_delay)
-            retry_count += 1
-            retry_delay *= 2
 
-    return None
\ No newline at end of file
+    return None
+
+
+async def acall_llm(llm, prompt: str, max_retries: int=3, deadline: float=120) -> LlmResult:
+    """
+    Async call_llm(): each attempt is bounded by what's left of the deadline, backoff doesn't block a thread, and
+    cancelling the caller cancels the call in flight. Timeouts of the call itself, e.g. of the network, are retried
+    like any other error, the deadline is told apart by the loop's clock.
+    """
+    loop = asyncio.get_running_loop()
+    ends_at = loop.time() + deadline
+    started = time.monotonic()
+    result = LlmResult(prompt=prompt)
+    if llm is None:
+        result.error = "model is not available"
+        print(f"Error to call LLM: {result.error}")
+        return result
+    for attempt in range(max_retries):
+        remaining = ends_at - loop.time()
+        if remaining <= 0:
+            result.error = result.error or "deadline exceeded"
+            break
+        result.attempts = attempt + 1
+        try:
+            responding = await asyncio.wait_for(llm.ainvoke(prompt), timeout=remaining)
+            result.content = string_to_pjson(responding.content)
+            result.error = None
+            break
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError) and loop.time() >= ends_at:
+                result.error = f"deadline exceeded after {deadline}s"
+                break
+            result.error = f"{type(e).__name__}: {e}"
+            retry_delay = backoff_delay(attempt)
+            if attempt == max_retries - 1 or loop.time() + retry_delay > ends_at:
+                break
+            print(f"Error to call LLM: {e}. Retrying in {retry_delay:.2f} seconds...")
+            await asyncio.sleep(retry_delay)
+    result.elapsed = time.monotonic() - started
+    if result.error is not None:
+        print(f"Error to call LLM: {result.error}, attempts: {result.attempts}")
+    return result
+
+
+async def call_llm_many(llm, prompts: list[str], concurrency: int=4, max_retries: int=3,
+                        deadline: float=120) -> list[LlmResult]:
+    """
+    Run acall_llm() over prompts with at most `concurrency` calls in flight, all sharing one deadline.
+    Returns:
+        One LlmResult per prompt, in the order of prompts.
+    """
+    if llm is None:
+        print("Error to call LLM: model is not available")
+        return [LlmResult(prompt=p, error="model is not available") for p in prompts]
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(prompt):
+        async with semaphore:
+            remaining = deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                return LlmResult(prompt=prompt, error="deadline exceeded before start")
+            return await acall_llm(llm, prompt, max_retries=max_retries, deadline=remaining)
+
+    return await asyncio.gather(*(one(p) for p in prompts))
+
+
+def _init_model_uncached(project_id:str, location:str, model_id:str):
+    """
+    init_model() as it was before models were cached, for bench_init_model(): credentials are resolved, vertexai is
+    initialized and the model is constructed on every call.
+    """
+    credentials, _ = default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    if model_id.startswith("gemini") and os.getenv("GOOGLE_GENERATIVEAI_API_KEY") is None:
+        vertexai.init(project=project_id, location=location, credentials=credentials)
+    return _new_model(project_id, location, model_id, credentials=credentials)
+
+
+def bench_init_model(model_id="gemini-1.5-flash-002", rounds=1000):
+    """
+    Compare the setup cost of a request with the old per-call init (credentials, vertexai.init and a new model) and
+    with the cache, needs application default credentials, e.g.:
+        gcloud auth application-default login
+        python -m shared.llm
+    """
+    started = time.perf_counter()
+    for _ in range(10):
+        _init_model_uncached("multi-gke-ops", "us-central1", model_id)
+    uncached = (time.perf_counter() - started) / 10
+
+    clear_model_cache()
+    init_model("multi-gke-ops", "us-central1", model_id)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        init_model("multi-gke-ops", "us-central1", model_id)
+    cached = (time.perf_counter() - started) / rounds
+    print(f"{model_id}: per-call init {uncached * 1000:.2f}ms per request, cached {cached * 1e6:.2f}us per request")
+
+
+if __name__ == "__main__":
+    bench_init_model(model_id=os.getenv("BENCH_MODEL_ID") or "gemini-1.5-flash-002")
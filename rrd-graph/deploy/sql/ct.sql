@@ -23,7 +23,8 @@ CREATE TABLE jobs (
     job_interval smallint,
     status text,
     created_at timestamptz NOT NULL,
-    updated_at timestamptz
+    updated_at timestamptz,
+    scrape_cursor jsonb -- high-water mark of incremental scraping, see Job.save_cursor()
 ) ;
 ALTER TABLE jobs ADD PRIMARY KEY (job_id);
 
@@ -126,6 +127,43 @@ CREATE TABLE playbooks (
     assessment JSONB NOT NULL,
     plan JSONB NOT NULL,
     created_at timestamptz NOT NULL,
-    updated_at timestamptz
+    updated_at timestamptz,
+    input_hash text, -- hash of the prompt inputs, see PromptBuilder.input_hash()
+    sentiment_level double precision
 );
-ALTER TABLE playbooks ADD PRIMARY KEY (playbook_id);
\ No newline at end of file
+ALTER TABLE playbooks ADD PRIMARY KEY (playbook_id);
+
+-- Indexes for hot queries, keep in sync with shared/db/migration.py (python -m shared.db.migration applies them to a live database)
+CREATE INDEX IF NOT EXISTS posts_thread_status_created_idx ON posts (thread_id, status, created_at DESC);
+CREATE INDEX IF NOT EXISTS posts_thread_created_analysed_idx ON posts (thread_id, created_at DESC, sentiment_score) WHERE status IN ('sentimented', 'generated');
+CREATE INDEX IF NOT EXISTS posts_thread_platform_sentiment_at_idx ON posts (thread_id, platform_id, sentiment_at) WHERE status IN ('sentimented', 'generated');
+CREATE INDEX IF NOT EXISTS sentiment_summary_thread_platform_created_idx ON sentiment_summary (thread_id, platform_id, created_at);
+CREATE INDEX IF NOT EXISTS sentiment_summary_created_idx ON sentiment_summary (created_at);
+CREATE INDEX IF NOT EXISTS playbooks_thread_created_idx ON playbooks (thread_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS marked_blob_created_idx ON marked_blob (created_at);
+CREATE INDEX IF NOT EXISTS jobs_thread_platform_idx ON jobs (thread_id, platform_id);
+
+
+DROP TABLE IF EXISTS sentiment_rollup;
+CREATE TABLE sentiment_rollup (
+    thread_id bigint NOT NULL,
+    platform_id text NOT NULL,
+    bucket_at timestamptz NOT NULL, -- start of a 60 seconds bucket by posts.sentiment_at
+    level_sum numeric NOT NULL, -- exact sum, see LEVEL_SQL in shared/db/tb_sentiment_rollup.py
+    post_count bigint NOT NULL
+) ;
+ALTER TABLE sentiment_rollup ADD PRIMARY KEY (thread_id, platform_id, bucket_at);
+
+
+DROP TABLE IF EXISTS page_extracts;
+CREATE TABLE page_extracts (
+    url_hash text NOT NULL, -- hash of the normalized URL
+    url text NOT NULL,
+    validator text, -- ETag or Last-Modified of the page when it was extracted
+    simhash bigint, -- 64 bits SimHash of the content, to find near-duplicate pages
+    canonical_hash text, -- url_hash of the page this one is a near-duplicate of
+    content text, -- NULL for a near-duplicate
+    extracted_at timestamptz NOT NULL
+) ;
+ALTER TABLE page_extracts ADD PRIMARY KEY (url_hash);
+CREATE INDEX IF NOT EXISTS page_extracts_extracted_idx ON page_extracts (extracted_at DESC) WHERE canonical_hash IS NULL;
@@ -3,7 +3,6 @@ import os
 import datetime
 import random
 import time
-import requests
 import json
 import threading
 
@@ -11,7 +10,7 @@ from google.cloud import run_v2
 from google.cloud import storage
 
 from shared.llm import init_model
-from shared.c_run import get_google_cloud_run_service_url
+from shared.c_run import trigger_service
 from shared.db.sql_cn import SqlCN
 
 
@@ -31,15 +30,8 @@ sqlcn = SqlCN()
 
 
 def trigger_analysis(thread_id, project_id, location, service_name="analysis-service"):
-    s_url = get_google_cloud_run_service_url(service_name="analysis-service", project_id=project_id, location=location)
-    if s_url is None:
-        s_url="http://localhost:8000"
-    print(f"service_url: {s_url}")
-    try:
-        print(f"Trigger analysis {s_url}/nlp-analysis/{thread_id} again...")
-        requests.get(f"{s_url}/nlp-analysis/{thread_id}", timeout=1)
-    except requests.exceptions.ReadTimeout: 
-        pass
+    # Sent in the background, the policy loop doesn't wait for discovery or the request
+    trigger_service(project_id, location, "analysis-service", f"/nlp-analysis/{thread_id}", timeout=1)
 
 def generate_tweets_sdk(project_id, location, model_id, context, total_tweets, positive_percentage, neutral_percentage, negative_percentage):
     llm = init_model(project_id="multi-gke-ops", location="us-east5", model_id="claude-3-5-sonnet-v2@20241022")
@@ -124,7 +116,9 @@ def save_tweets(thread_id: str, tweets: list[dict]):
             post_data.append(row)
 
         print(f"{len(post_data)} rows will be inserted.")
-        sqlcn.posts.create_posts_in_batch(post_data)
+        counts = sqlcn.posts.create_posts_in_batch(post_data)
+        print(f"{counts.get('inserted')} rows inserted, {counts.get('skipped')} duplicated rows skipped.")
+        return counts
 
 
 def thread_by_id(thread_id:str):
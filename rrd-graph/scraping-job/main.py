@@ -1,13 +1,12 @@
 import json
 import os
-import requests
 from dotenv import load_dotenv
 
 from tools.google_search import GoogleSearch
 from tools.tweets_scraper import TweetsScraper
 from shared.db.sql_cn import SqlCN
 from shared.db.tb_platforms import PlatformId
-from shared.c_run import get_google_cloud_run_service_url
+from shared.c_run import trigger_service
 
 import nltk
 nltk.download('punkt_tab')
@@ -22,19 +21,18 @@ sqlcn = SqlCN()
 
 
 def trigger_analysis( project_id, location, thread_id, service_name, nlp="nlp"):
-    s_url = get_google_cloud_run_service_url(project_id=project_id, location=location, service_name=service_name)
-    if s_url is None:
-        s_url="http://localhost:8000"
-    print(f"service_url: {s_url}")
-    try:
-        if nlp == "nlp":
-            print(f"Trigger analysis {s_url}/nlp-analysis/{thread_id} again...")
-            requests.get(f"{s_url}/nlp-analysis/{thread_id}", timeout=1)
-        else:
-            print(f"Trigger analysis {s_url}/analysis/{thread_id} again...")
-            requests.get(f"{s_url}/analysis/{thread_id}", timeout=1)
-    except requests.exceptions.ReadTimeout: 
-        pass
+    # Sent in the background, pending triggers are still sent before the job exits
+    if nlp == "nlp":
+        trigger_service(project_id, location, service_name, f"/nlp-analysis/{thread_id}", timeout=1)
+    else:
+        trigger_service(project_id, location, service_name, f"/analysis/{thread_id}", timeout=1)
+
+def save_cursor(job, scrape_cursor, counts):
+    # Moved forward only when the items were saved, otherwise the next run fetches them again
+    if counts is not None and counts.get("failed", 0) > 0:
+        print(f"Keep cursor of {job.get('job_id')}, {counts.get('failed')} items failed to save")
+        return
+    sqlcn.jobs.save_cursor(job.get("job_id"), scrape_cursor)
 
 # Function to main
 def main():
@@ -48,11 +46,15 @@ def main():
     if platform_id in PlatformId:
         if platform_id == PlatformId.TWITTER.value:
             try:
-                ts = TweetsScraper(sqlcn=sqlcn, bearer_token=sqlcn.platforms.api_secret_by(platform_id))
-                job = sqlcn.jobs.jobs_by_thread_id(thread_id)
+                bearer_token = sqlcn.platforms.api_secret_by(platform_id)
+                ts = TweetsScraper(sqlcn=sqlcn, bearer_token=bearer_token.get("secret"))
+                job = sqlcn.jobs.the_job(thread_id=thread_id, platform_id=platform_id)
                 kw = job.get("keywords")[0]
-                tss = ts.searh_tweets(kw)
-                ts.save_tweets(thread_id, platform_id, tss)
+                # Only tweets after the high-water mark of the last run
+                tss, scrape_cursor = ts.search_new_tweets(kw, job.get("scrape_cursor"))
+                counts = ts.save_tweets(thread_id, platform_id, tss)
+                print(f"Saved tweets: {counts}")
+                save_cursor(job, scrape_cursor, counts)
                     
                 # Trigger analysis after each data collecting 
                 trigger_analysis(project_id, location, thread_id, analysis_service)
@@ -68,15 +70,15 @@ def main():
 
                     job = sqlcn.jobs.the_job(thread_id=thread_id, platform_id=platform_id)
                     kws = job.get("keywords")
-                    all_srs = []
-                    for kw in kws:
-                        print(f"keyword: {kw}")
-                        if platform_id == PlatformId.GOOGLE_NEWS.value:
-                            all_srs.extend(gs.search_g_news(str(kw)))
-                        elif platform_id == PlatformId.GOOGLE_SEARCH.value:
-                            all_srs.extend(gs.search_g_engine(kw))
+                    print(f"keywords: {kws}")
+                    # All keywords are searched and scraped at once on the shared pool of gs, pages scraped by
+                    # the last runs are skipped
+                    s_path = "/news" if platform_id == PlatformId.GOOGLE_NEWS.value else "/search"
+                    all_srs, scrape_cursor = gs.search_new(s_path, kws, job.get("scrape_cursor"))
                     # Save into BQ
-                    gs.save_page_content(thread_id, platform_id, all_srs)
+                    counts = gs.save_page_content(thread_id, platform_id, all_srs)
+                    print(f"Saved pages: {counts}")
+                    save_cursor(job, scrape_cursor, counts)
                     # Trigger analysis after each data collecting 
                     trigger_analysis(project_id, location, thread_id, analysis_service, nlp=None)
                 else:
@@ -0,0 +1,139 @@
+import os
+import time
+import random
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+from tools.stage_timer import StageTimer
+from tools.url_utils import url_host
+
+
+# Statuses worth another try, anything else is returned to the caller as is
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AsyncFetcher():
+    """
+    Asyncio HTTP layer of the scraping job: one pooled keep-alive client for all requests, at most FETCH_CONCURRENCY
+    (default 16) requests in flight and SCRAPE_PER_HOST (default 2) per host, FETCH_TIMEOUT seconds (default 60) for
+    a response and 10 to connect, and up to FETCH_MAX_RETRIES (default 2) retries with jittered backoff on
+    timeouts, connection errors and 429/5xx.
+    CPU-heavy work like parsing runs on a process pool of PARSE_WORKERS (default number of CPUs) processes, so it
+    never blocks fetching, parse_workers=0 runs it inline instead, e.g. for a single page. Use it as an async context
+    manager:
+        async with AsyncFetcher() as fetcher:
+            response = await fetcher.request("GET", url)
+            text = await fetcher.run_cpu(extract, response.text)
+    """
+    def __init__(self, concurrency: int=None, per_host: int=None, timeout: float=None, max_retries: int=None,
+                 parse_workers: int=None, timer: StageTimer=None, transport: httpx.AsyncBaseTransport=None):
+        self.concurrency = concurrency or int(os.getenv("FETCH_CONCURRENCY") or 16)
+        self.per_host = per_host or int(os.getenv("SCRAPE_PER_HOST") or 2)
+        self.timeout = timeout or float(os.getenv("FETCH_TIMEOUT") or 60)
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("FETCH_MAX_RETRIES") or 2)
+        self.parse_workers = parse_workers if parse_workers is not None \
+            else int(os.getenv("PARSE_WORKERS") or os.cpu_count() or 1)
+        self.timer = timer or StageTimer()
+        self.backoff = 0.5
+        self.transport = transport
+        self.client = None
+        self.processes = None
+        self._slots = None
+        self._host_slots = None
+
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout, connect=10),
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            follow_redirects=True,
+            transport=self.transport,
+        )
+        self.processes = ProcessPoolExecutor(max_workers=self.parse_workers) if self.parse_workers > 0 else None
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._host_slots = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        return self
+
+
+    async def __aexit__(self, *args):
+        await self.client.aclose()
+        if self.processes is not None:
+            self.processes.shutdown(wait=False, cancel_futures=True)
+        return False
+
+
+    async def request(self, method: str, url: str, stage: str="fetch", host: str=None, host_limit: bool=True,
+                      **kwargs) -> httpx.Response:
+        """
+        Send the request within the concurrency limits, retried on transient failures.
+        Args:
+            stage: Name of the stage in timer.
+            host: Host the per-host limit applies to, host of the URL by default, e.g. the host of the page
+                rendered by a Browserless request.
+            host_limit: False for an API which takes concurrent calls, only bounded by FETCH_CONCURRENCY.
+        Raises:
+            httpx.HTTPError or TimeoutError of the last attempt.
+        """
+        deadline = kwargs.get("timeout") or self.timeout
+        host_slot = self._host_slots[host or url_host(url)] if host_limit else None
+        for attempt in range(self.max_retries + 1):
+            try:
+                # The slot of the host first, so requests waiting for a busy host don't hold a global slot
+                if host_slot is not None:
+                    await host_slot.acquire()
+                try:
+                    async with self._slots:
+                        with self.timer.time(stage):
+                            # httpx times out each read, a server trickling bytes is stopped by the deadline
+                            response = await asyncio.wait_for(self.client.request(method, url, **kwargs), deadline)
+                finally:
+                    if host_slot is not None:
+                        host_slot.release()
+                if response.status_code not in RETRYABLE_STATUSES or attempt == self.max_retries:
+                    return response
+                print(f"{method} {url} got {response.status_code}, attempt {attempt + 1}")
+            except (httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"{method} {url} failed, attempt {attempt + 1}, err: {e!r}")
+            await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+    async def run_cpu(self, fn, *args, stage: str="parse"):
+        """
+        Run fn(*args) on the process pool, fn and args have to be picklable.
+        """
+        with self.timer.time(stage):
+            if self.processes is None:
+                return fn(*args)
+            return await asyncio.get_running_loop().run_in_executor(self.processes, fn, *args)
+
+
+def bench_async_fetch(keywords=20, results=10, latency=0.2, hosts=50):
+    """
+    Fetch keywords x results fake pages of latency seconds each through a mock transport, prints the wall time
+    against one page latency.
+    """
+    async def handler(request):
+        await asyncio.sleep(latency)
+        return httpx.Response(200, text="<html><body><p>page</p></body></html>")
+
+    async def run():
+        urls = [f"https://host{i % hosts}.example/page/{i}" for i in range(keywords * results)]
+        async with AsyncFetcher(concurrency=keywords * results, per_host=2, transport=httpx.MockTransport(handler),
+                                parse_workers=1) as fetcher:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*[fetcher.request("GET", url) for url in urls])
+            elapsed = time.perf_counter() - started
+        print(f"fetched {len(responses)} pages over {hosts} hosts in {elapsed:.2f}s "
+              f"({elapsed / latency:.1f}x page latency, serial {len(responses) * latency:.1f}s), "
+              f"stages: {fetcher.timer.summary()}")
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    bench_async_fetch(keywords=int(os.getenv("BENCH_KEYWORDS") or 20), latency=float(os.getenv("BENCH_LATENCY") or 0.2))
@@ -0,0 +1,222 @@
+import os
+import re
+import time
+import hashlib
+import datetime
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+from tools.url_utils import url_hash
+
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+MASK_64 = (1 << 64) - 1
+
+
+def simhash(text: str, shingle: int=3) -> int:
+    """
+    64 bits SimHash over word shingles, near-duplicate texts differ in a few bits.
+    """
+    words = _WORD_RE.findall((text or "").lower())
+    if len(words) == 0:
+        return 0
+    digests = b"".join(
+        hashlib.blake2b(" ".join(words[i:i + shingle]).encode("utf-8"), digest_size=8).digest()
+        for i in range(max(1, len(words) - shingle + 1))
+    )
+    # One row of 64 bits per shingle, most significant bit first
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    majority = bits.sum(axis=0) * 2 > bits.shape[0]
+    return int.from_bytes(np.packbits(majority).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return ((a ^ b) & MASK_64).bit_count()
+
+
+def to_signed(h: int) -> int:
+    # bigint of Postgres is signed
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def to_unsigned(h: int) -> int:
+    return h & MASK_64
+
+
+class SimHashIndex():
+    """
+    Near-duplicate lookup of 64 bits SimHashes within max_distance bits, hashes are split into max_distance + 1 bands
+    so a near-duplicate shares at least one band exactly and only those candidates are compared.
+    A key has at most one hash, adding it again replaces the hash it had.
+    """
+    def __init__(self, max_distance: int=3):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.width = 64 // self.bands
+        self._buckets = defaultdict(list)
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+
+    def _keys(self, h: int):
+        mask = (1 << self.width) - 1
+        return [(band, h >> (band * self.width) & mask) for band in range(self.bands)]
+
+
+    def add(self, key, h: int):
+        with self._lock:
+            self._add(key, h)
+
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+
+    def find(self, h: int):
+        """
+        Returns:
+            Key of the closest near-duplicate, None if there's none.
+        """
+        with self._lock:
+            return self._find(h)
+
+
+    def find_or_add(self, key, h: int):
+        """
+        Atomic find(), the hash is added under the key when there's no near-duplicate, so of two near-duplicates
+        added concurrently one always finds the other. The hash the key had before is removed either way, as the page
+        no longer has that content.
+        Returns:
+            Key of the closest near-duplicate other than the key, None if the hash has been added.
+        """
+        with self._lock:
+            self._remove(key)
+            found = self._find(h)
+            if found is None:
+                self._add(key, h)
+            return found
+
+
+    def _add(self, key, h: int):
+        self._remove(key)
+        for k in self._keys(h):
+            self._buckets[k].append((key, h))
+        self._hashes[key] = h
+
+
+    def _remove(self, key):
+        h = self._hashes.pop(key, None)
+        if h is None:
+            return
+        for k in self._keys(h):
+            bucket = [entry for entry in self._buckets.get(k, ()) if entry[0] != key]
+            if len(bucket) > 0:
+                self._buckets[k] = bucket
+            else:
+                self._buckets.pop(k, None)
+
+
+    def _find(self, h: int):
+        best = None
+        for k in self._keys(h):
+            for key, other in self._buckets.get(k, ()):
+                d = hamming(h, other)
+                if d <= self.max_distance and (best is None or d < best[0]):
+                    best = (d, key)
+        return best[1] if best is not None else None
+
+
+class ExtractCache():
+    """
+    Cache of text extracted from pages in the page_extracts table, keyed on url_hash() of the normalized URL.
+    An extract is fresh while the ETag/Last-Modified of the page is unchanged, or, for pages without either, for
+    EXTRACT_CACHE_TTL seconds (default 21600). Pages whose content is within EXTRACT_SIMHASH_DISTANCE bits
+    (default 3) of a page extracted in the last EXTRACT_CACHE_TTL are stored as near-duplicates of it, with no content
+    of their own.
+    """
+    def __init__(self, page_extracts, ttl: int=None, max_distance: int=None):
+        self.page_extracts = page_extracts
+        self.ttl = ttl or int(os.getenv("EXTRACT_CACHE_TTL") or 21600)
+        self.index = SimHashIndex(max_distance=max_distance or int(os.getenv("EXTRACT_SIMHASH_DISTANCE") or 3))
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "near_duplicates": 0}
+
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            since = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=self.ttl)
+            started = time.perf_counter()
+            rows = self.page_extracts.recent_simhashes(since)
+            for key, h in rows:
+                self.index.add(key, to_unsigned(h))
+            self._loaded = True
+            print(f"Loaded {len(rows)} simhashes in {time.perf_counter() - started:.2f}s")
+
+
+    def lookup(self, url: str, validator: str=None):
+        """
+        Returns:
+            (content, canonical_hash) of a fresh extract of the page, canonical_hash is None unless the page is
+            a near-duplicate, None on a miss.
+        """
+        key = url_hash(url)
+        extract = self.page_extracts.extract_by([key]).get(key)
+        if extract is None or not self._fresh(extract, validator):
+            self._count("misses")
+            return None
+        canonical = extract.get("canonical_hash")
+        content = extract.get("content")
+        if canonical is not None:
+            content = (self.page_extracts.extract_by([canonical]).get(canonical) or {}).get("content")
+            if content is None:
+                self._count("misses")
+                return None
+        self._count("hits")
+        return content, canonical
+
+
+    def _fresh(self, extract: dict, validator: str) -> bool:
+        if validator:
+            return extract.get("validator") == validator
+        extracted_at = extract.get("extracted_at")
+        if extracted_at.tzinfo is None:
+            extracted_at = extracted_at.replace(tzinfo=datetime.UTC)
+        return datetime.datetime.now(datetime.UTC) - extracted_at < datetime.timedelta(seconds=self.ttl)
+
+
+    def store(self, url: str, content: str, validator: str=None) -> str:
+        """
+        Save the extract of a page, only a reference when it's a near-duplicate of another page.
+        Returns:
+            url_hash of the page it's a near-duplicate of, None if it's original.
+        """
+        self._load()
+        key = url_hash(url)
+        h = simhash(content)
+        if h != 0:
+            canonical = self.index.find_or_add(key, h)
+        else:
+            canonical = None
+            self.index.remove(key)
+        self.page_extracts.save_extract({
+            "url_hash": key,
+            "url": url,
+            "validator": validator,
+            "simhash": to_signed(h),
+            "canonical_hash": canonical,
+            "content": content if canonical is None else None,
+        })
+        if canonical is not None:
+            self._count("near_duplicates")
+        return canonical
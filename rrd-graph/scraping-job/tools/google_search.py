@@ -1,42 +1,112 @@
 import json
 import os
-import http.client
+import time
 import uuid
-import requests
+import asyncio
 import datetime
-import threading
-from unstructured.partition.html import partition_html
 from shared.db.sql_cn import SqlCN
 from shared.db.tb_posts import PostType
+from tools.async_fetch import AsyncFetcher
+from tools.extract_cache import ExtractCache
+from tools.html_text import extract_text
+from tools.stage_timer import StageTimer
+from tools.url_utils import url_hash, url_host
 
 
+SERPER_URL = "https://google.serper.dev"
+
+# Hashes of URLs have been scraped, kept in the cursor of a job to skip them in the next runs
+JOB_CURSOR_MAX_URLS = int(os.getenv("JOB_CURSOR_MAX_URLS") or 2000)
+
 
 class GoogleSearch:
+    """
+    Search keywords through Serper and scrape result pages through Browserless, on one AsyncFetcher for all
+    keywords: pooled keep-alive connections, timeouts, retries, bounded concurrency per host, and extraction of text
+    from pages on a process pool by extract_text(), with its size limits. Result URLs are deduplicated across keywords
+    before any page is fetched.
+    Text extracted from pages is cached by ExtractCache, a page is only rendered and partitioned again when its
+    ETag/Last-Modified changed, set EXTRACT_CACHE=false to disable it.
+    """
     def __init__(self, sqlcn: SqlCN, serper_api_key: str, browserless_url: str):
         self.sqlcn = sqlcn
         self.serper_api_key = serper_api_key
         self.browserless_url = browserless_url
+        self.timer = StageTimer()
+        # Pages extracted per method, truncated pages and seconds of parsing in worker processes
+        self.extract_stats = {"fast": 0, "unstructured": 0, "truncated": 0, "parse_seconds": 0.0}
+        use_cache = (os.getenv("EXTRACT_CACHE") or "true").lower() == "true"
+        self.cache = ExtractCache(sqlcn.page_extracts) if use_cache and sqlcn is not None else None
+
+
+    def fetcher(self) -> AsyncFetcher:
+        return AsyncFetcher(timer=self.timer)
+
+
+    async def validator(self, fetcher: AsyncFetcher, page_url):
+        """
+        Returns:
+            ETag or Last-Modified of the page by a HEAD request, None if the site gives neither.
+        """
+        try:
+            response = await fetcher.request("HEAD", page_url, stage="validate", timeout=5)
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+        except Exception as e:
+            print(f"Failed to validate {page_url}, err: {e!r}")
+            return None
+
+    def count_extract(self, page_url, extract: dict):
+        self.extract_stats[extract["method"]] += 1
+        self.extract_stats["truncated"] += int(extract["truncated"])
+        self.extract_stats["parse_seconds"] = round(self.extract_stats["parse_seconds"] + extract["parse_ms"] / 1000, 3)
+        print(f"Extracted {len(extract['content'])} chars of {page_url} from {extract['html_bytes']} bytes by "
+              f"{extract['method']} in {extract['parse_ms']}ms{', truncated' if extract['truncated'] else ''}")
 
     # Function to scrape a page
-    def scrape_page(self, req, abbr, srs):
+    def scrape_page(self, req, abbr, srs=None):
+        async def run():
+            # One page is extracted inline, a process pool is only worth it for the pages of asearch_many()
+            async with AsyncFetcher(timer=self.timer, parse_workers=0) as fetcher:
+                return await self.ascrape_page(fetcher, req, abbr)
+        sr = asyncio.run(run())
+        if srs is not None:
+            srs.append(sr)
+        return sr
+
+
+    async def ascrape_page(self, fetcher: AsyncFetcher, req, abbr):
         page_url=req.get('link')
-        browserless_url = self.browserless_url
-        payload = json.dumps({"url": page_url})
-        headers = {'cache-control': 'no-cache', 'content-type': 'application/json'}
-        response = requests.request("POST", browserless_url, headers=headers, data=payload)
-        elements = partition_html(text=response.text)
-        content = "\n\n".join([str(el) for el in elements])
-        # content = [content[i:i + 8000] for i in range(0, len(content), 8000)]
+        validator = await self.validator(fetcher, page_url) if self.cache is not None else None
+        cached = await asyncio.to_thread(self.cache.lookup, page_url, validator) if self.cache is not None else None
+        if cached is not None:
+            content, duplicate_of = cached
+        else:
+            payload = json.dumps({"url": page_url})
+            headers = {'cache-control': 'no-cache', 'content-type': 'application/json'}
+            # Rendering a page is bounded by the host of the page, not of Browserless
+            response = await fetcher.request(
+                "POST", self.browserless_url, host=url_host(page_url), headers=headers, content=payload
+            )
+            response.raise_for_status()
+            extract = await fetcher.run_cpu(extract_text, response.text)
+            content = extract["content"]
+            self.count_extract(page_url, extract)
+            duplicate_of = None
+            if self.cache is not None:
+                duplicate_of = await asyncio.to_thread(self.cache.store, page_url, content, validator)
 
         pid = uuid.uuid4()
-        srs.append({
+        return {
             "post_id": f"{abbr}-{pid}",
             "content": content,
             "content_summary": f"Title: {req.get('title')}, Snippet: {req.get('snippet')}, Link: {req.get('link')}, ",
             "scraped_at": datetime.datetime.now(datetime.UTC),
             #TODO: Using same time as scraped_at for created_at for now, don't know how to get right time!!!
             "created_at": datetime.datetime.now(datetime.UTC),
-        })
+            "url_hash": url_hash(page_url),
+            # url_hash of the page this one is a near-duplicate (e.g. syndicated copy) of
+            "duplicate_of": duplicate_of,
+        }
 
     def save_page_content(self, thread_id, platform_id, contents):
         if len(contents) > 0:
@@ -53,68 +123,106 @@ class GoogleSearch:
                     "scraped_at": v.get('scraped_at').isoformat(),
                 }
                 rows_to_insert.append(row)
-            self.sqlcn.posts.create_posts_in_batch(rows_to_insert)
+            return self.sqlcn.posts.create_posts_in_batch(rows_to_insert)
+        return None
 
 
     # Function to search through Search Engine
-    def search_engine(self, s_path, query):
+    async def search_results(self, fetcher: AsyncFetcher, s_path, query, tbs="qdr:d"):
+        """
+        Args:
+            tbs: Time range of results, e.g. qdr:h for the past hour, qdr:d for the past 24 hours.
+        Returns:
+            Top results of the query, and abbreviation of the platform as prefix of post_id.
+        """
         top_result_to_return = 10
-        conn = http.client.HTTPSConnection("google.serper.dev")
         payload = json.dumps({
             "q": query,
             "num": top_result_to_return,
             #TODO To be configured.
             "location": "Singapore",
             "gl": "sg",
-            # Past 24H
-            "tbs": "qdr:d"
+            "tbs": tbs
         })
         headers = {
             'X-API-KEY': self.serper_api_key,
             'content-type': 'application/json'
         }
-        conn.request("POST", s_path, payload, headers)
-        res = conn.getresponse()
-        data = res.read()
+        # Serper takes concurrent calls, only bounded by FETCH_CONCURRENCY
+        response = await fetcher.request(
+            "POST", f"{SERPER_URL}{s_path}", stage="search", host_limit=False, headers=headers, content=payload
+        )
+        response.raise_for_status()
         if s_path == "/news":
-            results = json.loads(data).get('news')
+            results = response.json().get('news')
             abbr = "gn"
         else:
-            results = json.loads(data).get('organic')
+            results = response.json().get('organic')
             abbr = "gs"
-        
-        srs = []
-        sthreads = []
-        for result in results[:top_result_to_return]:
-            try:
-                print('\n'.join([
-                    f"Title: {result.get('title')}", f"Link: {result.get('link')}",
-                    f"Snippet: {result.get('snippet')}", "\n-----------------"
-                ]))
-
-                th = threading.Thread(target=self.scrape_page, args=(result, abbr, srs))
-                th.start()
-                print(f"Thread {th.name}: {th.ident} is running...")
-                
-                sthreads.append(th)
-            except KeyError:
-                next
-
-        # Waiting thread to be finish
-        for th in sthreads:
-            th.join()
-
-        # for th in sthreads:
-        #     ret, content = th.result
-        #     # Using UUID as post_id for search result
-        #     pid = uuid.uuid4()
-        #     srs.append({
-        #         "post_id": f"{abbr}-{pid}",
-        #         "content": content,
-        #         "content_summary": f"Title: {ret.get('title')}, Snippet: {ret.get('snippet')}, Link: {ret.get('link')}, ",
-        #         "scraped_at": datetime.datetime.now(datetime.UTC),
-        #     })
+        return (results or [])[:top_result_to_return], abbr
+
+
+    def search_engine(self, s_path, query):
+        return self.search_many(s_path, [query])
+
+
+    def search_many(self, s_path, queries, skip_hashes=None, tbs="qdr:d", dropped=None):
+        return asyncio.run(self.asearch_many(s_path, queries, skip_hashes=skip_hashes, tbs=tbs, dropped=dropped))
 
+
+    async def asearch_many(self, s_path, queries, skip_hashes=None, tbs="qdr:d", dropped=None):
+        """
+        Search all queries at once, then scrape the deduplicated result pages with at most SCRAPE_PER_HOST pages of
+        a host in flight, prints time spent in each stage.
+        Args:
+            skip_hashes: url_hash() of pages have been scraped by earlier runs, which aren't fetched again.
+            dropped: List to append url_hash() of near-duplicates which are left out of the result to.
+        """
+        started = time.perf_counter()
+        async with self.fetcher() as fetcher:
+            searches = await asyncio.gather(
+                *[self.search_results(fetcher, s_path, str(query), tbs) for query in queries], return_exceptions=True
+            )
+            seen = set(skip_hashes or ())
+            skipped = 0
+            pages = []
+            for query, searched in zip(queries, searches):
+                if isinstance(searched, Exception):
+                    print(f"Failed to search {query}, err: {searched!r}")
+                    continue
+                results, abbr = searched
+                for result in results:
+                    link = result.get('link')
+                    if link is None or url_hash(link) in seen:
+                        skipped += int(link is not None)
+                        continue
+                    seen.add(url_hash(link))
+                    print('\n'.join([
+                        f"Title: {result.get('title')}", f"Link: {link}",
+                        f"Snippet: {result.get('snippet')}", "\n-----------------"
+                    ]))
+                    pages.append((result, abbr))
+
+            scraped = await asyncio.gather(
+                *[self.ascrape_page(fetcher, result, abbr) for result, abbr in pages], return_exceptions=True
+            )
+
+        srs = []
+        for (result, _), sr in zip(pages, scraped):
+            if isinstance(sr, Exception):
+                print(f"Failed to scrape {result.get('link')}, err: {sr!r}")
+            else:
+                srs.append(sr)
+        # Near-duplicates of a page of this run or of earlier runs are saved once
+        originals = set(skip_hashes or ()) | {sr["url_hash"] for sr in srs}
+        n_scraped = len(srs)
+        if dropped is not None:
+            dropped.extend(sr["url_hash"] for sr in srs if sr.get("duplicate_of") in originals)
+        srs = [sr for sr in srs if sr.get("duplicate_of") is None or sr["duplicate_of"] not in originals]
+        elapsed = time.perf_counter() - started
+        print(f"Scraped {n_scraped}/{len(pages)} pages of {len(queries)} queries in {elapsed:.2f}s, {skipped} seen, "
+              f"{n_scraped - len(srs)} near-duplicates, cache: {self.cache.counters if self.cache else None}, "
+              f"extracts: {self.extract_stats}, stages: {json.dumps(self.timer.summary())}")
         return srs
 
     # Function to search Google News
@@ -127,6 +235,36 @@ class GoogleSearch:
         s_path = "/search"
         return self.search_engine(s_path, query)
 
+    def search_new(self, s_path, queries, scrape_cursor: dict=None) -> tuple[list, dict]:
+        """
+        Incremental search_many(), pages scraped by earlier runs are skipped by their url_hash() in the cursor of the
+        job, and results are limited to the past hour when the last run was within an hour.
+        Returns:
+            New pages, and the cursor to persist once they're saved.
+        """
+        c = dict(scrape_cursor or {})
+        hashes = c.get("url_hashes") or []
+        last_run_at = c.get("last_run_at")
+        now = datetime.datetime.now(datetime.UTC)
+        recent = last_run_at is not None \
+            and now - datetime.datetime.fromisoformat(last_run_at) < datetime.timedelta(hours=1)
+        dropped = []
+        srs = self.search_many(
+            s_path, queries, skip_hashes=set(hashes), tbs="qdr:h" if recent else "qdr:d", dropped=dropped
+        )
+        # Newest first, the oldest hashes are dropped beyond JOB_CURSOR_MAX_URLS. Near-duplicates left out are kept
+        # too, so they aren't validated and looked up again by the next runs
+        c["url_hashes"] = ([sr["url_hash"] for sr in srs] + dropped + hashes)[:JOB_CURSOR_MAX_URLS]
+        c["last_run_at"] = now.isoformat()
+        return srs, c
+
+    # Function to search Google News for all keywords
+    def search_g_news_all(self, queries):
+        return self.search_many("/news", queries)
+
+    # Function to search Google Search for all keywords
+    def search_g_engine_all(self, queries):
+        return self.search_many("/search", queries)
 
 
 
@@ -0,0 +1,236 @@
+import os
+import re
+import time
+from html.parser import HTMLParser
+
+
+# Pages are cut to EXTRACT_MAX_HTML_BYTES (default 2MB) before parsing and text to EXTRACT_MAX_CHARS (default 20000)
+MAX_HTML_BYTES = int(os.getenv("EXTRACT_MAX_HTML_BYTES") or 2 * 1024 * 1024)
+MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS") or 20000)
+# The fast path falls back to unstructured when it finds less text than this, e.g. on pages it can't make sense of
+MIN_CHARS = int(os.getenv("EXTRACT_MIN_CHARS") or 200)
+
+# Elements whose content is never part of the article
+SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "canvas", "iframe", "form", "button", "select",
+             "nav", "aside", "menu", "dialog"}
+# Page header and footer, but the header of an article holds its headline, so only skipped outside CONTENT_TAGS
+CHROME_TAGS = {"header", "footer"}
+# Elements which hold the article, never skipped by their class/id, which often names the layout around it
+CONTENT_TAGS = {"main", "article"}
+PAGE_TAGS = {"html", "body"} | CONTENT_TAGS
+# Elements which start a new block of text
+BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "ul", "ol", "table", "tr", "td", "th", "blockquote",
+              "pre", "h1", "h2", "h3", "h4", "h5", "h6", "br", "hr", "figcaption", "dd", "dt"}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+# Elements which never have an end tag
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+# Classes/ids of containers of boilerplate
+BOILERPLATE_ATTR_RE = re.compile(
+    r"(^|[\s_-])(nav|menu|footer|header|sidebar|cookie|consent|banner|share|social|related|comment|subscribe|"
+    r"newsletter|promo|advert|ads?)([\s_-]|$)",
+    re.IGNORECASE,
+)
+# Short blocks of boilerplate text
+BOILERPLATE_TEXT_RE = re.compile(
+    r"cookie|subscribe|sign up|sign in|log in|all rights reserved|privacy policy|terms of (use|service)|"
+    r"advertisement|share this|follow us|read more",
+    re.IGNORECASE,
+)
+_SPACE_RE = re.compile(r"\s+")
+
+
+class _TextParser(HTMLParser):
+    """
+    Collect blocks of text from the body, skipping SKIP_TAGS, header/footer of the page and containers whose
+    class/id looks like boilerplate.
+    Each block is (text, characters inside links, heading or not).
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self._skip = []
+        self._text = []
+        self._link_chars = 0
+        self._in_link = 0
+        self._heading = False
+        self._in_content = 0
+
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip:
+            if tag not in VOID_TAGS:
+                self._skip.append(tag)
+            return
+        if self._is_boilerplate(tag, dict(attrs)):
+            if tag not in VOID_TAGS:
+                self._flush()
+                self._skip.append(tag)
+            return
+        if tag in CONTENT_TAGS:
+            self._in_content += 1
+        if tag in BLOCK_TAGS:
+            self._flush()
+            self._heading = tag in HEADING_TAGS
+        elif tag == "a":
+            self._in_link += 1
+
+
+    def handle_endtag(self, tag):
+        if self._skip:
+            # Tolerate unclosed children by unwinding to the matching start tag
+            if tag in self._skip:
+                while self._skip and self._skip.pop() != tag:
+                    pass
+            return
+        if tag in CONTENT_TAGS and self._in_content > 0:
+            self._in_content -= 1
+        if tag in BLOCK_TAGS:
+            self._flush()
+        elif tag == "a" and self._in_link > 0:
+            self._in_link -= 1
+
+
+    def _is_boilerplate(self, tag, attrs: dict) -> bool:
+        if tag in SKIP_TAGS:
+            return True
+        if tag in CHROME_TAGS:
+            return self._in_content == 0
+        if tag in PAGE_TAGS:
+            return False
+        return BOILERPLATE_ATTR_RE.search(f"{attrs.get('class') or ''} {attrs.get('id') or ''}") is not None \
+            or attrs.get("role") in ("navigation", "banner", "contentinfo") or attrs.get("aria-hidden") == "true"
+
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        self._text.append(data)
+        if self._in_link > 0:
+            self._link_chars += len(data.strip())
+
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+    def _flush(self):
+        text = _SPACE_RE.sub(" ", "".join(self._text)).strip()
+        if text:
+            self.blocks.append((text, self._link_chars, self._heading))
+        self._text = []
+        self._link_chars = 0
+        self._heading = False
+
+
+def is_boilerplate(text: str, link_chars: int, heading: bool) -> bool:
+    if len(text) == 0 or link_chars / len(text) > 0.5:
+        return True
+    words = len(text.split())
+    if heading:
+        return False
+    return words < 4 or (words < 20 and BOILERPLATE_TEXT_RE.search(text) is not None)
+
+
+def fast_extract(html: str) -> str:
+    """
+    Text of the article of a page by the standard library HTML parser: blocks of navigation, links and boilerplate
+    are dropped, as are repeated blocks.
+    """
+    parser = _TextParser()
+    parser.feed(html)
+    parser.close()
+    seen = set()
+    blocks = []
+    for text, link_chars, heading in parser.blocks:
+        if is_boilerplate(text, link_chars, heading) or text in seen:
+            continue
+        seen.add(text)
+        blocks.append(text)
+    return "\n\n".join(blocks)
+
+
+def unstructured_extract(html: str) -> str:
+    """
+    Text of a page, elements partitioned by unstructured are joined by blank lines.
+    """
+    from unstructured.partition.html import partition_html
+
+    elements = partition_html(text=html)
+    return "\n\n".join([str(el) for el in elements])
+
+
+def cap_text(text: str, max_chars: int) -> tuple[str, bool]:
+    if len(text) <= max_chars:
+        return text, False
+    cut = text.rfind("\n\n", 0, max_chars)
+    return text[:cut if cut > max_chars // 2 else max_chars].rstrip(), True
+
+
+def extract_text(html: str) -> dict:
+    """
+    Extraction stage of a scraped page, runs in worker processes of AsyncFetcher.run_cpu(), so it's a module-level
+    function: the page is cut to MAX_HTML_BYTES, extracted by fast_extract() or, when it finds less than MIN_CHARS,
+    by unstructured, and the text is cut to MAX_CHARS at a paragraph.
+    Returns:
+        content, method (fast or unstructured), parse_ms, html_bytes and whether the page or text was truncated.
+    """
+    started = time.perf_counter()
+    html = html or ""
+    html_bytes = len(html.encode("utf-8", errors="ignore"))
+    truncated = html_bytes > MAX_HTML_BYTES
+    if truncated:
+        html = html.encode("utf-8", errors="ignore")[:MAX_HTML_BYTES].decode("utf-8", errors="ignore")
+    method = "fast"
+    try:
+        content = fast_extract(html)
+    except Exception as e:
+        print(f"Fast extraction failed, err: {e!r}")
+        content = ""
+    if len(content) < MIN_CHARS:
+        try:
+            fallback = unstructured_extract(html)
+            if len(fallback) > len(content):
+                content, method = fallback, "unstructured"
+        except Exception as e:
+            print(f"Failed to partition page, err: {e!r}")
+    content, cut = cap_text(content, MAX_CHARS)
+    return {
+        "content": content,
+        "method": method,
+        "parse_ms": round((time.perf_counter() - started) * 1000, 2),
+        "html_bytes": html_bytes,
+        "truncated": truncated or cut,
+    }
+
+
+def bench_extract(pages=200, paragraphs=60, workers=None):
+    """
+    Extract synthetic article pages inline and on a process pool, prints pages/s of both.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    nav = "".join(f'<li><a href="/s{i}">Section {i}</a></li>' for i in range(40))
+    body = "".join(
+        f"<p>Paragraph {i} of the article says the launch event drew mixed reactions from reviewers and buyers "
+        f"alike, with <a href='/x'>a link</a> in the middle of the text.</p>" for i in range(paragraphs)
+    )
+    html = (f"<html><head><script>var x = 1;</script><style>p {{}}</style></head><body><nav><ul>{nav}</ul></nav>"
+            f"<div class='cookie-banner'>We use cookies</div><article><h1>Headline</h1>{body}</article>"
+            f"<footer>All rights reserved</footer></body></html>")
+
+    started = time.perf_counter()
+    results = [extract_text(html) for _ in range(pages)]
+    inline = time.perf_counter() - started
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(extract_text, [html] * 4))
+        started = time.perf_counter()
+        list(pool.map(extract_text, [html] * pages, chunksize=4))
+        pooled = time.perf_counter() - started
+    r = results[0]
+    print(f"{len(html)} bytes -> {len(r['content'])} chars by {r['method']} in {r['parse_ms']}ms, "
+          f"inline {pages / inline:.0f} pages/s, process pool {pages / pooled:.0f} pages/s ({os.cpu_count()} CPUs)")
+
+
+if __name__ == "__main__":
+    bench_extract(pages=int(os.getenv("BENCH_PAGES") or 200))
@@ -0,0 +1,42 @@
+import time
+import threading
+
+
+class RateLimiter():
+    """
+    A thread-safe token bucket, acquire() blocks until a token is available.
+    When the remote side reports its limit is exhausted, pause() holds every caller until the window resets.
+    """
+    def __init__(self, rate_per_sec: float, burst: int=None):
+        self.rate = rate_per_sec
+        self.capacity = burst or max(1, int(rate_per_sec))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait_for = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+    def pause(self, seconds: float):
+        """
+        Hand out no tokens for the next seconds, the bucket starts empty afterwards.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.updated_at = self.paused_until
@@ -0,0 +1,45 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class StageTimer():
+    """
+    Thread-safe timing of pipeline stages, per stage: number of calls, total and max seconds spent in calls, and wall
+    seconds from the first call started to the last one finished, which is less than total when calls overlap.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+
+    @contextmanager
+    def time(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            elapsed = finished - started
+            with self._lock:
+                st = self._stages.setdefault(
+                    stage, {"count": 0, "total": 0.0, "max": 0.0, "first": started, "last": finished}
+                )
+                st["count"] += 1
+                st["total"] += elapsed
+                st["max"] = max(st["max"], elapsed)
+                st["first"] = min(st["first"], started)
+                st["last"] = max(st["last"], finished)
+
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                stage: {
+                    "count": st["count"],
+                    "total": round(st["total"], 3),
+                    "max": round(st["max"], 3),
+                    "wall": round(st["last"] - st["first"], 3),
+                }
+                for stage, st in self._stages.items()
+            }
@@ -1,9 +1,63 @@
 import os
 import time
 import datetime
+import threading
 import tweepy
 from shared.db.sql_cn import SqlCN
 from shared.db.tb_posts import PostType
+from tools.rate_limit import RateLimiter
+
+
+TWEET_FIELDS = ["created_at", "public_metrics", "author_id"]
+
+# Recent search allows 450 requests per 15 minutes with an app bearer token
+TWITTER_RATE_LIMIT = float(os.getenv("TWITTER_RATE_LIMIT") or 450 / 900)
+TWITTER_RATE_BURST = int(os.getenv("TWITTER_RATE_BURST") or 5)
+# Longest wait for a rate limit window to reset, a search gives up beyond it
+TWITTER_MAX_WAIT = int(os.getenv("TWITTER_MAX_WAIT") or 120)
+# Recent search only takes since_id of the last 7 days, a cursor is restarted an hour before
+TWITTER_SEARCH_WINDOW = datetime.timedelta(days=7) - datetime.timedelta(hours=1)
+# Epoch of tweet ids (snowflakes) in milliseconds
+TWITTER_EPOCH_MS = 1288834974657
+
+_lock = threading.Lock()
+_clients = {}
+_limiter = RateLimiter(TWITTER_RATE_LIMIT, burst=TWITTER_RATE_BURST)
+
+
+def twitter_client(bearer_token) -> tweepy.Client:
+    """
+    Process-wide client per bearer token, so its HTTP session is reused across searches.
+    """
+    with _lock:
+        if bearer_token not in _clients:
+            _clients[bearer_token] = tweepy.Client(bearer_token=bearer_token, wait_on_rate_limit=False)
+        return _clients[bearer_token]
+
+
+def tweet_time(tweet_id) -> datetime.datetime:
+    """
+    Time a tweet was posted at, from the timestamp in its id.
+    """
+    return datetime.datetime.fromtimestamp(((int(tweet_id) >> 22) + TWITTER_EPOCH_MS) / 1000, datetime.UTC)
+
+
+def tweet_record(twe) -> dict:
+    t = {
+        "post_id": f"tw-{twe.id}",
+        "user_id": str(twe.author_id) if twe.author_id is not None else None,
+        "content": [twe.text],
+        "content_summary": twe.text,
+        "scraped_at": datetime.datetime.now(datetime.UTC),
+        "created_at": twe.created_at or datetime.datetime.now(datetime.UTC),
+    }
+    metrics = twe.public_metrics
+    if metrics is not None:
+        t["likes"] = metrics['like_count']
+        t["shares"] = metrics['retweet_count']
+        t["comments"] = metrics['reply_count']
+    return t
+
 
 class TweetsScraper:
 
@@ -14,64 +68,151 @@ class TweetsScraper:
         self.consumer_secret = consumer_secret
         self.access_token = access_token
         self.access_token_secret = access_token_secret
+        self.limiter = _limiter
+
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call the API within the rate limit, when it's exhausted anyway wait for the window of the response to reset
+        and try once more.
+        """
+        for attempt in range(2):
+            self.limiter.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except tweepy.TooManyRequests as e:
+                reset_at = int(e.response.headers.get("x-rate-limit-reset") or 0)
+                wait_for = max(1, reset_at - time.time()) if reset_at > 0 else 60
+                if attempt > 0 or wait_for > TWITTER_MAX_WAIT:
+                    raise
+                print(f"Rate limited, wait {wait_for:.0f}s for the window to reset")
+                self.limiter.pause(wait_for)
 
     
     # Function to search tweets, One query(str) for matching Tweets. Up to 1024 characters.
     # query: https://developer.x.com/en/docs/x-api/tweets/search/integrate/build-a-query
-    def searh_tweets(self, query, next_token=None):
-        client = tweepy.Client(bearer_token=self.bearer_token, wait_on_rate_limit=False)
-
+    def searh_tweets(self, query, next_token=None, max_pages=10, page_size=100):
+        """
+        Search up to max_pages pages of page_size tweets (10 - 100), metrics and created_at of tweets come with the
+        search response, so each page takes one round trip.
+        """
         tss = []
-        # TODO: Come back later to process paginated tweets
-        # max_loop = 10 for now
-        for i in range(1, 11):
+        for response in self.search_pages(query, next_token=next_token, max_pages=max_pages, page_size=page_size):
+            tss.extend(self.page_records(response))
+        return tss
+
+
+    def search_pages(self, query, next_token=None, since_id=None, max_pages=10, page_size=100, strict=False):
+        """
+        Yield responses of up to max_pages pages, newest first, only tweets newer than since_id when given.
+        Errors end the search quietly, with strict a 400 of the first page is raised, e.g. for a since_id or
+        next_token the API doesn't take anymore.
+        """
+        client = twitter_client(self.bearer_token)
+        for i in range(max_pages):
             # https://docs.tweepy.org/en/stable/client.html#search-tweets
             try: 
-                response = client.search_recent_tweets(query, next_token=next_token)
-                print("------------------")
-                print(response.meta)
-                print("------------------")
+                started = time.perf_counter()
+                response = self.call(
+                    client.search_recent_tweets, query, next_token=next_token, since_id=since_id,
+                    max_results=page_size, tweet_fields=TWEET_FIELDS
+                )
+                print(f"page {i}: {response.meta} in {time.perf_counter() - started:.2f}s")
+            except tweepy.BadRequest as e:
+                if strict and i == 0:
+                    raise
+                print(e)
+                return
             except Exception as e:
                 print(e)
-                break
-            
-            ids = []
-            tsd = {}
-            if response.meta['result_count']!=0:
-                for twe in response.data:
-                    print(twe.id)
-                    print(twe.text)
-                    print("------------------")
-                    ids.append(twe.id)
-                    t = {
-                        "post_id": f"tw-{twe.id}",
-                        "content": [twe.text],
-                        "content_summary": twe.text,
-                        "scraped_at": datetime.datetime.now(datetime.UTC),
-                        "created_at": datetime.datetime.now(datetime.UTC),
-                    }
-                    tsd[twe.id] = t
-                
-                if response.meta['next_token'] is not None:
-                    next_token=response.meta['next_token']
-
-                # Tweet Respose: https://developer.x.com/en/docs/x-api/tweets/lookup/api-reference/get-tweets-id
-                try:
-                    for id in ids:
-                        tweet = client.get_tweet(ids, tweet_fields=["created_at", "public_metrics"])
-                        print(tweet)
-                        time.sleep(5)
-                        tsd[id]["likes"] = tweet.data.public_metrics['like_count']
-                        tsd[id]["shares"] = tweet.data.public_metrics['retweet_count']
-                        tsd[id]["comments"] = tweet.data.public_metrics['reply_count']
-                        tsd[id]["created_at"] = tweet.data.created_at
-                except Exception as e:
-                    print(e)
-                finally:
-                    print("An unexpected error occurred.")
-                for (k, v) in tsd.items():
-                    tss.append(v)
-        return tss
+                return
+            yield response
+
+            next_token = response.meta.get('next_token')
+            if next_token is None:
+                return
+
+
+    def page_records(self, response) -> list[dict]:
+        if response.meta['result_count']==0:
+            return []
+        tsd = {twe.id: tweet_record(twe) for twe in response.data}
+        self.hydrate(twitter_client(self.bearer_token), tsd)
+        return list(tsd.values())
+
+
+    def search_new_tweets(self, query, scrape_cursor: dict=None, max_pages=10, page_size=100) -> tuple[list, dict]:
+        """
+        Incremental search which only fetches tweets posted after the last run, resumed from the cursor of the job:
+            since_id: Newest tweet id of the runs have been completed, only newer tweets are searched.
+            next_token: Set when the last run stopped at max_pages, the run carries on from that page.
+            newest_id: Newest tweet id of the interrupted run, becomes since_id once its pages are done.
+            query: The cursor is only resumed for the same query.
+        A cursor older than the recent search window, or one the API rejects with a 400, is dropped and the search
+        starts over, so a quiet query or an expired next_token doesn't stop the job from collecting tweets.
+        Returns:
+            New tweets, and the cursor to persist for the next run.
+        """
+        c = dict(scrape_cursor or {})
+        if c.get("query") != query:
+            c = {"query": query}
+        oldest_id = c.get("since_id") or c.get("newest_id")
+        now = datetime.datetime.now(datetime.UTC)
+        if oldest_id is not None and now - tweet_time(oldest_id) > TWITTER_SEARCH_WINDOW:
+            print(f"Cursor of {tweet_time(oldest_id).isoformat()} is out of the recent search window, start over")
+            c = {"query": query}
+
+        try:
+            return self._search_from(query, c, max_pages, page_size)
+        except tweepy.BadRequest as e:
+            if c == {"query": query}:
+                print(e)
+                return [], c
+            print(f"Search from cursor {c} was rejected, start over, err: {e}")
+        c = {"query": query}
+        try:
+            return self._search_from(query, c, max_pages, page_size)
+        except tweepy.BadRequest as e:
+            print(e)
+            return [], c
+
+
+    def _search_from(self, query, c: dict, max_pages: int, page_size: int) -> tuple[list, dict]:
+        since_id, next_token, newest_id = c.get("since_id"), c.get("next_token"), c.get("newest_id")
+        tss = []
+        exhausted = False
+        for response in self.search_pages(query, next_token=next_token, since_id=since_id, max_pages=max_pages,
+                                          page_size=page_size, strict=True):
+            if newest_id is None:
+                newest_id = response.meta.get("newest_id")
+            tss.extend(self.page_records(response))
+            next_token = response.meta.get("next_token")
+            exhausted = next_token is None
+        if not exhausted and len(tss) == 0:
+            # The search failed before any page, resume from the same cursor next time
+            return tss, c
+
+        c = dict(c)
+        if exhausted:
+            c.update({"since_id": newest_id or since_id, "next_token": None, "newest_id": None})
+        else:
+            c.update({"since_id": since_id, "next_token": next_token, "newest_id": newest_id})
+        return tss, c
+
+    def hydrate(self, client, tsd: dict):
+        """
+        Fill in metrics of tweets the search returned without them, by one batched lookup of up to 100 ids.
+        """
+        # Tweet Respose: https://developer.x.com/en/docs/x-api/tweets/lookup/api-reference/get-tweets
+        ids = [id for id, t in tsd.items() if t.get("likes") is None]
+        if len(ids) == 0:
+            return
+        try:
+            response = self.call(client.get_tweets, ids[:100], tweet_fields=TWEET_FIELDS)
+            for twe in response.data or []:
+                tsd[twe.id].update({k: v for k, v in tweet_record(twe).items() if k not in ("post_id", "scraped_at")})
+        except Exception as e:
+            print(f"Failed to hydrate {len(ids)} tweets, err: {e}")
 
     def save_tweets(self, thread_id, platform_id, contents):
         if len(contents) > 0:
@@ -91,7 +232,8 @@ class TweetsScraper:
                     "scraped_at": v.get('scraped_at').isoformat(),
                 }
                 rows_to_insert.append(row)
-            self.sqlcn.posts.create_posts_in_batch(rows_to_insert)
+            return self.sqlcn.posts.create_posts_in_batch(rows_to_insert)
+        return None
 
 
 
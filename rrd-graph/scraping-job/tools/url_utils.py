@@ -0,0 +1,30 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+# Query parameters which only track where a link was clicked, dropped when URLs are compared
+TRACKING_PARAMS = ("utm_", "gclid", "fbclid", "ocid", "cmpid")
+
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a URL to dedup pages found by several keywords: lower-cased scheme and host, no fragment,
+    no tracking parameters and no trailing slash.
+    """
+    parts = urlsplit((url or "").strip())
+    query = urlencode([
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_PARAMS)
+    ])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/") or "/", query, ""))
+
+
+def url_hash(url: str) -> str:
+    """
+    Short hash of the normalized URL, small enough to keep thousands of them in the cursor of a job.
+    """
+    return hashlib.sha1(normalize_url(url).encode("utf-8")).hexdigest()[:16]
+
+
+def url_host(url: str) -> str:
+    return urlsplit(url or "").netloc.lower()
@@ -1,17 +1,141 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 from google.cloud import run_v2
 
-def get_google_cloud_run_service_url(project_id, location, service_name):
+from .cache import TTLCache
+
+
+# Resolved URLs are served for SERVICE_URL_TTL seconds (default 600) and refreshed in the background after half of it
+SERVICE_URL_TTL = int(os.getenv("SERVICE_URL_TTL") or 600)
+# Failed lookups are retried after this many seconds
+SERVICE_URL_NEGATIVE_TTL = 30
+
+_lock = threading.Lock()
+_resolve_lock = threading.Lock()
+_client = None
+_urls = TTLCache(ttl=SERVICE_URL_TTL, maxsize=64)
+_refreshing = set()
+_dispatcher = None
+
+
+def services_client() -> run_v2.ServicesClient:
+  """
+  Process-wide Cloud Run client, which keeps its channel and credentials across calls.
+  """
+  global _client
+  with _lock:
+    if _client is None:
+      _client = run_v2.ServicesClient()
+    return _client
+
+
+def resolve_service_url(project_id, location, service_name):
   try:
-    # Create a Cloud Run client
-    client = run_v2.ServicesClient()
     # Build the service name
     name = f"projects/{project_id}/locations/{location}/services/{service_name}"
     # Make the request
-    response = client.get_service(name=name)
-    print(response)
-    service_url = response.uri
-    return service_url
+    response = services_client().get_service(name=name)
+    return response.uri
   except Exception as e:
     print(f"Error getting Cloud Run service URL: {e}")
     return None
 
+
+def get_google_cloud_run_service_url(project_id, location, service_name):
+  """
+  Returns:
+    URL of the Cloud Run service, from the cache when it has been resolved within SERVICE_URL_TTL seconds, None if
+    the service can't be resolved.
+  """
+  key = (project_id, location, service_name)
+  entry = _urls.get(key)
+  if entry is not None:
+    service_url, resolved_at = entry
+    if service_url is not None and time.monotonic() - resolved_at > SERVICE_URL_TTL / 2:
+      _refresh_in_background(key)
+    return service_url
+  # Only one caller resolves a cold entry, the others wait and get its result
+  with _resolve_lock:
+    entry = _urls.get(key)
+    if entry is not None:
+      return entry[0]
+    return _refresh(key)
+
+
+def _refresh(key):
+  service_url = resolve_service_url(*key)
+  ttl = SERVICE_URL_TTL if service_url is not None else SERVICE_URL_NEGATIVE_TTL
+  _urls.set(key, (service_url, time.monotonic()), ttl=ttl)
+  return service_url
+
+
+def _refresh_in_background(key):
+  with _lock:
+    if key in _refreshing:
+      return
+    _refreshing.add(key)
+
+  def run():
+    try:
+      _refresh(key)
+    finally:
+      with _lock:
+        _refreshing.discard(key)
+  threading.Thread(target=run, name="c-run-refresh", daemon=True).start()
+
+
+class TriggerDispatcher():
+  """
+  Fire-and-forget GET requests on a pooled HTTP session, sent from a small thread pool so the caller never waits
+  for discovery, connection or response. A URL already waiting to be sent isn't queued again.
+  """
+  def __init__(self, max_workers=4):
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=max_workers)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    # Threads of the pool are joined at interpreter exit, so triggers of short-lived jobs are still sent
+    self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="trigger")
+    self._pending = set()
+    self._lock = threading.Lock()
+
+
+  def trigger(self, project_id, location, service_name, path, timeout=2, default_url="http://localhost:8000"):
+    key = (project_id, location, service_name, path)
+    with self._lock:
+      if key in self._pending:
+        return None
+      self._pending.add(key)
+    return self.pool.submit(self._send, key, timeout, default_url)
+
+
+  def _send(self, key, timeout, default_url):
+    try:
+      with self._lock:
+        self._pending.discard(key)
+      project_id, location, service_name, path = key
+      s_url = get_google_cloud_run_service_url(project_id=project_id, location=location, service_name=service_name)
+      if s_url is None:
+        s_url = default_url
+      print(f"Trigger {s_url}{path}")
+      # The triggered handler runs long, only wait for the request to be delivered
+      self.session.get(f"{s_url}{path}", timeout=(5, timeout))
+    except requests.exceptions.ReadTimeout:
+      pass
+    except Exception as e:
+      print(f"Failed to trigger {key}, err: {e}")
+
+
+def trigger_service(project_id, location, service_name, path, timeout=2):
+  """
+  Send GET <service url><path> in the background and return immediately.
+  """
+  global _dispatcher
+  with _lock:
+    if _dispatcher is None:
+      _dispatcher = TriggerDispatcher()
+  return _dispatcher.trigger(project_id, location, service_name, path, timeout=timeout)
@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache():
+    """
+    A thread-safe, bounded LRU cache, entries are expired after ttl seconds.
+    """
+    def __init__(self, ttl: float=30, maxsize: int=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+
+    def set(self, key, value, ttl: float=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+    def add(self, key, value, ttl: float=None) -> bool:
+        """
+        Set the key only if it's not cached yet.
+        Returns:
+            True if the key has been added, False if a live entry already exists.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] >= time.monotonic():
+                return False
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,62 @@
+import time
+import sqlalchemy
+from sqlalchemy import Table
+
+
+# Seconds missing columns are remembered by AddedColumns before they're looked up again
+RECHECK_SECONDS = 60
+
+
+class AddedColumns():
+    """
+    Columns migration.py adds to a table of the initial schema. Until they're added, select(table) and writes of them
+    fail, so table classes select columns() and write values through values() instead. Like
+    SentimentRollup.available(), columns once found are remembered, missing ones for RECHECK_SECONDS.
+    """
+    def __init__(self, engine: sqlalchemy.engine.Engine, table: Table, names: list[str]):
+        self.engine = engine
+        self.table = table
+        self.names = list(names)
+        self._present = set()
+        self._checked_at = None
+
+
+    def missing(self) -> set:
+        """
+        Names of the added columns which don't exist yet.
+        """
+        if len(self._present) == len(self.names):
+            return set()
+        if self._checked_at is not None and time.monotonic() - self._checked_at < RECHECK_SECONDS:
+            return set(self.names) - self._present
+        stmt = sqlalchemy.text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = :table AND column_name = ANY(:names)
+        """)
+        try:
+            with self.engine.connect() as conn:
+                self._present = set(conn.execute(stmt, {"table": self.table.name, "names": self.names}).scalars())
+        except Exception as e:
+            print(e)
+            return set(self.names) - self._present
+        self._checked_at = time.monotonic()
+        missing = set(self.names) - self._present
+        if len(missing) > 0:
+            print(f"Columns {sorted(missing)} of {self.table.name} don't exist, run shared/db/migration.py to add them")
+        return missing
+
+
+    def columns(self) -> list:
+        """
+        Columns of the table to select, a missing one is selected as NULL under its name.
+        """
+        missing = self.missing()
+        return [sqlalchemy.null().label(c.name) if c.name in missing else c for c in self.table.c]
+
+
+    def values(self, values: dict) -> dict:
+        """
+        Values to write, without those of missing columns.
+        """
+        missing = self.missing()
+        return {k: v for k, v in values.items() if k not in missing}
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import random
+import bisect
+import logging
+import threading
+import sqlalchemy
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+
+# Statement echo of the table classes, off unless SQL_ECHO=true
+ECHO = (os.getenv("SQL_ECHO") or "false").lower() == "true"
+
+# Upper bounds in milliseconds of latency histogram buckets, the last bucket is open ended
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+def echo(*args):
+    """
+    Print statements and diagnostics of table classes only when SQL_ECHO is enabled.
+    """
+    if ECHO:
+        print(*args)
+
+
+class _TimedCheckout():
+    """
+    Record how long a checkout waited for a connection on the connection record, the wait is reported with the next
+    query executed on the connection.
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        rec = super()._do_get()
+        rec.info["rrd_pool_wait_ms"] = (time.perf_counter() - started) * 1000
+        return rec
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    """
+    QueuePool of SqlCN with the checkout wait recorded.
+    """
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool of AsyncSqlCN with the checkout wait recorded.
+    """
+
+
+class LogSink():
+    """
+    Emit every sampled query as one JSON log line.
+    """
+    def __init__(self, logger: logging.Logger=None):
+        self.logger = logger or logging.getLogger("rrd.sql")
+
+    def emit(self, record: dict):
+        self.logger.info(json.dumps(record))
+
+
+class StatsSink():
+    """
+    Aggregate sampled queries in process: latency histogram, row count and pool wait per query name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def emit(self, record: dict):
+        with self._lock:
+            st = self._stats.get(record["query"])
+            if st is None:
+                st = {"count": 0, "rows": 0, "total_ms": 0.0, "pool_wait_ms": 0.0, "errors": 0,
+                      "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+                self._stats[record["query"]] = st
+            st["count"] += 1
+            st["rows"] += max(record.get("rows") or 0, 0)
+            st["total_ms"] += record["ms"]
+            st["pool_wait_ms"] += record.get("pool_wait_ms") or 0.0
+            st["errors"] += 1 if record.get("error") else 0
+            st["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, record["ms"])] += 1
+
+    def snapshot(self, reset: bool=False) -> dict:
+        """
+        Returns:
+            Per query name: count, rows, errors, mean/p50/p95/p99 latency and mean pool wait in milliseconds,
+            percentiles are upper bounds of the histogram bucket.
+        """
+        with self._lock:
+            stats = {k: {**v, "buckets": list(v["buckets"])} for k, v in self._stats.items()}
+            if reset:
+                self._stats = {}
+        report = {}
+        for name, st in stats.items():
+            report[name] = {
+                "count": st["count"],
+                "rows": st["rows"],
+                "errors": st["errors"],
+                "mean_ms": st["total_ms"] / st["count"],
+                "p50_ms": self._percentile(st["buckets"], st["count"], 0.50),
+                "p95_ms": self._percentile(st["buckets"], st["count"], 0.95),
+                "p99_ms": self._percentile(st["buckets"], st["count"], 0.99),
+                "pool_wait_mean_ms": st["pool_wait_ms"] / st["count"],
+                "histogram": dict(zip([f"le_{b}" for b in LATENCY_BUCKETS_MS] + ["inf"], st["buckets"])),
+            }
+        return report
+
+    def _percentile(self, buckets: list, count: int, q: float) -> float:
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= q * count:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float("inf")
+        return float("inf")
+
+
+class QueryInstrument():
+    """
+    Time queries of an engine with SQLAlchemy cursor events and emit sampled records to pluggable sinks, a sink is
+    anything with emit(record: dict). A record looks like:
+        {"query": "Post.claim_pending_posts", "ms": 3.2, "rows": 100, "pool_wait_ms": 0.1, "error": None}
+    The query name is the table class method which runs the statement, otherwise the SQL verb.
+    """
+    def __init__(self, engine: sqlalchemy.engine.Engine, sample_rate: float=1.0, sinks: list=None):
+        self.engine = engine
+        self.sample_rate = sample_rate
+        self.sinks = sinks if sinks is not None else [StatsSink()]
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self._before)
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self._after)
+        sqlalchemy.event.listen(engine, "handle_error", self._error)
+
+
+    @property
+    def stats(self) -> StatsSink:
+        return next((s for s in self.sinks if isinstance(s, StatsSink)), None)
+
+
+    def snapshot(self, reset: bool=False) -> dict:
+        """
+        Report of the StatsSink, see StatsSink.snapshot(), empty without one.
+        """
+        return self.stats.snapshot(reset=reset) if self.stats is not None else {}
+
+
+    def start_reporter(self, interval: float):
+        """
+        Print the snapshot as one JSON line every interval seconds, on a daemon thread, so it lands in the service log.
+        """
+        self._stop_reporter = threading.Event()
+
+        def report(stop: threading.Event):
+            while not stop.wait(interval):
+                snapshot = self.snapshot()
+                if len(snapshot) > 0:
+                    print(json.dumps({"sql_stats": snapshot}))
+
+        threading.Thread(target=report, args=(self._stop_reporter,), name="sql-stats", daemon=True).start()
+
+
+    def remove(self):
+        if getattr(self, "_stop_reporter", None) is not None:
+            self._stop_reporter.set()
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", self._before)
+        sqlalchemy.event.remove(self.engine, "after_cursor_execute", self._after)
+        sqlalchemy.event.remove(self.engine, "handle_error", self._error)
+
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        pool_wait_ms = conn.connection.info.pop("rrd_pool_wait_ms", None)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            conn.info.pop("rrd_query", None)
+            return
+        conn.info["rrd_query"] = (time.perf_counter(), self._query_name(statement), pool_wait_ms)
+
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("rrd_query", None)
+        if started is not None:
+            self._emit(started, cursor.rowcount, None)
+
+
+    def _error(self, exception_context):
+        conn = exception_context.connection
+        started = conn.info.pop("rrd_query", None) if conn is not None else None
+        if started is not None:
+            self._emit(started, None, type(exception_context.original_exception).__name__)
+
+
+    def _emit(self, started: tuple, rows: int, error: str):
+        record = {
+            "query": started[1],
+            "ms": (time.perf_counter() - started[0]) * 1000,
+            "rows": rows,
+            "pool_wait_ms": started[2],
+            "error": error,
+        }
+        for sink in self.sinks:
+            try:
+                sink.emit(record)
+            except Exception as e:
+                print(f"Failed to emit query record to {sink}, err: {e}")
+
+
+    def _query_name(self, statement: str) -> str:
+        # Walk up to the table class method which runs the statement, e.g. Post.claim_pending_posts
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = os.path.basename(frame.f_code.co_filename)
+            if filename.startswith("tb_") or filename == "migration.py":
+                owner = frame.f_locals.get("self")
+                return f"{type(owner).__name__}.{frame.f_code.co_name}" if owner is not None else frame.f_code.co_name
+            frame = frame.f_back
+        return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+
+
+def instrument_from_env(engine: sqlalchemy.engine.Engine) -> QueryInstrument:
+    """
+    Attach a QueryInstrument configured by SQL_SAMPLE_RATE (default 0.1) and SQL_METRICS_SINK, a comma separated list
+    of: stats (default), log. With SQL_STATS_INTERVAL (seconds, default 300, 0 is off) the stats are logged
+    periodically, the analysis service also serves them on /sql-stats.
+    """
+    sinks = []
+    for name in (os.getenv("SQL_METRICS_SINK") or "stats").split(","):
+        if name.strip() == "stats":
+            sinks.append(StatsSink())
+        elif name.strip() == "log":
+            sinks.append(LogSink())
+    instrument = QueryInstrument(engine, sample_rate=float(os.getenv("SQL_SAMPLE_RATE") or 0.1), sinks=sinks)
+    interval = float(os.getenv("SQL_STATS_INTERVAL") or 300)
+    if interval > 0 and instrument.stats is not None:
+        instrument.start_reporter(interval)
+    return instrument
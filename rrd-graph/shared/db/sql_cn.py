@@ -6,11 +6,14 @@ from dotenv import load_dotenv
 from google.cloud.alloydb.connector import Connector, IPTypes
 from google.auth import default, transport
 
+from .instrument import TimedQueuePool, instrument_from_env
 from .tb_jobs import Job
 from .tb_marked_blob import MarkedBlob
+from .tb_page_extract import PageExtract
 from .tb_platforms import Platform
 from .tb_playbook import Playbook
 from .tb_posts import Post
+from .tb_sentiment_rollup import SentimentRollup
 from .tb_sentiment_summary import SentimentSummary
 from .tb_threads import Thread
 
@@ -45,12 +48,16 @@ class SqlCN():
             password=password, 
             db=db
         )
+        # Sampled query timing, see instrument.py for SQL_SAMPLE_RATE, SQL_METRICS_SINK and SQL_ECHO
+        self.instrument = instrument_from_env(self.engine)
         self.jobs = Job(self.engine)
         self.marked_blobs = MarkedBlob(self.engine)
+        self.page_extracts = PageExtract(self.engine)
         self.platforms = Platform(self.engine)
         self.playbooks = Playbook(self.engine)
-        self.posts = Post(self.engine)
-        self.sentiment_summaries = SentimentSummary(self.engine)
+        self.sentiment_rollups = SentimentRollup(self.engine)
+        self.posts = Post(self.engine, rollup=self.sentiment_rollups)
+        self.sentiment_summaries = SentimentSummary(self.engine, rollup=self.sentiment_rollups)
         self.threads = Thread(self.engine)
 
 
@@ -94,6 +101,7 @@ class SqlCN():
         engine = sqlalchemy.create_engine(
             "postgresql+pg8000://",
             creator=getconn,
+            poolclass=TimedQueuePool,
             pool_size=40,
             max_overflow=10,
             pool_recycle=1800,
@@ -1,9 +1,15 @@
+import os
+import time
 import pg8000
 import sqlalchemy
-from sqlalchemy import insert, select, update
+from sqlalchemy import insert, select, update, delete
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import datetime
 from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP
 
+from ..cache import TTLCache
+from .instrument import echo
+
 
 
 class MarkedBlob():
@@ -16,6 +22,12 @@ class MarkedBlob():
             Column("ops_id", String),
             Column("created_at", TIMESTAMP, nullable=False),
         )
+        # Recently claimed blob names, redelivered events are rejected here without a round trip
+        self.seen = TTLCache(ttl=int(os.getenv("MARKED_BLOB_CACHE_TTL") or 3600), maxsize=10000)
+        # Marks older than this are deleted by cleanup_marks(), which claim_blob() runs at most once per interval
+        self.retention = datetime.timedelta(days=int(os.getenv("MARKED_BLOB_RETENTION_DAYS") or 7))
+        self.cleanup_interval = 3600
+        self.cleaned_at = 0
 
     # def __del__(self):
     #     print("__del__")
@@ -33,7 +45,7 @@ class MarkedBlob():
             stmt = (
                 insert(self.table).values(mb)
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -43,7 +55,7 @@ class MarkedBlob():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
@@ -51,12 +63,66 @@ class MarkedBlob():
             return None
     
 
+    def claim_blob(self, blob_name:str, ops_id:str=None)->bool:
+        """
+        Atomically mark the blob as processing, with INSERT ... ON CONFLICT DO NOTHING RETURNING.
+        Returns:
+            True if this call claimed the blob, False if it has been claimed before, None on database error.
+        """
+        if not self.seen.add(blob_name, True):
+            return False
+        stmt = (
+            pg_insert(self.table)
+                .values(blob_name=blob_name, ops_id=ops_id,
+                        created_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None))
+                .on_conflict_do_nothing(index_elements=[self.table.c.blob_name])
+                .returning(self.table.c.blob_name)
+        )
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                r = conn.execute(stmt).fetchone()
+                conn.commit()
+        except Exception as e:
+            print(e)
+            # Let a redelivery try again
+            self.seen.pop(blob_name)
+            return None
+
+        if time.monotonic() - self.cleaned_at > self.cleanup_interval:
+            self.cleaned_at = time.monotonic()
+            self.cleanup_marks()
+        return r is not None
+
+
+    def cleanup_marks(self, retention:datetime.timedelta=None)->int:
+        """
+        Delete marks older than the retention, default MARKED_BLOB_RETENTION_DAYS or 7 days.
+        Returns:
+            Number of marks have been deleted.
+        """
+        cutoff = datetime.datetime.now(datetime.UTC).replace(tzinfo=None) - (retention or self.retention)
+        stmt = (
+            delete(self.table)
+                .where(self.table.c.created_at < cutoff)
+        )
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                r = conn.execute(stmt)
+                conn.commit()
+                return r.rowcount
+        except Exception as e:
+            print(e)
+        return None
+
+
     def marked_blob_by_name(self, blob_name:str)->dict:
         stmt = (
             select(self.table)
                 .where(self.table.c.blob_name == blob_name)
         )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt).fetchone()
@@ -67,7 +133,7 @@ class MarkedBlob():
         except Exception as e:
             print(e)
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return None
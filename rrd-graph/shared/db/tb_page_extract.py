@@ -0,0 +1,122 @@
+import pg8000
+import sqlalchemy
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import datetime
+from sqlalchemy import Table, Column, String, BigInteger, TIMESTAMP
+from .instrument import echo
+
+
+
+class PageExtract():
+    def __init__(self, engine: sqlalchemy.engine.Engine, table_name="page_extracts"):
+        self.engine = engine
+        self.table = Table(
+            table_name,
+            sqlalchemy.MetaData(),
+            Column("url_hash", String, primary_key=True, comment="""
+                Hash of the normalized URL of the page.
+            """),
+            Column("url", String, nullable=False, comment="""
+                URL of the page.
+            """),
+            Column("validator", String, comment="""
+                ETag or Last-Modified of the page when it was extracted, the extract is stale once they differ.
+            """),
+            Column("simhash", BigInteger, comment="""
+                64 bits SimHash of the content as signed integer, to find near-duplicate (syndicated) pages.
+            """),
+            Column("canonical_hash", String, comment="""
+                url_hash of the page this one is a near-duplicate of, content is only stored with that page.
+            """),
+            Column("content", String, comment="""
+                Text extracted from the page, NULL for a near-duplicate.
+            """),
+            Column("extracted_at", TIMESTAMP(timezone=True), nullable=False, comment="""
+                Time of the extraction.
+            """),
+            comment="""
+                The page_extracts table caches text extracted from scraped pages, so a page is only rendered and
+                partitioned again when it changed.
+            """
+        )
+
+
+    def extract_by(self, url_hashes: list[str]) -> dict:
+        """
+        Returns:
+            Extracts by url_hash, missing hashes are left out.
+        """
+        stmt = select(self.table).where(self.table.c.url_hash.in_(list(url_hashes)))
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(stmt).fetchall()
+            return {r.url_hash: r._asdict() for r in rows}
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+
+        return {}
+
+
+    def save_extract(self, extract: dict) -> bool:
+        extract["extracted_at"] = datetime.datetime.now(datetime.UTC)
+        stmt = (
+            pg_insert(self.table).values(extract)
+                .on_conflict_do_update(
+                    index_elements=[self.table.c.url_hash],
+                    set_={k: v for k, v in extract.items() if k != "url_hash"},
+                )
+        )
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(stmt)
+                conn.commit()
+            return True
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+
+        return False
+
+
+    def recent_simhashes(self, since: datetime.datetime, limit: int=10000) -> list[tuple[str, int]]:
+        """
+        Returns:
+            (url_hash, simhash) of pages with content extracted since the time, newest first.
+        """
+        stmt = (
+            select(self.table.c.url_hash, self.table.c.simhash)
+                .where(self.table.c.extracted_at >= since)
+                .where(self.table.c.canonical_hash.is_(None))
+                .where(self.table.c.simhash.is_not(None))
+                .order_by(self.table.c.extracted_at.desc())
+                .limit(limit)
+        )
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(stmt).fetchall()
+            return [(r.url_hash, r.simhash) for r in rows]
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+
+        return []
+
+
+
+if __name__ == "__main__":
+    pe = PageExtract(engine=None)
+    print(pe.table.metadata.tables)
@@ -5,6 +5,7 @@ from enum import Enum
 import datetime
 from sqlalchemy import insert, select, update
 from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP
+from .instrument import echo
 
 
 
@@ -56,7 +57,7 @@ class Platform():
             stmt = (
                 insert(self.table).values(pt)
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -66,7 +67,7 @@ class Platform():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
@@ -79,7 +80,7 @@ class Platform():
             select(self.table)
                 .where(self.table.c.platform_id == platform_id)
         )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt).fetchone()
@@ -88,7 +89,7 @@ class Platform():
             print(e)
             conn.rollback()
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return None
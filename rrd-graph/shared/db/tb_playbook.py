@@ -2,7 +2,9 @@ import pg8000
 import sqlalchemy
 from sqlalchemy import insert, select, update
 import datetime
-from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP, JSON
+from sqlalchemy import Table, Column, Integer, String, BigInteger, ARRAY, TIMESTAMP, JSON, Float
+from .columns import AddedColumns
+from .instrument import echo
 
 
 
@@ -33,8 +35,16 @@ class Playbook():
             Column("updated_at", TIMESTAMP, comment="""
                 Updated time of the playbook. 
             """),
+            Column("input_hash", String, comment="""
+                Hash of the inputs of the prompt which generated the playbook, see PromptBuilder.input_hash().
+            """),
+            Column("sentiment_level", Float, comment="""
+                Overall sentiment level when the playbook was generated.
+            """),
             comment="The table is to store playbook based latest sentiment level, when sentiment level changed and will generate a new playbook."
         )
+        # Added by migration.py, NULL until then
+        self.added_columns = AddedColumns(self.engine, self.table, ["input_hash", "sentiment_level"])
 
     # def __del__(self):
     #     print("__del__")
@@ -50,9 +60,9 @@ class Playbook():
         if bool(pb):
             pb["created_at"] = datetime.datetime.now(datetime.UTC).isoformat()
             stmt = (
-                insert(self.table).values(pb)
+                insert(self.table).values(self.added_columns.values(pb))
             )
-            print(stmt)
+            echo(stmt)
             try:
                 with self.engine.connect() as conn:
                     r = conn.execute(stmt)
@@ -62,7 +72,7 @@ class Playbook():
                 print(e)
                 conn.rollback()
             finally:
-                print("finally")
+                echo("finally")
                 conn.close()
                 
             return None
@@ -72,12 +82,12 @@ class Playbook():
 
     def last_playbook(self, thread_id:str)->dict:
         stmt = (
-            select(self.table)
+            select(*self.added_columns.columns())
                 .where(self.table.c.thread_id == int(thread_id))
                 .order_by(self.table.c.created_at.desc())
                 .limit(1)
         )
-        print(stmt)
+        echo(stmt)
         try:
             with self.engine.connect() as conn:
                 r = conn.execute(stmt).fetchone()
@@ -86,11 +96,42 @@ class Playbook():
             print(e)
             conn.rollback()
         finally:
-            print("finally")
+            echo("finally")
             conn.close()
             
         return None
 
+
+    def recent_playbook(self, thread_id:str, since:datetime.datetime, input_hash:str=None)->dict:
+        """
+        Returns:
+            The newest playbook of the thread created since the time, generated from the same inputs if input_hash
+            is given, None if there's no such playbook.
+        """
+        if input_hash is not None and "input_hash" in self.added_columns.missing():
+            return None
+        stmt = (
+            select(*self.added_columns.columns())
+                .where(self.table.c.thread_id == int(thread_id))
+                .where(self.table.c.created_at >= since)
+        )
+        if input_hash is not None:
+            stmt = stmt.where(self.table.c.input_hash == input_hash)
+        stmt = stmt.order_by(self.table.c.created_at.desc()).limit(1)
+        echo(stmt)
+        try:
+            with self.engine.connect() as conn:
+                r = conn.execute(stmt).fetchone()
+            return r._asdict() if r is not None else None
+        except Exception as e:
+            print(e)
+            conn.rollback()
+        finally:
+            echo("finally")
+            conn.close()
+
+        return None
+
         
     
 if __name__ == "__main__":
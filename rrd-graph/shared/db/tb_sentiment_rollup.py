@@ -0,0 +1,187 @@
+import pg8000
+import sqlalchemy
+from datetime import datetime, UTC
+from sqlalchemy import Table, Column, String, BigInteger, TIMESTAMP, Numeric
+import time
+
+
+
+# Width of a rollup bucket in seconds, must match the date_bin() width used by queries on this table.
+BUCKET_SECONDS = 60
+# Seconds a missing table is remembered by available() before it's looked up again
+AVAILABLE_RECHECK_SECONDS = 60
+
+# Sentiment level of a post, summed as numeric so sums are exact whatever order posts are added in, and a level from
+# the rollup is identical to one summed from posts, see SentimentSummary.calculate_sentiment_level().
+LEVEL_SQL = "((((0.7*sentiment_score + 0.3*sentiment_magnitude)+1)/2)*100)::numeric"
+
+
+def bucket_of(ts: datetime) -> datetime:
+    return datetime.fromtimestamp(int(ts.timestamp() // BUCKET_SECONDS) * BUCKET_SECONDS, UTC)
+
+
+def buckets_of(posts: list) -> set:
+    """
+    Buckets of analysed posts, rows with thread_id, platform_id, status and sentiment_at.
+    """
+    return {
+        (r.thread_id, r.platform_id, bucket_of(r.sentiment_at))
+        for r in posts if r.status in ("sentimented", "generated") and r.sentiment_at is not None
+    }
+
+
+class SentimentRollup():
+    def __init__(self, engine: sqlalchemy.engine.Engine, table_name="sentiment_rollup"):
+        self.engine = engine
+        # Set once the table has been found, see available()
+        self._available = False
+        self._missing_at = None
+        self.table = Table(
+            table_name,
+            sqlalchemy.MetaData(),
+            Column("thread_id", BigInteger, primary_key=True, comment="""
+                Unique identifier, acts as foreign key to threads table.
+            """),
+            Column("platform_id", String, primary_key=True, comment="""
+                Unique identifier, acts as foreign key to platforms table.
+            """),
+            Column("bucket_at", TIMESTAMP(timezone=True), primary_key=True, comment="""
+                Start of the time bucket by sentiment_at of posts, buckets are BUCKET_SECONDS wide.
+            """),
+            Column("level_sum", Numeric, nullable=False, comment="""
+                Sum of sentiment level of sentimented/generated posts in the bucket.
+            """),
+            Column("post_count", BigInteger, nullable=False, comment="""
+                Number of sentimented/generated posts in the bucket.
+            """),
+            comment="""
+                The sentiment_rollup table keeps a per-minute aggregate of analysed posts by thread and platform,
+                buckets changed by Post.save_sentiment_results() are recomputed from posts in its transaction.
+            """
+        )
+
+
+    def available(self, conn: sqlalchemy.engine.Connection=None) -> bool:
+        """
+        Whether the table exists, i.e. migration.py has been run. Until then Post.save_sentiment_results() skips the
+        rollup and SentimentSummary.calculate_sentiment_level() reads posts, the migration backfills the table when
+        it creates it. A found table is remembered, a missing one for AVAILABLE_RECHECK_SECONDS.
+        Args:
+            conn: Connection of the caller's transaction, a new connection if None.
+        """
+        if self._available:
+            return True
+        if self._missing_at is not None and time.monotonic() - self._missing_at < AVAILABLE_RECHECK_SECONDS:
+            return False
+        stmt = sqlalchemy.text("SELECT to_regclass(:name) IS NOT NULL")
+        try:
+            if conn is not None:
+                self._available = bool(conn.execute(stmt, {"name": self.table.name}).scalar())
+            else:
+                with self.engine.connect() as conn:
+                    self._available = bool(conn.execute(stmt, {"name": self.table.name}).scalar())
+        except Exception as e:
+            print(e)
+            return False
+        if not self._available:
+            self._missing_at = time.monotonic()
+            print(f"Table {self.table.name} doesn't exist, run shared/db/migration.py to create it")
+        return self._available
+
+
+    def refresh(self, conn: sqlalchemy.engine.Connection, buckets: set) -> int:
+        """
+        Recompute buckets from posts, on the caller's connection and transaction after it has updated the posts.
+        Buckets are locked first with transaction-level advisory locks, in order so writers don't deadlock, and
+        summed from posts by the next statement, whose snapshot then holds every write committed by earlier
+        holders of the locks. So concurrent writers of the same bucket can't leave it stale.
+        Args:
+            buckets: (thread_id, platform_id, bucket_at) of posts before and after the update.
+        Returns:
+            Number of buckets have been recomputed.
+        """
+        if len(buckets) == 0:
+            return 0
+        keys = sorted(f"{self.table.name}:{t}:{p}:{b.isoformat()}" for t, p, b in buckets)
+        conn.execute(sqlalchemy.text("""
+            SELECT pg_advisory_xact_lock(hashtextextended(k, 0))
+            FROM (SELECT unnest(CAST(:keys AS text[])) AS k ORDER BY 1) AS s
+        """), {"keys": keys})
+
+        thread_ids, platform_ids, bucket_ats = zip(*sorted(buckets))
+        conn.execute(sqlalchemy.text(f"""
+            WITH k AS (
+                SELECT * FROM unnest(
+                    CAST(:thread_ids AS bigint[]), CAST(:platform_ids AS text[]), CAST(:bucket_ats AS timestamptz[])
+                ) AS k (thread_id, platform_id, bucket_at)
+            ),
+            b AS (
+                SELECT
+                    k.thread_id,
+                    k.platform_id,
+                    k.bucket_at,
+                    COALESCE(SUM({LEVEL_SQL}), 0) AS level_sum,
+                    COUNT(p.post_id) AS post_count
+                FROM
+                    k
+                    LEFT JOIN posts p ON
+                        p.thread_id = k.thread_id
+                        AND p.platform_id = k.platform_id
+                        AND p.status IN ('sentimented', 'generated')
+                        AND p.sentiment_at >= k.bucket_at
+                        AND p.sentiment_at < k.bucket_at + INTERVAL '{BUCKET_SECONDS} seconds'
+                GROUP BY
+                    1, 2, 3
+            ),
+            upserted AS (
+                INSERT INTO {self.table.name} (thread_id, platform_id, bucket_at, level_sum, post_count)
+                SELECT * FROM b WHERE post_count > 0
+                ON CONFLICT (thread_id, platform_id, bucket_at) DO UPDATE
+                    SET level_sum = EXCLUDED.level_sum, post_count = EXCLUDED.post_count
+            )
+            DELETE FROM {self.table.name} r USING b
+            WHERE
+                r.thread_id = b.thread_id
+                AND r.platform_id = b.platform_id
+                AND r.bucket_at = b.bucket_at
+                AND b.post_count = 0
+        """), {"thread_ids": list(thread_ids), "platform_ids": list(platform_ids), "bucket_ats": list(bucket_ats)})
+        return len(buckets)
+
+
+    def rebuild(self, thread_id: str=None) -> int:
+        """
+        Recompute the rollup from posts, for the initial backfill or to repair drift, e.g. after posts were
+        changed outside of Post.save_sentiment_results().
+        """
+        cd = "" if thread_id is None else "AND thread_id = :thread_id"
+        params = {} if thread_id is None else {"thread_id": int(thread_id)}
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(sqlalchemy.text(f"DELETE FROM {self.table.name} WHERE TRUE {cd}"), params)
+                r = conn.execute(sqlalchemy.text(f"""
+                    INSERT INTO {self.table.name} (thread_id, platform_id, bucket_at, level_sum, post_count)
+                    SELECT
+                        thread_id,
+                        platform_id,
+                        date_bin(INTERVAL '{BUCKET_SECONDS} seconds', sentiment_at, TIMESTAMPTZ 'epoch') AS bucket_at,
+                        COALESCE(SUM({LEVEL_SQL}), 0),
+                        COUNT(*)
+                    FROM
+                        posts
+                    WHERE
+                        status IN ('sentimented', 'generated')
+                        AND sentiment_at IS NOT NULL
+                        {cd}
+                    GROUP BY
+                        1, 2, 3
+                """), params)
+                conn.commit()
+                return r.rowcount
+        except Exception as e:
+            print(e)
+        return None
+
+
+if __name__ == "__main__":
+    pass
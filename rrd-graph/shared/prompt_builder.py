@@ -0,0 +1,204 @@
+import os
+import re
+import json
+import math
+import hashlib
+
+
+# Rough size of a token for Gemini/Claude on English text, good enough to budget prompts
+CHARS_PER_TOKEN = 4
+
+# Sentiment shares are hashed in steps of this many percent, see input_hash()
+HASH_SHARE_STEP = 5
+
+# Share of the post budget per section, budget left over by a section rolls over to the next one
+SECTION_SHARES = (("negative", 0.4), ("positive", 0.3), ("neutral", 0.3))
+
+_URL_RE = re.compile(r"https?://\S+")
+_SPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"[a-z0-9]{4,}")
+
+ASSESSMENT_JSON_FORMAT = {
+    "report_name": "Give a creative name for this reputation report within five words.",
+    "summary": "Key findings and data points summarized, including reputational strengths and weaknesses.",
+    "severity_assessment": "Evaluation of the potential impact on brand reputation.",
+    "incident_categorization": {
+        "category": "Category of the incident (e.g., unmet expectations, product failure, etc.)",
+        "explanation": "Explanation for the chosen category"
+    },
+    "recommendations": {
+        "response_strategy": "Comprehensive communication plan to address concerns and manage public perception.",
+        "performance_monitoring": "Methods for tracking the effectiveness of the response strategy.",
+        "post_incident_analysis": "Process for reviewing the incident and improving future strategies.",
+        "reputation_building": "Proactive measures to strengthen online reputation."
+    }
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def normalize_content(content) -> str:
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    return _SPACE_RE.sub(" ", _URL_RE.sub("", content)).strip()
+
+
+def input_hash(thread: dict, distribution: dict, packed: dict) -> str:
+    """
+    Stable hash of what drives a prompt: the thread context, sentiment distribution as percent shares rounded to
+    HASH_SHARE_STEP and ids of the top posts per section, so prompts which only differ by a few new posts hash the same.
+    """
+    total = sum(distribution.get(k) or 0 for k in ("positive", "negative", "neutral"))
+    shares = {k: HASH_SHARE_STEP * round(100 * (distribution.get(k) or 0) / total / HASH_SHARE_STEP) if total > 0 else 0
+              for k in ("positive", "negative", "neutral")}
+    posts = {name: sorted(str(json.loads(line).get("post_id")) for line in lines) for name, lines in packed.items()}
+    inputs = {"context": thread.get("context"), "platform_ids": thread.get("platform_ids"), "shares": shares,
+              "posts": posts}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class PromptBuilder():
+    """
+    Assemble prompts from posts within a token budget: each post is projected to the fields the model needs, its
+    content is stripped of URLs and truncated, duplicates are dropped, and posts are ranked by relevance to the
+    thread context, strength of sentiment and engagement before they're packed into the budget.
+    Configured by PROMPT_TOKEN_BUDGET (default 12000) and PROMPT_MAX_POST_CHARS (default 400).
+    """
+    def __init__(self, token_budget: int=None, max_post_chars: int=None):
+        self.token_budget = token_budget or int(os.getenv("PROMPT_TOKEN_BUDGET") or 12000)
+        self.max_post_chars = max_post_chars or int(os.getenv("PROMPT_MAX_POST_CHARS") or 400)
+
+
+    def project(self, post: dict) -> dict:
+        content = normalize_content(post.get("content"))
+        truncated = len(content) > self.max_post_chars
+        if truncated:
+            content = content[:self.max_post_chars].rsplit(" ", 1)[0] + " …"
+        return {
+            "post_id": post.get("post_id"),
+            "platform_id": post.get("platform_id"),
+            "score": post.get("sentiment_score"),
+            "content": content,
+        }, truncated
+
+
+    def rank(self, posts: list[dict], context_words: set) -> list[dict]:
+        def relevance(post):
+            words = set(_WORD_RE.findall(normalize_content(post.get("content")).lower()))
+            overlap = len(words & context_words) / len(words) if len(words) > 0 else 0
+            engagement = sum(post.get(k) or 0 for k in ("likes", "shares", "comments"))
+            return 0.5 * abs(post.get("sentiment_score") or 0) + 0.3 * overlap + 0.2 * min(1.0, math.log1p(engagement) / 10)
+        return sorted(posts, key=relevance, reverse=True)
+
+
+    def pack(self, sections: dict, context: str, budget: int, shares=SECTION_SHARES) -> tuple[dict, dict]:
+        """
+        Pack ranked, deduplicated posts of each section into the budget, split by shares.
+        Returns:
+            Lines of each section, and metrics of what was kept and dropped.
+        """
+        context_words = set(_WORD_RE.findall((context or "").lower()))
+        seen = set()
+        packed = {}
+        metrics = {"posts_in": 0, "posts_kept": 0, "duplicates": 0, "truncated": 0, "over_budget": 0}
+        carry = 0
+        for name, share in shares:
+            posts = sections.get(name) or []
+            metrics["posts_in"] += len(posts)
+            section_budget = int(budget * share) + carry
+            used = 0
+            lines = []
+            for post in self.rank(posts, context_words):
+                projected, truncated = self.project(post)
+                digest = hashlib.sha1(projected["content"].lower().encode("utf-8")).digest()
+                if digest in seen:
+                    metrics["duplicates"] += 1
+                    continue
+                line = json.dumps(projected, ensure_ascii=False)
+                tokens = estimate_tokens(line) + 1
+                if used + tokens > section_budget:
+                    metrics["over_budget"] += 1
+                    continue
+                seen.add(digest)
+                used += tokens
+                lines.append(line)
+                metrics["truncated"] += int(truncated)
+            metrics["posts_kept"] += len(lines)
+            metrics[f"{name}_kept"] = len(lines)
+            packed[name] = lines
+            carry = section_budget - used
+        return packed, metrics
+
+
+    def assessment_prompt(self, thread: dict, snapshot: dict, sentiment_level) -> tuple[str, dict]:
+        """
+        Prompt of the reputation report, with top posts of the snapshot packed into the token budget.
+        Returns:
+            The prompt and its metrics: chars, tokens (estimated), budget, counts of kept/dropped posts and input_hash.
+        """
+        s_distribution = snapshot.get("distribution") or {}
+        template = """
+            You are a public relations expert with extensive experience in mitigating reputation incidents and in-depth knowledge of organizational strategies. Your task is to analyze the provided context and analytic data to generate a comprehensive reputation report in JSON format.
+
+            ## Context
+            {context}
+
+            ## Analytic Data
+
+            **The sentiment results are based on content collected from media platforms: {platform_ids}.**
+
+            Positive  records: {positive_count}
+            Negative records:  {negative_count}
+            Neutral records: {neutral_count}
+
+            ** Sentiment level (sentiment_level = (0.7 * sentiment_score) + (0.3 * sentiment_magnitude)) is formulated by last two hours sentiment records and the value is between 1 and 100 after normalization. **
+
+            Sentiment level:  {sentiment_level}
+
+            **Top positive records**
+
+            {positive_content}
+
+            **Top neutral records**
+
+            {neutral_content}
+
+            **Top negative records**
+
+            {negative_content}
+
+            ## Instructions
+
+            Based on the provided context and analytic data, create a reputation report following this structure:
+
+            {json_format}
+
+            Ensure your report adheres strictly to the JSON structure above.  Use the provided context and analytic data to populate each section of the JSON object with relevant information.
+        """
+        fields = {
+            "context": thread.get("context"),
+            "platform_ids": thread.get("platform_ids"),
+            "positive_count": s_distribution.get("positive"),
+            "negative_count": s_distribution.get("negative"),
+            "neutral_count": s_distribution.get("neutral"),
+            "sentiment_level": sentiment_level,
+            "json_format": ASSESSMENT_JSON_FORMAT,
+        }
+        fixed_tokens = estimate_tokens(template.format(**fields, positive_content="", neutral_content="", negative_content=""))
+        packed, metrics = self.pack(
+            {"positive": snapshot.get("positive"), "neutral": snapshot.get("neutral"), "negative": snapshot.get("negative")},
+            thread.get("context"),
+            max(0, self.token_budget - fixed_tokens),
+        )
+        prompt = template.format(
+            **fields,
+            positive_content="\n            ".join(packed["positive"]),
+            neutral_content="\n            ".join(packed["neutral"]),
+            negative_content="\n            ".join(packed["negative"]),
+        )
+        metrics.update({"chars": len(prompt), "tokens": estimate_tokens(prompt), "budget": self.token_budget,
+                        "input_hash": input_hash(thread, s_distribution, packed)})
+        print(f"assessment prompt: {json.dumps(metrics)}")
+        return prompt, metrics
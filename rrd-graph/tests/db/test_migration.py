@@ -0,0 +1,41 @@
+import pytest
+
+from shared.db.migration import EXPLAIN_QUERIES, Migration
+
+
+@pytest.fixture(scope="module")
+def migration(db_engine):
+    # Plans of empty tables are arbitrary, so fill in 50 threads of three weeks of posts and sentiment levels
+    with db_engine.connect() as conn:
+        conn.exec_driver_sql("TRUNCATE posts, sentiment_summary")
+        conn.exec_driver_sql("""
+            INSERT INTO posts (post_id, thread_id, platform_id, content, conent_type, status, sentiment_score,
+                               sentiment_magnitude, created_at, scraped_at, sentiment_at, updated_at)
+            SELECT 'tw-' || i, i % 50, (ARRAY['twitter', 'google', 'news'])[i % 3 + 1], 'post', 'post',
+                (ARRAY['pending', 'processing', 'sentimented', 'sentimented', 'generated', 'ignored'])[i % 6 + 1],
+                (i % 21 - 10) / 10.0, (i % 7) / 7.0, now() - i * INTERVAL '20 seconds', now(),
+                now() - i * INTERVAL '20 seconds', now()
+            FROM generate_series(1, 100000) AS i
+        """)
+        conn.exec_driver_sql("""
+            INSERT INTO sentiment_summary (thread_id, platform_id, sentiment_level, created_at)
+            SELECT i % 50, (ARRAY['twitter', 'google', 'news'])[i / 50 % 3 + 1], 50, now() - i * INTERVAL '10 seconds'
+            FROM generate_series(1, 200000) AS i
+        """)
+        conn.exec_driver_sql("ANALYZE")
+        conn.commit()
+    mg = Migration(db_engine)
+    mg.upgrade()
+    return mg
+
+
+def test_upgrade_verifies(migration):
+    assert set(migration.verify().values()) == {"valid"}
+    assert migration.upgrade() == []
+
+
+@pytest.mark.parametrize("name", list(EXPLAIN_QUERIES))
+def test_hot_query_uses_its_index(migration, name):
+    r = migration.explain_check()[name]
+    assert r["missing"] == [], r["scans"]
+    assert r["ok"], r["scans"]
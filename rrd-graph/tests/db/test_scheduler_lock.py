@@ -0,0 +1,48 @@
+import threading
+
+from utiles.scheduler import AdvisoryRunLock
+
+
+def test_one_run_and_one_queued_across_instances(db_engine):
+    lock = AdvisoryRunLock(db_engine, wait_timeout=5)
+    running = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def hold(after=None):
+        with lock.hold(("nlp", "1")) as acquired:
+            results.append(acquired)
+            if after is not None:
+                after()
+
+    def run():
+        running.set()
+        release.wait(5)
+
+    first = threading.Thread(target=hold, args=(run,))
+    first.start()
+    assert running.wait(5)
+    # Waits for the first run, holding the queue lock meanwhile
+    second = threading.Thread(target=hold)
+    second.start()
+    for _ in range(50):
+        with db_engine.connect() as conn:
+            if conn.exec_driver_sql("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'").scalar() >= 2:
+                break
+        threading.Event().wait(0.1)
+    hold()
+    # Other keys aren't held up
+    with lock.hold(("nlp", "2")) as acquired:
+        assert acquired is True
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert results == [True, False, True]
+
+
+def test_waiting_for_the_run_times_out(db_engine):
+    lock = AdvisoryRunLock(db_engine, wait_timeout=0.2)
+    with lock.hold(("batch", "1")) as acquired:
+        assert acquired is True
+        with lock.hold(("batch", "1")) as waited:
+            assert waited is None
@@ -0,0 +1,90 @@
+import random
+import threading
+from datetime import datetime, timedelta, UTC
+
+from shared.db.tb_posts import Post
+from shared.db.tb_sentiment_rollup import SentimentRollup
+from shared.db.tb_sentiment_summary import SentimentSummary
+
+
+def add_posts(pt: Post, n: int, thread_id: int=1) -> list[str]:
+    now = datetime.now(UTC).isoformat()
+    posts = [{
+        "post_id": f"tw-{thread_id}-{i}", "thread_id": thread_id, "platform_id": "twitter", "content": f"post {i}",
+        "conent_type": "post", "status": "processing", "created_at": now, "scraped_at": now,
+    } for i in range(n)]
+    pt.create_posts_in_batch(posts)
+    return [p["post_id"] for p in posts]
+
+
+def results(post_ids: list[str], rnd: random.Random, statuses=("sentimented", "generated", "ignored")) -> list[dict]:
+    now = datetime.now(UTC)
+    return [{
+        "post_id": post_id, "sentiment_score": rnd.uniform(-1, 1), "sentiment_magnitude": rnd.uniform(0, 3),
+        "sentiment_label": "mixed", "status": rnd.choice(statuses),
+        "sentiment_at": (now - timedelta(seconds=rnd.uniform(0, 5400))).isoformat(),
+    } for post_id in post_ids]
+
+
+def rollup_rows(conn) -> list:
+    return conn.exec_driver_sql(
+        "SELECT thread_id, platform_id, bucket_at, level_sum, post_count FROM sentiment_rollup ORDER BY 1, 2, 3"
+    ).fetchall()
+
+
+def test_rollup_matches_posts(db_engine, db_conn):
+    rollup = SentimentRollup(db_engine)
+    pt = Post(db_engine, rollup=rollup)
+    ss = SentimentSummary(db_engine, rollup=rollup)
+    rnd = random.Random(7)
+    post_ids = add_posts(pt, 500)
+    pt.save_sentiment_results(results(post_ids, rnd), chunk_size=100)
+    # Rescored posts move between buckets and in and out of the analysed statuses
+    pt.save_sentiment_results(results(rnd.sample(post_ids, 200), rnd), chunk_size=100)
+    pt.save_sentiment_results(results(rnd.sample(post_ids, 50), rnd), bulk=False)
+
+    maintained = rollup_rows(db_conn)
+    db_conn.commit()
+    assert len(maintained) > 0
+    rollup.rebuild()
+    assert rollup_rows(db_conn) == maintained
+
+    level, _ = ss.calculate_sentiment_level("1", "twitter")
+    assert level is not None
+    assert ss.calculate_sentiment_level_from_posts("1", "twitter")[0] == level
+
+
+def test_concurrent_writers_keep_rollup_exact(db_engine, db_conn):
+    rollup = SentimentRollup(db_engine)
+    pt = Post(db_engine, rollup=rollup)
+    post_ids = add_posts(pt, 400)
+    at = datetime.now(UTC).replace(second=30).isoformat()
+    saved = []
+
+    def write(seed):
+        rnd = random.Random(seed)
+        for _ in range(10):
+            # Writers update different posts, which are all in the same bucket
+            batch = results(rnd.sample(post_ids[seed::4], 50), rnd, statuses=("sentimented",))
+            for r in batch:
+                r["sentiment_at"] = at
+            saved.append(pt.save_sentiment_results(batch, chunk_size=20) is not None)
+
+    writers = [threading.Thread(target=write, args=(seed,)) for seed in range(4)]
+    for w in writers:
+        w.start()
+    for w in writers:
+        w.join()
+    assert saved == [True] * 40
+
+    maintained = rollup_rows(db_conn)
+    db_conn.commit()
+    rollup.rebuild()
+    assert rollup_rows(db_conn) == maintained
+
+
+def test_missing_table_is_remembered(db_engine, capsys):
+    rollup = SentimentRollup(db_engine, table_name="no_such_rollup")
+    assert rollup.available() is False
+    assert rollup.available() is False
+    assert capsys.readouterr().out.count("doesn't exist") == 1
@@ -0,0 +1,30 @@
+from shared.db.tb_jobs import Job
+
+
+def job(job_id: str) -> dict:
+    return {"job_id": job_id, "thread_id": 1, "keywords": ["k"], "platform_id": "twitter", "job_interval": 10,
+            "status": "running", "scrape_cursor": {"since_id": "1"}}
+
+
+def test_jobs_before_migration(db_engine, db_conn):
+    # The table as it was before migration.py added scrape_cursor
+    db_conn.exec_driver_sql("DROP TABLE IF EXISTS jobs_premigration")
+    db_conn.exec_driver_sql("CREATE TABLE jobs_premigration (LIKE jobs INCLUDING DEFAULTS)")
+    db_conn.exec_driver_sql("ALTER TABLE jobs_premigration DROP COLUMN scrape_cursor")
+    db_conn.commit()
+    jb = Job(db_engine, table_name="jobs_premigration")
+    try:
+        assert jb.create_job(job("j1")) == "j1"
+        assert jb.the_job("1", "twitter")["scrape_cursor"] is None
+        assert [j["job_id"] for j in jb.jobs_by_thread_id("1")] == ["j1"]
+        assert jb.save_cursor("j1", {"since_id": "2"}) is False
+    finally:
+        db_conn.exec_driver_sql("DROP TABLE jobs_premigration")
+        db_conn.commit()
+
+
+def test_jobs_after_migration(db_engine, db_conn):
+    jb = Job(db_engine)
+    jb.create_job(job("j1"))
+    assert jb.save_cursor("j1", {"since_id": "2"}) is True
+    assert jb.the_job("1", "twitter")["scrape_cursor"] == {"since_id": "2"}
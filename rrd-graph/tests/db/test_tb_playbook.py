@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, UTC
+
+from shared.db.tb_playbook import Playbook
+
+
+def playbook(input_hash=None, sentiment_level=None) -> dict:
+    return {"display_name": "report", "thread_id": 1, "assessment": "{}", "plan": "[]",
+            "input_hash": input_hash, "sentiment_level": sentiment_level}
+
+
+def test_playbooks_before_migration(db_engine, db_conn):
+    # The table as it was before migration.py added input_hash and sentiment_level
+    db_conn.exec_driver_sql("DROP TABLE IF EXISTS playbooks_premigration")
+    db_conn.exec_driver_sql("CREATE TABLE playbooks_premigration (LIKE playbooks INCLUDING DEFAULTS)")
+    db_conn.exec_driver_sql("ALTER TABLE playbooks_premigration DROP COLUMN input_hash, DROP COLUMN sentiment_level")
+    db_conn.commit()
+    pb = Playbook(db_engine, table_name="playbooks_premigration")
+    try:
+        assert pb.create_playbook(playbook("abc", 42.0)) is not None
+        last = pb.last_playbook("1")
+        assert (last["display_name"], last["input_hash"], last["sentiment_level"]) == ("report", None, None)
+        since = datetime.now(UTC) - timedelta(hours=1)
+        assert pb.recent_playbook("1", since, input_hash="abc") is None
+        assert pb.recent_playbook("1", since)["display_name"] == "report"
+    finally:
+        db_conn.exec_driver_sql("DROP TABLE playbooks_premigration")
+        db_conn.commit()
+
+
+def test_playbooks_after_migration(db_engine, db_conn):
+    pb = Playbook(db_engine)
+    pb.create_playbook(playbook("abc", 42.0))
+    last = pb.last_playbook("1")
+    assert (last["input_hash"], last["sentiment_level"]) == ("abc", 42.0)
+    since = datetime.now(UTC) - timedelta(hours=1)
+    assert pb.recent_playbook("1", since, input_hash="abc")["input_hash"] == "abc"
@@ -0,0 +1,76 @@
+from datetime import datetime, UTC
+
+import pytest
+
+from shared.db.tb_posts import Post
+
+
+def add_posts(pt: Post, n: int) -> list[str]:
+    now = datetime.now(UTC).isoformat()
+    posts = [{
+        "post_id": f"tw-{i}", "thread_id": 1, "platform_id": "twitter", "content": f"post {i}",
+        "conent_type": "post", "status": "processing", "created_at": now, "scraped_at": now,
+    } for i in range(n)]
+    assert pt.create_posts_in_batch(posts)["inserted"] == n
+    return [p["post_id"] for p in posts]
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_save_sentiment_results(db_engine, db_conn, bulk):
+    pt = Post(db_engine)
+    post_ids = add_posts(pt, 3)
+    at = "2026-01-02T03:04:05+00:00"
+    results = [
+        {"post_id": post_ids[0], "sentiment_score": 0.5, "sentiment_magnitude": 0.3, "sentiment_label": "positive",
+         "status": "sentimented", "sentiment_at": at},
+        # NULLs resolve to the column types in the VALUES list
+        {"post_id": post_ids[1], "sentiment_score": None, "sentiment_magnitude": None, "sentiment_label": None,
+         "status": "ignored", "sentiment_at": None},
+        {"post_id": "tw-unknown", "sentiment_score": -1.0, "sentiment_magnitude": 1.0, "sentiment_label": "negative",
+         "status": "sentimented", "sentiment_at": at},
+    ]
+    assert pt.save_sentiment_results(results, bulk=bulk, chunk_size=2) == results
+
+    rows = {r.post_id: r for r in db_conn.exec_driver_sql(
+        "SELECT post_id, sentiment_score, sentiment_magnitude, sentiment_label, status, sentiment_at FROM posts"
+    ).fetchall()}
+    assert len(rows) == 3
+    assert (rows[post_ids[0]].sentiment_score, rows[post_ids[0]].sentiment_label, rows[post_ids[0]].status) \
+        == (0.5, "positive", "sentimented")
+    assert rows[post_ids[0]].sentiment_at == datetime.fromisoformat(at)
+    assert (rows[post_ids[1]].sentiment_score, rows[post_ids[1]].status) == (None, "ignored")
+    assert rows[post_ids[2]].status == "processing"
+
+
+def test_claim_pending_posts(db_engine, db_conn):
+    pt = Post(db_engine)
+    post_ids = add_posts(pt, 3)
+    db_conn.exec_driver_sql("UPDATE posts SET status = 'pending'")
+    db_conn.commit()
+
+    claimed = pt.claim_pending_posts("1", batch_size=2)
+    assert len(claimed) == 2 and all(r.status == "processing" for r in claimed)
+    assert pt.pending_count("1") == 1
+    assert [r.post_id for r in pt.claim_pending_posts("1", batch_size=2)] == [
+        p for p in post_ids if p not in {r.post_id for r in claimed}]
+    assert pt.claim_pending_posts("1") == []
+    # Posts stuck in processing are claimable again after visibility_timeout, 0 is not the default
+    assert pt.pending_count("1", visibility_timeout=0) == 3
+    assert len(pt.claim_pending_posts("1", visibility_timeout=0)) == 3
+
+
+def test_snapshot_cache_is_shared(db_engine, db_conn):
+    reader, writer = Post(db_engine), Post(db_engine)
+    post_ids = add_posts(reader, 2)
+    at = datetime.now(UTC).isoformat()
+    writer.save_sentiment_results([{"post_id": post_ids[0], "sentiment_score": 0.5, "sentiment_magnitude": 0.3,
+                                    "sentiment_label": "positive", "status": "sentimented", "sentiment_at": at}])
+    snapshot = reader.sentiment_snapshot("1")
+    assert snapshot["distribution"] == {"positive": 1, "neutral": 0, "negative": 0}
+    snapshot["positive"].clear()
+    assert len(reader.sentiment_snapshot("1")["positive"]) == 1
+
+    # Results saved through another instance, as AsyncSqlCN does for SqlCN, drop the cached snapshot
+    writer.save_sentiment_results([{"post_id": post_ids[1], "sentiment_score": -0.5, "sentiment_magnitude": 0.3,
+                                    "sentiment_label": "negative", "status": "sentimented", "sentiment_at": at}])
+    assert reader.sentiment_snapshot("1")["distribution"] == {"positive": 1, "neutral": 0, "negative": 1}
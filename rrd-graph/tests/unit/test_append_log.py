@@ -0,0 +1,70 @@
+import pytest
+from google.api_core import exceptions as gexc
+
+from utiles.append_log import AppendLog
+from utiles.storage import LocalBlob, LocalBucket
+
+
+def read_lines(bucket, name):
+    with bucket.blob(name).open("r") as f:
+        return f.read().splitlines()
+
+
+def test_lines_are_composed_in_order(tmp_path):
+    bucket = LocalBucket(str(tmp_path / "bucket"))
+    log = AppendLog(bucket, "unknown-issues.txt", flush_interval=60, max_lines=1000, compact_segments=3)
+    for i in range(5):
+        log.append(f"line-{i}")
+        # One segment per flush, the third one triggers a compaction
+        assert log.flush() is not None
+    assert log.flush() is None
+    log.append("line-5")
+    log.close()
+    assert read_lines(bucket, "unknown-issues.txt") == [f"line-{i}" for i in range(6)]
+    assert list(bucket.list_blobs(prefix="unknown-issues.txt.segments/")) == []
+
+
+def test_existing_log_is_appended_to(tmp_path):
+    bucket = LocalBucket(str(tmp_path / "bucket"))
+    bucket.blob("log.txt").upload_from_string("old\n")
+    log = AppendLog(bucket, "log.txt", flush_interval=60)
+    log.append("new")
+    log.close()
+    assert read_lines(bucket, "log.txt") == ["old", "new"]
+
+
+def test_composed_segments_are_not_composed_again(tmp_path, monkeypatch):
+    bucket = LocalBucket(str(tmp_path / "bucket"))
+    a = AppendLog(bucket, "log.txt", flush_interval=60, compact_segments=16)
+    b = AppendLog(bucket, "log.txt", flush_interval=60, compact_segments=16)
+    for i in range(3):
+        a.append(f"a-{i}")
+        a.flush()
+
+    # Instance a composes its segments and stops before deleting them
+    with monkeypatch.context() as m:
+        m.setattr(LocalBlob, "delete", lambda self, **kwargs: None)
+        assert a.compact() == 3
+    assert len(list(bucket.list_blobs(prefix="log.txt.segments/"))) == 3
+
+    # Instance b sees them listed in the log's metadata, deletes them and only composes its own
+    b.append("b-0")
+    b.flush()
+    assert b.compact() == 1
+    assert list(bucket.list_blobs(prefix="log.txt.segments/")) == []
+    a.close()
+    b.close()
+    assert read_lines(bucket, "log.txt") == ["a-0", "a-1", "a-2", "b-0"]
+
+
+def test_compose_is_conditional_on_generation(tmp_path):
+    bucket = LocalBucket(str(tmp_path / "bucket"))
+    log = AppendLog(bucket, "log.txt", flush_interval=60)
+    log.append("line")
+    log.flush()
+    stale = bucket.blob("log.txt")
+    log.compact()
+    # A compaction which read the log before another one composed into it loses
+    with pytest.raises(gexc.PreconditionFailed):
+        stale.compose([], if_generation_match=0)
+    log.close()
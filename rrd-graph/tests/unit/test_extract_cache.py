@@ -0,0 +1,40 @@
+from tools.extract_cache import SimHashIndex, hamming, simhash, to_signed, to_unsigned
+
+
+ARTICLE = " ".join(f"word{i % 97} story{i % 13}" for i in range(400))
+
+
+def test_simhash_near_duplicates():
+    assert simhash("") == 0
+    assert simhash(ARTICLE) == simhash(ARTICLE.upper())
+    assert hamming(simhash(ARTICLE), simhash(ARTICLE + " one more line")) <= 3
+    assert hamming(simhash(ARTICLE), simhash("an entirely different page about something else " * 20)) > 3
+
+
+def test_signed_roundtrip():
+    for h in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= to_signed(h) < (1 << 63)
+        assert to_unsigned(to_signed(h)) == h
+
+
+def test_find_or_add():
+    ix = SimHashIndex(max_distance=3)
+    assert ix.find_or_add("a", 0b1111) is None
+    assert ix.find_or_add("b", 0b0111) == "a"
+    # b is a near-duplicate, so it isn't added
+    assert ix.find(0b0011) == "a"
+    assert ix.find(1 << 40) is None
+
+
+def test_re_adding_a_key_replaces_its_hash():
+    ix = SimHashIndex(max_distance=3)
+    ix.add("a", 0b1111)
+    assert ix.find_or_add("a", 1 << 60) is None
+    assert ix.find(0b1111) is None
+    assert ix.find(1 << 60) == "a"
+    # A page which becomes a near-duplicate of another drops its own hash
+    ix.add("b", 0xFFFF << 20)
+    assert ix.find_or_add("b", (1 << 60) | 1) == "a"
+    assert ix.find(0xFFFF << 20) is None
+    ix.remove("a")
+    assert ix.find(1 << 60) is None
@@ -0,0 +1,59 @@
+from tools import html_text
+from tools.html_text import cap_text, extract_text, fast_extract
+
+
+PARAGRAPH = "<p>" + "The launch event drew mixed reactions from reviewers and buyers alike. " * 5 + "</p>"
+
+
+def test_cap_text_cuts_at_paragraph():
+    text = "\n\n".join(["a" * 40, "b" * 40, "c" * 40])
+    assert cap_text(text, 200) == (text, False)
+    assert cap_text(text, 100) == ("a" * 40 + "\n\n" + "b" * 40, True)
+    # No paragraph in the second half of the limit, cut at the limit
+    assert cap_text("x" * 300, 100) == ("x" * 100, True)
+
+
+def test_fast_extract_drops_page_chrome_and_boilerplate():
+    html = (
+        "<html><head><script>var x = 1;</script><style>p {}</style></head><body>"
+        "<header><h1>Site name</h1></header><nav><a href='/'>Home</a></nav>"
+        "<div class='cookie-banner'>We use cookies to improve your experience here</div>"
+        f"<article><h1>Headline</h1>{PARAGRAPH}<p>Subscribe to our newsletter today</p>{PARAGRAPH}</article>"
+        "<ul><li><a href='/a'>Link to another story here</a></li></ul>"
+        "<footer>All rights reserved by the site</footer></body></html>"
+    )
+    text = fast_extract(html)
+    blocks = text.split("\n\n")
+    assert blocks[0] == "Headline"
+    # Repeated paragraph is kept once
+    assert len(blocks) == 2
+    for dropped in ("Site name", "Home", "cookies", "Subscribe", "Link to another", "All rights reserved", "var x"):
+        assert dropped not in text
+
+
+def test_fast_extract_keeps_article_header_and_layout_classes():
+    assert fast_extract(f'<body class="has-sidebar"><article>{PARAGRAPH}</article></body>') != ""
+    text = fast_extract(f"<body><article><header><h1>Headline</h1></header>{PARAGRAPH}</article></body>")
+    assert text.startswith("Headline\n\n")
+    text = fast_extract(f'<body><main class="with-sidebar"><div class="sidebar">{PARAGRAPH}</div></main></body>')
+    assert text == ""
+
+
+def test_extract_text_caps_page_and_content(monkeypatch):
+    html = "<html><body><article>" + PARAGRAPH + "".join(
+        f"<p>Paragraph {i} of the article keeps going with more words about the event.</p>" for i in range(200)
+    ) + "</article></body></html>"
+    monkeypatch.setattr(html_text, "MAX_CHARS", 1000)
+    r = extract_text(html)
+    assert r["method"] == "fast"
+    assert r["truncated"] is True
+    assert 500 < len(r["content"]) <= 1000
+    assert r["html_bytes"] == len(html)
+
+    monkeypatch.setattr(html_text, "MAX_HTML_BYTES", 100)
+    monkeypatch.setattr(html_text, "unstructured_extract", lambda html: f"{len(html)} bytes partitioned " * 20)
+    r = extract_text(html)
+    # The cut page has too little text for the fast path
+    assert r["method"] == "unstructured"
+    assert r["content"].startswith("100 bytes partitioned")
+    assert r["truncated"] is True
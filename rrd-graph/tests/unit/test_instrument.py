@@ -0,0 +1,53 @@
+import json
+import threading
+import time
+
+import pytest
+import sqlalchemy
+
+from shared.db.instrument import QueryInstrument, StatsSink, TimedAsyncQueuePool, TimedQueuePool
+
+
+class FakeConnection():
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("poolclass", [TimedQueuePool, TimedAsyncQueuePool])
+def test_checkout_records_wait(poolclass):
+    pool = poolclass(FakeConnection, pool_size=1, max_overflow=0)
+    conn = pool.connect()
+    assert conn.info["rrd_pool_wait_ms"] >= 0
+    conn.close()
+
+
+def test_snapshot_has_pool_wait_and_is_reported(tmp_path, capsys):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/db.sqlite", poolclass=TimedQueuePool, pool_size=1,
+                                      max_overflow=0)
+    instrument = QueryInstrument(engine, sinks=[StatsSink()])
+
+    def hold():
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+            time.sleep(0.2)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.05)
+    # Waits for the connection held by the other thread
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 2")
+    holder.join()
+
+    snapshot = instrument.snapshot()
+    assert snapshot["SELECT"]["count"] == 2
+    assert snapshot["SELECT"]["pool_wait_mean_ms"] >= 50
+
+    instrument.start_reporter(0.05)
+    time.sleep(0.2)
+    instrument.remove()
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert len(lines) > 0 and lines[0]["sql_stats"]["SELECT"]["count"] == 2
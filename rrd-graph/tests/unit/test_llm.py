@@ -0,0 +1,43 @@
+import asyncio
+
+from shared import llm
+
+
+class Responding():
+    content = "```json{}```"
+
+
+class FlakyModel():
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def ainvoke(self, prompt):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return Responding()
+
+
+class SlowModel():
+    async def ainvoke(self, prompt):
+        await asyncio.sleep(5)
+
+
+def test_network_timeouts_are_retried(monkeypatch):
+    monkeypatch.setattr(llm, "backoff_delay", lambda attempt: 0)
+    model = FlakyModel([TimeoutError("read timed out")])
+    result = asyncio.run(llm.acall_llm(model, "prompt"))
+    assert (result.ok, result.content, result.attempts, model.calls) == (True, "{}", 2, 2)
+
+
+def test_deadline_is_not_retried():
+    result = asyncio.run(llm.acall_llm(SlowModel(), "prompt", deadline=0.1))
+    assert (result.ok, result.attempts) == (False, 1)
+    assert result.error.startswith("deadline exceeded")
+
+
+def test_missing_model_fails_fast():
+    results = asyncio.run(llm.call_llm_many(None, ["a", "b"]))
+    assert [r.error for r in results] == ["model is not available"] * 2
+    assert llm.call_llm(None, "prompt") is None
@@ -0,0 +1,46 @@
+import json
+
+from shared.prompt_builder import PromptBuilder, estimate_tokens, input_hash
+
+
+def post(i, score, content=None, **kwargs):
+    return {"post_id": f"p{i}", "platform_id": "twitter", "sentiment_score": score,
+            "content": content or f"post number {i} about the battery life of the phone", **kwargs}
+
+
+def test_pack_stays_within_budget_and_dedups():
+    sections = {
+        "negative": [post(i, -0.5) for i in range(50)] + [post(100, -0.9, content="Same text https://x.co/a")],
+        "positive": [post(200, 0.9, content="same   TEXT")],
+        "neutral": [],
+    }
+    packed, metrics = PromptBuilder().pack(sections, "battery", budget=300)
+    used = sum(estimate_tokens(line) + 1 for lines in packed.values() for line in lines)
+    assert used <= 300
+    assert metrics["posts_in"] == 52
+    assert metrics["duplicates"] == 1
+    assert metrics["over_budget"] > 0
+    assert metrics["posts_kept"] == sum(len(lines) for lines in packed.values())
+    # Strongest sentiment first
+    assert json.loads(packed["negative"][0])["post_id"] == "p100"
+    assert packed["positive"] == []
+
+
+def test_pack_truncates_and_carries_budget_over():
+    builder = PromptBuilder(max_post_chars=40)
+    sections = {"negative": [], "positive": [post(i, 0.5, content=f"post {i} " + "word " * 50) for i in range(3)], "neutral": []}
+    packed, metrics = builder.pack(sections, "", budget=200)
+    # Unused budget of negative rolls over to positive
+    assert metrics["positive_kept"] == 3
+    assert metrics["truncated"] == 3
+    assert all(len(json.loads(line)["content"]) <= 42 for line in packed["positive"])
+
+
+def test_input_hash_ignores_small_share_changes():
+    thread = {"context": "battery", "platform_ids": ["twitter"]}
+    packed = {"negative": [json.dumps({"post_id": "p1"})]}
+    h = input_hash(thread, {"positive": 50, "negative": 30, "neutral": 20}, packed)
+    assert h == input_hash(thread, {"positive": 51, "negative": 30, "neutral": 20}, packed)
+    assert h != input_hash(thread, {"positive": 80, "negative": 10, "neutral": 10}, packed)
+    assert h != input_hash(thread, {"positive": 50, "negative": 30, "neutral": 20},
+                           {"negative": [json.dumps({"post_id": "p2"})]})
@@ -0,0 +1,24 @@
+import time
+
+from tools.rate_limit import RateLimiter
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(50, burst=3)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - started < 0.01
+    for _ in range(5):
+        limiter.acquire()
+    # 5 more tokens at 50/s
+    assert 0.08 <= time.monotonic() - started < 0.5
+
+
+def test_pause_holds_callers():
+    limiter = RateLimiter(1000, burst=10)
+    limiter.acquire()
+    limiter.pause(0.1)
+    started = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.09
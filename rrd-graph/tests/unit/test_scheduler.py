@@ -0,0 +1,85 @@
+import threading
+
+from utiles.scheduler import CoalescingScheduler
+
+
+def test_batch_size_follows_backlog():
+    backlog = {"1": 0, "2": 2000, "3": 100000, "4": None}
+    scheduler = CoalescingScheduler(backlog_fn=backlog.get, min_batch=100, max_batch=1000, backlog_divisor=4)
+    assert [scheduler.batch_size(t) for t in ("1", "2", "3", "4")] == [100, 500, 1000, 100]
+
+
+def run_blocked(scheduler, key, fn, results, **kwargs):
+    thread = threading.Thread(target=lambda: results.append(scheduler.run(key, "1", fn, **kwargs)))
+    thread.start()
+    return thread
+
+
+def test_triggers_coalesce_into_one_queued_round():
+    release = threading.Event()
+    started = threading.Event()
+    rounds = []
+
+    def fn(batch_size):
+        rounds.append(batch_size)
+        started.set()
+        release.wait(5)
+
+    scheduler = CoalescingScheduler(min_batch=10)
+    results = []
+    thread = run_blocked(scheduler, ("nlp", "1"), fn, results)
+    assert started.wait(5)
+    assert scheduler.run(("nlp", "1"), "1", fn) == "queued"
+    assert scheduler.run(("nlp", "1"), "1", fn) == "coalesced"
+    # Other keys aren't held up by the run in flight
+    assert scheduler.run(("llm", "1"), "1", lambda batch_size: None) == "done"
+    release.set()
+    thread.join(5)
+    assert results == ["done"]
+    assert rounds == [10, 10]
+    metrics = scheduler.metrics()
+    assert (metrics["requested"], metrics["queued"], metrics["coalesced"], metrics["depth"]) == (4, 1, 1, 0)
+
+
+def test_queued_rounds_are_handed_off_after_max_rounds():
+    release = threading.Event()
+    started = threading.Event()
+    handoffs = []
+
+    def fn(batch_size):
+        started.set()
+        release.wait(5)
+
+    scheduler = CoalescingScheduler(max_rounds=1)
+    results = []
+    thread = run_blocked(scheduler, ("nlp", "1"), fn, results, handoff=lambda: handoffs.append(True))
+    assert started.wait(5)
+    assert scheduler.run(("nlp", "1"), "1", fn) == "queued"
+    release.set()
+    thread.join(5)
+    assert results == ["handed_off"]
+    assert handoffs == [True]
+
+
+def test_lock_fn_coalesces_across_instances():
+    from contextlib import contextmanager
+
+    held = {"acquired": False}
+    handoffs = []
+
+    @contextmanager
+    def lock_fn(key):
+        yield held["acquired"]
+
+    scheduler = CoalescingScheduler(lock_fn=lock_fn)
+    # Another instance's trigger is already queued
+    assert scheduler.run(("nlp", "1"), "1", lambda batch_size: None) == "coalesced"
+    # Waiting for another instance's run timed out
+    held["acquired"] = None
+    assert scheduler.run(("nlp", "1"), "1", lambda batch_size: None, handoff=lambda: handoffs.append(True)) \
+        == "handed_off"
+    assert handoffs == [True]
+    held["acquired"] = True
+    assert scheduler.run(("nlp", "1"), "1", lambda batch_size: None) == "done"
+    metrics = scheduler.metrics()
+    assert (metrics["coalesced_remote"], metrics["lock_timeouts"], metrics["rounds"], metrics["depth"]) == (1, 1, 1, 0)
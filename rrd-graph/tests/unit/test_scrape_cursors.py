@@ -0,0 +1,152 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+import requests
+import tweepy
+
+from tools import tweets_scraper
+from tools.google_search import GoogleSearch, JOB_CURSOR_MAX_URLS
+from tools.tweets_scraper import TWITTER_EPOCH_MS, TweetsScraper, tweet_time
+
+
+def tweet_id(days_ago: float) -> str:
+    at = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=days_ago)
+    return str((int(at.timestamp() * 1000) - TWITTER_EPOCH_MS) << 22)
+
+
+def bad_request():
+    response = requests.Response()
+    response.status_code = 400
+    response._content = b"{}"
+    return tweepy.BadRequest(response)
+
+
+class FakeClient():
+    """
+    Recent search over pages of tweets, newest first, next_token is the index of the page, a next_token which
+    isn't a number is rejected like an expired one.
+    """
+    def __init__(self, pages, error=None):
+        self.pages = pages
+        self.error = error
+        self.calls = []
+
+    def search_recent_tweets(self, query, next_token=None, since_id=None, **kwargs):
+        self.calls.append((next_token, since_id))
+        if self.error is not None:
+            raise self.error
+        if next_token is not None and not next_token.isdigit():
+            raise bad_request()
+        page = int(next_token or 0)
+        tweets = [t for t in self.pages[page] if since_id is None or int(t.id) > int(since_id)]
+        meta = {"result_count": len(tweets)}
+        if len(tweets) > 0:
+            meta["newest_id"] = tweets[0].id
+        if page + 1 < len(self.pages):
+            meta["next_token"] = str(page + 1)
+        return SimpleNamespace(meta=meta, data=tweets)
+
+
+def tweet(days_ago):
+    return SimpleNamespace(id=tweet_id(days_ago), text="text", author_id=1, created_at=None,
+                           public_metrics={"like_count": 1, "retweet_count": 0, "reply_count": 0})
+
+
+@pytest.fixture
+def scraper(monkeypatch):
+    monkeypatch.setattr(tweets_scraper.RateLimiter, "acquire", lambda self: None)
+    return TweetsScraper(None, bearer_token="token")
+
+
+def use_client(monkeypatch, client):
+    monkeypatch.setattr(tweets_scraper, "twitter_client", lambda bearer_token: client)
+    return client
+
+
+def test_tweet_time():
+    assert abs(tweet_time(tweet_id(2)) - (datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=2))) \
+        < datetime.timedelta(seconds=1)
+
+
+def test_search_resumes_next_token_then_moves_since_id(scraper, monkeypatch):
+    pages = [[tweet(0.1), tweet(0.2)], [tweet(0.3)], [tweet(0.4)]]
+    client = use_client(monkeypatch, FakeClient(pages))
+
+    tss, c = scraper.search_new_tweets("q", None, max_pages=2)
+    assert len(tss) == 3
+    assert c == {"query": "q", "since_id": None, "next_token": "2", "newest_id": pages[0][0].id}
+
+    tss, c = scraper.search_new_tweets("q", c, max_pages=2)
+    assert len(tss) == 1
+    assert client.calls[-1] == ("2", None)
+    # Pages of the interrupted run are done, its newest tweet becomes since_id
+    assert c == {"query": "q", "since_id": pages[0][0].id, "next_token": None, "newest_id": None}
+
+    client.pages = [[tweet(0.01)] + pages[0]]
+    tss, c = scraper.search_new_tweets("q", c)
+    assert [t["post_id"] for t in tss] == [f"tw-{client.pages[0][0].id}"]
+    assert client.calls[-1] == (None, pages[0][0].id)
+    assert c["since_id"] == client.pages[0][0].id
+
+
+def test_other_query_starts_over(scraper, monkeypatch):
+    client = use_client(monkeypatch, FakeClient([[tweet(0.1)]]))
+    _, c = scraper.search_new_tweets("q2", {"query": "q", "since_id": tweet_id(1)})
+    assert client.calls == [(None, None)]
+    assert c["query"] == "q2"
+
+
+def test_cursor_out_of_window_starts_over(scraper, monkeypatch):
+    client = use_client(monkeypatch, FakeClient([[]]))
+    _, c = scraper.search_new_tweets("q", {"query": "q", "since_id": tweet_id(8)})
+    # A quiet query didn't move since_id, which aged out of the recent search window
+    assert client.calls == [(None, None)]
+    assert c == {"query": "q", "since_id": None, "next_token": None, "newest_id": None}
+
+
+def test_rejected_cursor_starts_over(scraper, monkeypatch):
+    client = use_client(monkeypatch, FakeClient([[tweet(0.1)]]))
+    since_id = tweet_id(1)
+    tss, c = scraper.search_new_tweets("q", {"query": "q", "since_id": since_id, "next_token": "expired"})
+    assert client.calls == [("expired", since_id), (None, None)]
+    assert len(tss) == 1
+    assert c == {"query": "q", "since_id": client.pages[0][0].id, "next_token": None, "newest_id": None}
+
+
+def test_failed_search_keeps_cursor(scraper, monkeypatch):
+    response = requests.Response()
+    response.status_code = 503
+    response._content = b"{}"
+    use_client(monkeypatch, FakeClient([[]], error=tweepy.TwitterServerError(response)))
+    cursor = {"query": "q", "since_id": tweet_id(1), "next_token": "3", "newest_id": tweet_id(0.5)}
+    tss, c = scraper.search_new_tweets("q", cursor)
+    assert tss == [] and c == cursor
+
+
+def test_search_new_keeps_scraped_and_dropped_hashes(monkeypatch):
+    gs = GoogleSearch(None, "key", "http://browserless")
+    calls = []
+
+    def search_many(s_path, queries, skip_hashes=None, tbs=None, dropped=None):
+        calls.append((set(skip_hashes), tbs))
+        dropped.append("dup")
+        return [{"url_hash": "new1"}, {"url_hash": "new2"}]
+
+    monkeypatch.setattr(gs, "search_many", search_many)
+    srs, c = gs.search_new("/search", ["q"], None)
+    assert len(srs) == 2
+    assert calls[-1] == (set(), "qdr:d")
+    assert c["url_hashes"] == ["new1", "new2", "dup"]
+
+    # A run within the hour only searches the past hour, and skips what earlier runs scraped
+    srs, c = gs.search_new("/search", ["q"], c)
+    assert calls[-1] == ({"new1", "new2", "dup"}, "qdr:h")
+    assert c["url_hashes"][:3] == ["new1", "new2", "dup"]
+
+    c["last_run_at"] = (datetime.datetime.now(datetime.UTC) - datetime.timedelta(hours=2)).isoformat()
+    c["url_hashes"] = [f"old{i}" for i in range(JOB_CURSOR_MAX_URLS)]
+    _, c = gs.search_new("/search", ["q"], c)
+    assert calls[-1][1] == "qdr:d"
+    assert len(c["url_hashes"]) == JOB_CURSOR_MAX_URLS
+    assert c["url_hashes"][:4] == ["new1", "new2", "dup", "old0"]